@@ -0,0 +1,5 @@
+source venv/bin/activate
+export PYTHONPATH=$PYTHONPATH:.
+# compares medians against the latest stored baseline, a new one is stored from a clean checkout
+# with ./bench.sh --benchmark-save=baseline
+pytest benchmarks --benchmark-storage=benchmarks/.benchmarks --benchmark-compare --benchmark-compare-fail=median:50% "$@"
@@ -0,0 +1,84 @@
+"""
+    Compares encode time and size of the read endpoint response formats.
+
+    Usage (from the repository root):
+        PYTHONPATH=. python3 benchmarks/bench_formats.py --citizens 10000 --relatives 5
+"""
+import argparse
+import json
+import random
+from datetime import date, timedelta
+from timeit import timeit
+
+from yandex_school.app import app
+from yandex_school.formats import JSON, MSGPACK, ARROW
+from yandex_school.storage.memory import MemoryStorage
+
+ENDPOINTS = ('citizens', 'citizens/birthdays', 'towns/stat/percentile/age')
+
+
+def generate(count: int, relatives: int, seed: int = 0):
+    """
+    Generates validated citizens with mutual relationships
+    :param count: number of citizens
+    :param relatives: average number of relatives per citizen
+    :param seed: random seed
+    :return: citizens, relative links
+    """
+    rnd = random.Random(seed)
+    links = set()
+    for _ in range(count * relatives // 2):
+        a, b = rnd.randint(1, count), rnd.randint(1, count)
+        if a != b:
+            links.update({(a, b), (b, a)})
+    family = {x: [] for x in range(1, count + 1)}
+    for a, b in links:
+        family[a].append(b)
+    citizens = [{
+        'citizen_id': x,
+        'town': f'Город {rnd.randint(1, 20)}',
+        'street': f'Улица {rnd.randint(1, 200)}',
+        'building': f'{rnd.randint(1, 100)}к{rnd.randint(1, 5)}',
+        'apartment': rnd.randint(1, 500),
+        'name': f'Житель Номер {x}',
+        'birth_date': date(1940, 1, 1) + timedelta(days=rnd.randint(0, 25000)),
+        'gender': rnd.choice(('male', 'female')),
+        'relatives': family[x]
+    } for x in range(1, count + 1)]
+    return citizens, sorted(links)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--citizens', type=int, default=10000)
+    parser.add_argument('--relatives', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app.config['STORAGE_BACKEND'] = 'memory'
+    with app.app_context():
+        app.extensions.setdefault('storage', {})['memory'] = storage = MemoryStorage()
+    import_id = storage.create_import(*generate(args.citizens, args.relatives))
+
+    client = app.test_client()
+    print(f'{args.citizens} citizens, ~{args.relatives} relatives each')
+    print(f'{"endpoint":28} {"format":38} {"size, bytes":>12} {"time, ms":>10}')
+    for endpoint in ENDPOINTS:
+        query = f'/imports/{import_id}/{endpoint}'
+        for mimetype in (JSON, MSGPACK, ARROW):
+            response = client.get(query, headers={'Accept': mimetype})
+            if response.mimetype != mimetype:
+                print(f'{endpoint:28} {mimetype:38} {"unavailable":>12}')
+                continue
+            seconds = timeit(lambda: client.get(query, headers={'Accept': mimetype}), number=args.repeat)
+            print(f'{endpoint:28} {mimetype:38} {len(response.data):12d} {seconds / args.repeat * 1000:10.1f}')
+
+    # decoding cost on the consumer side, JSON needs dates parsed back
+    response = client.get(f'/imports/{import_id}/citizens', headers={'Accept': JSON})
+    seconds = timeit(lambda: [x['birth_date'].split('.') for x in json.loads(response.data)['data']],
+                     number=args.repeat)
+    print(f'citizens JSON decode incl. dates: {seconds / args.repeat * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+    Compares the dict per row pipeline of GetCitizens and GetBirthdays with the positional tuple one.
+
+    The dict pipeline is the former implementation: every row is turned into a dict first, citizens are serialized
+    by marshmallow, birthdays are aggregated through nested dict maps. Both pipelines get the same tuple rows
+    from the memory storage, the dict one pays for dict(zip(columns, row)) where it used to pay for dict(RowProxy).
+    Allocations are objects created by the pipeline stages and alive until the response is built,
+    peak is the tracemalloc peak of a single run.
+
+    Usage (from the repository root):
+        PYTHONPATH=. python3 benchmarks/bench_rows.py --citizens 10000 --relatives 10
+"""
+import argparse
+import gc
+import tracemalloc
+from timeit import timeit
+
+from benchmarks.bench_formats import generate
+from yandex_school import aggregation
+from yandex_school.resources import GetCitizens
+from yandex_school.storage.memory import MemoryStorage, CITIZEN_COLUMNS
+from yandex_school.validation import citizensSchema
+
+
+def citizens_dicts(raw_citizens):
+    citizens = [dict(zip(CITIZEN_COLUMNS + ('relative_id',), raw)) for raw in raw_citizens]
+    id_map = {citizen['id']: citizen['citizen_id'] for citizen in citizens}
+    prev_id = 0
+    result = []
+    for citizen in citizens:
+        relative_id = citizen['relative_id']
+        if prev_id == citizen['citizen_id']:
+            result[-1]['relatives'].append(id_map[relative_id])
+        else:
+            del citizen['relative_id']
+            citizen['relatives'] = [id_map[relative_id]] if relative_id else []
+            result.append(citizen)
+        prev_id = citizen['citizen_id']
+    return citizens, id_map, citizensSchema.dump(result)
+
+
+def citizens_tuples(raw_citizens):
+    return GetCitizens.merge_by_relatives(raw_citizens),
+
+
+def birthdays_dicts(raw_rows):
+    rows = [dict(zip(('id', 'citizen_id', 'birth_date', 'relative_id'), raw)) for raw in raw_rows]
+    id_bd_map = {x['id']: {'citizen_id': x['citizen_id'], 'month': x['birth_date'].month} for x in rows}
+    presents = {}
+    for row in rows:
+        citizen_id = id_bd_map[row['id']]['citizen_id']
+        db_relative_id = row['relative_id']
+        if not db_relative_id:
+            continue
+        month = id_bd_map[db_relative_id]['month']
+        try:
+            presents[citizen_id][month] += 1
+        except KeyError:
+            try:
+                presents[citizen_id][month] = 1
+            except KeyError:
+                presents[citizen_id] = {month: 1}
+    return rows, id_bd_map, presents, aggregation.cells_by_month(aggregation.presents_cells(presents))
+
+
+def birthdays_tuples(raw_rows):
+    presents = aggregation.birthday_presents(raw_rows)
+    return presents, aggregation.cells_by_month(aggregation.presents_cells(presents))
+
+
+def measure(pipeline, rows, repeat: int):
+    """
+    :return: milliseconds per run, allocated blocks, peak traced bytes
+    """
+    seconds = timeit(lambda: pipeline(rows), number=repeat) / repeat
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    stages = pipeline(rows)
+    peak = tracemalloc.get_traced_memory()[1] - start
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    del stages
+    return seconds * 1000, blocks, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--citizens', type=int, default=10000)
+    parser.add_argument('--relatives', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    storage = MemoryStorage()
+    import_id = storage.create_import(*generate(args.citizens, args.relatives))
+    citizen_rows = storage.citizens_with_relatives(import_id)
+    birthday_rows = storage.birthday_rows(import_id)
+    assert citizens_dicts(citizen_rows)[-1] == citizens_tuples(citizen_rows)[-1]
+    assert birthdays_dicts(birthday_rows)[-1] == birthdays_tuples(birthday_rows)[-1]
+
+    print(f'{args.citizens} citizens, {len(citizen_rows)} joined rows')
+    print(f'{"pipeline":22} {"time, ms":>10} {"allocations":>12} {"peak, bytes":>14}')
+    for name, pipeline, rows in (('citizens dicts', citizens_dicts, citizen_rows),
+                                 ('citizens tuples', citizens_tuples, citizen_rows),
+                                 ('birthdays dicts', birthdays_dicts, birthday_rows),
+                                 ('birthdays tuples', birthdays_tuples, birthday_rows)):
+        milliseconds, blocks, peak = measure(pipeline, rows, args.repeat)
+        print(f'{name:22} {milliseconds:10.1f} {blocks:12d} {peak:14d}')
+
+
+if __name__ == '__main__':
+    main()
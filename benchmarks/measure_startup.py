@@ -0,0 +1,129 @@
+"""
+    Measures gunicorn startup time and per-worker memory for a given gunicorn config.
+
+    Usage (from the repository root):
+        python3 benchmarks/measure_startup.py gunicorn.py.ini gunicorn.preload.py.ini --workers 4
+
+    RSS counts shared pages in every worker, PSS splits them between sharers and
+    USS is memory private to the worker. Copy-on-write sharing shows up as lower PSS/USS.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def children(pid: int) -> List[int]:
+    """
+    Lists child processes of a process
+    :param pid: parent process id
+    :return: list of child process ids
+    """
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as file:
+            return [int(x) for x in file.read().split()]
+    except FileNotFoundError:
+        return []
+
+
+def memory(pid: int) -> Dict[str, int]:
+    """
+    Reads memory usage of a process from procfs
+    :param pid: process id
+    :return: dict of rss, pss, uss in kilobytes
+    """
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'rss': values.get('Rss', 0),
+        'pss': values.get('Pss', 0),
+        'uss': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0)
+    }
+
+
+def wait_for(url: str, deadline: float) -> bool:
+    """
+    Polls url until it answers with any http status
+    :param url: url to poll
+    :param deadline: time.monotonic() value to give up at
+    :return: True if server answered
+    """
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return True
+        except urllib.error.HTTPError:
+            return True
+        except OSError:  # refused, reset or timed out while booting
+            time.sleep(0.01)
+    return False
+
+
+def measure(config: str, workers: int, port: int, warmup: int) -> None:
+    """
+    Starts gunicorn, waits until all workers serve requests and prints timings and memory
+    :param config: gunicorn config file
+    :param workers: number of workers
+    :param port: port to bind to
+    :param warmup: number of requests hitting endpoints with lazy imports
+    :return: None
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.environ.get('PYTHONPATH'), ROOT,
+                                                                     os.path.join(ROOT, 'yandex_school')])))
+    base_url = f'http://127.0.0.1:{port}'
+    started = time.monotonic()
+    master = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', config, '-w', str(workers),
+                               '-b', f'127.0.0.1:{port}', 'app:app'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for(f'{base_url}/metrics', started + 60):
+            print(f'{config}: server did not start')
+            return
+        first_response = time.monotonic() - started
+
+        while len(children(master.pid)) < workers and time.monotonic() - started < 60:
+            time.sleep(0.01)
+        all_workers = time.monotonic() - started
+
+        for _ in range(warmup):
+            wait_for(f'{base_url}/imports/1/towns/stat/percentile/age', time.monotonic() + 5)
+
+        workers_memory = [memory(pid) for pid in children(master.pid)]
+        master_memory = memory(master.pid)
+
+        print(f'{config}')
+        print(f'  first response: {first_response * 1000:8.1f} ms')
+        print(f'  all workers:    {all_workers * 1000:8.1f} ms')
+        print(f'  master:         rss {master_memory["rss"]:8d} kB')
+        for key in ('rss', 'pss', 'uss'):
+            values = [x[key] for x in workers_memory]
+            print(f'  worker {key}:     avg {sum(values) // len(values):8d} kB, total {sum(values):8d} kB')
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('configs', nargs='+', help='gunicorn config files to compare')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--warmup', type=int, default=20, help='requests to warm up lazy imports')
+    args = parser.parse_args()
+    for config in args.configs:
+        measure(config, args.workers, args.port, args.warmup)
+
+
+if __name__ == '__main__':
+    main()
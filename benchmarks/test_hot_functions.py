@@ -0,0 +1,121 @@
+"""
+    Micro-benchmarks of the pure-Python hot functions, no database involved.
+    Rows are produced by the memory storage, which returns them in the same shape as the SQL storage does.
+
+    Usage (from the repository root):
+        ./bench.sh
+    compares against the stored baseline and fails if the median of any benchmark got more than 50% slower
+    (shared CI machines are noisy). Store a new baseline from a clean checkout with ./bench.sh --benchmark-save=baseline
+"""
+import random
+from datetime import date
+
+import pytest
+
+from benchmarks.bench_formats import generate
+from yandex_school import aggregation, stats
+from yandex_school.resources import GetCitizens
+from yandex_school.storage.memory import MemoryStorage
+from yandex_school.validation import validate_relatives, validate_citizen_ids
+
+SIZES = (1000, 10000, 100000)
+# average number of relatives per citizen
+DENSITIES = {'sparse': 1, 'dense': 6}
+TODAY = date(2019, 8, 1)
+
+_imports = {}
+
+
+def make_import(size: int, density: str):
+    """
+    :return: citizens, memory storage holding them as import 1
+    """
+    key = (size, density)
+    if key not in _imports:
+        citizens, links = generate(size, DENSITIES[density], seed=size)
+        storage = MemoryStorage()
+        storage.create_import(citizens, links)
+        _imports.clear()  # keep only one 100k import alive
+        _imports[key] = citizens, storage
+    return _imports[key]
+
+
+def rounds(size: int) -> dict:
+    # sub-millisecond cases need many rounds for a stable median
+    return {'rounds': max(5, 200000 // size), 'iterations': 1, 'warmup_rounds': 2}
+
+
+def birthdays_python(rows):
+    return aggregation.cells_by_month(aggregation.presents_cells(aggregation.birthday_presents(rows)))
+
+
+def birthdays_numpy(rows):
+    return aggregation.cells_by_month(aggregation.birthday_cells(rows))
+
+
+params = pytest.mark.parametrize('size,density', [(size, density) for size in SIZES for density in DENSITIES])
+
+
+@params
+def test_validate_relatives(benchmark, size, density):
+    citizens, _ = make_import(size, density)
+    benchmark.pedantic(validate_relatives, (citizens,), **rounds(size))
+
+
+@params
+def test_validate_citizen_ids(benchmark, size, density):
+    citizens, _ = make_import(size, density)
+    benchmark.pedantic(validate_citizen_ids, (citizens,), **rounds(size))
+
+
+@params
+def test_merge_by_relatives(benchmark, size, density):
+    _, storage = make_import(size, density)
+    rows = storage.citizens_with_relatives(1)
+    benchmark.pedantic(GetCitizens.merge_by_relatives, (rows,), **rounds(size))
+
+
+@params
+def test_relatives_diff(benchmark, size, density):
+    # a PATCH replacing relatives of every citizen of the import
+    citizens, _ = make_import(size, density)
+    rnd = random.Random(size)
+    requests = [(x['relatives'], rnd.sample(range(1, size + 1), len(x['relatives']) or 1)) for x in citizens]
+
+    def diff_all():
+        for current, requested in requests:
+            aggregation.relatives_diff(current, requested)
+
+    benchmark.pedantic(diff_all, **rounds(size))
+
+
+@params
+def test_birthday_presents(benchmark, size, density):
+    _, storage = make_import(size, density)
+    rows = storage.birthday_rows(1)
+    benchmark.pedantic(birthdays_python, (rows,), **rounds(size))
+
+
+@params
+def test_birthday_cells(benchmark, size, density):
+    _, storage = make_import(size, density)
+    rows = storage.birthday_rows(1)
+    benchmark.pedantic(birthdays_numpy, (rows,), **rounds(size))
+
+
+@pytest.mark.parametrize('engine', ('python', 'numpy'))
+@pytest.mark.parametrize('size', SIZES[1:])
+def test_birthdays_dense_families(benchmark, engine, size):
+    # large families, about 20 relatives each
+    citizens, links = generate(size, 20, seed=size)
+    storage = MemoryStorage()
+    storage.create_import(citizens, links)
+    rows = storage.birthday_rows(1)
+    benchmark.pedantic(birthdays_python if engine == 'python' else birthdays_numpy, (rows,), **rounds(size))
+
+
+@params
+def test_town_ages(benchmark, size, density):
+    _, storage = make_import(size, density)
+    rows = storage.town_stat_rows(1)
+    benchmark.pedantic(stats.compute, (rows, stats.AGE_PERCENTILES, TODAY), **rounds(size))
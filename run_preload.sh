@@ -0,0 +1,5 @@
+#!/bin/bash
+source venv/bin/activate
+export DEV=1
+export PYTHONPATH=$PYTHONPATH:yandex_school
+gunicorn -c gunicorn.preload.py.ini app:app
@@ -0,0 +1,145 @@
+import logging
+import subprocess
+import sys
+
+import pytest
+
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, send_get_citizens_request, \
+    send_get_metrics_request
+from yandex_school import admission
+from yandex_school.app import app
+from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    app.config['TESTING'] = True
+    client = app.test_client()
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
+    reset_storage(app)
+    monkeypatch.setitem(app.config, 'ADMISSION_CONTROL', True)
+    monkeypatch.setitem(app.config, 'ADMISSION_DIR', str(tmp_path))
+    monkeypatch.setitem(app.config, 'ADMISSION_LIMITS', {'getcitizens': 2, 'createimport': 3})
+    monkeypatch.setitem(app.config, 'ADMISSION_QUEUE_SIZE', 1)
+    monkeypatch.setitem(app.config, 'ADMISSION_TIMEOUT', 0.05)
+    yield client
+
+
+def hold_slots(endpoint: str, limit: int, count: int):
+    with app.test_request_context():
+        return admission.acquire(endpoint, limit, count)
+
+
+def hold_queue(endpoint: str, slots: int = 1):
+    with app.test_request_context():
+        ticket = admission._Ticket(admission._path(endpoint), slots)
+        with admission._state(ticket.path) as state:
+            state['queue'].append(ticket.entry)
+        return ticket
+
+
+def test_admitted(client):
+    status, data = send_create_import_request(client, {'citizens': [make_citizen()]})
+    assert status == 201
+    import_id = data['data']['import_id']
+
+    # one busy slot of two leaves room for a request
+    slots = hold_slots('getcitizens', 2, 1)
+    status, data = send_get_citizens_request(client, import_id)
+    assert status == 200
+    slots.release()
+
+
+def test_rejected_when_queue_is_full(client):
+    status, data = send_create_import_request(client, {'citizens': [make_citizen()]})
+    import_id = data['data']['import_id']
+
+    slots = hold_slots('getcitizens', 2, 2)
+    queue = hold_queue('getcitizens')
+
+    response = client.get(f'/imports/{import_id}/citizens')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(app.config['ADMISSION_RETRY_AFTER'])
+
+    status, data = send_get_metrics_request(client)
+    assert data['data']['counters']['admission_rejected.getcitizens'] >= 1
+    assert data['data']['gauges']['admission']['getcitizens'] == {'limit': 2, 'busy': 2, 'queue': 1}
+
+    queue.release()
+    slots.release()
+
+    status, data = send_get_citizens_request(client, import_id)
+    assert status == 200
+
+
+def test_rejected_on_wait_timeout(client):
+    status, data = send_create_import_request(client, {'citizens': [make_citizen()]})
+    import_id = data['data']['import_id']
+
+    slots = hold_slots('getcitizens', 2, 2)
+    response = client.get(f'/imports/{import_id}/citizens')
+    assert response.status_code == 503
+    slots.release()
+
+    status, data = send_get_metrics_request(client)
+    assert data['data']['counters']['admission_timeouts.getcitizens'] >= 1
+
+
+def test_payload_weight(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'ADMISSION_WEIGHT_BYTES', 1000)
+    small = {'citizens': [make_citizen()]}
+    large = {'citizens': [make_citizen(citizen_id=x) for x in range(1, 30)]}
+
+    with app.test_request_context(json=small):
+        assert admission.weight('createimport', 3) == 1
+    with app.test_request_context(json=large):
+        assert admission.weight('createimport', 3) == 3
+
+    # large import needs every slot, small one fits into what is left
+    slots = hold_slots('createimport', 3, 1)
+    status, data = send_create_import_request(client, large)
+    assert status == 503
+    status, data = send_create_import_request(client, small)
+    assert status == 201
+    slots.release()
+
+    status, data = send_create_import_request(client, large)
+    assert status == 201
+
+
+def test_first_come_first_served(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'ADMISSION_QUEUE_SIZE', 2)
+    small = {'citizens': [make_citizen()]}
+
+    # a heavy request waits for all three slots, a light one arriving later does not overtake it
+    slots = hold_slots('createimport', 3, 1)
+    heavy = hold_queue('createimport', 3)
+    status, data = send_create_import_request(client, small)
+    assert status == 503
+    status, data = send_get_metrics_request(client)
+    assert data['data']['counters']['admission_timeouts.createimport'] >= 1
+    assert data['data']['gauges']['admission']['createimport'] == {'limit': 3, 'busy': 1, 'queue': 1}
+
+    heavy.release()
+    status, data = send_create_import_request(client, small)
+    assert status == 201
+    slots.release()
+
+
+def test_dead_workers_release_slots(client):
+    status, data = send_create_import_request(client, {'citizens': [make_citizen()]})
+    import_id = data['data']['import_id']
+
+    # slots left behind by a worker killed while serving requests
+    worker = subprocess.Popen([sys.executable, '-c', 'pass'])
+    worker.wait()
+    with app.test_request_context():
+        with admission._state(admission._path('getcitizens')) as state:
+            state['busy'].append(['dead', worker.pid, 2])
+
+    status, data = send_get_citizens_request(client, import_id)
+    assert status == 200
+    status, data = send_get_metrics_request(client)
+    assert data['data']['gauges']['admission']['getcitizens'] == {'limit': 2, 'busy': 0, 'queue': 0}
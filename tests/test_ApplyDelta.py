@@ -0,0 +1,190 @@
+import logging
+import random
+import threading
+
+import pytest
+from marshmallow import ValidationError
+from sqlalchemy import create_engine
+
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, send_apply_delta_request, \
+    send_get_citizens_request, send_get_families_request, send_get_ages_request, send_get_birthdays_request
+from tests.test_GetFamilies import expected_families
+from yandex_school.app import app
+from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+from yandex_school.storage import get_storage
+from yandex_school.storage.sql import SQLStorage
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    client = app.test_client()
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
+    reset_storage(app)
+    yield client
+
+
+def create_import(client, citizens: list) -> int:
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+    return data['data']['import_id']
+
+
+def test_bad_import_id(client):
+    status, data = send_apply_delta_request(client, 1, {'removed': [1]})
+    assert status == 404
+
+
+def test_bad_delta(client):
+    import_id = create_import(client, [make_citizen(citizen_id=1, relatives=[2]),
+                                       make_citizen(citizen_id=2, relatives=[1]),
+                                       make_citizen(citizen_id=3)])
+    bad_deltas = [
+        {},
+        {'removed': []},
+        {'removed': ['1']},
+        {'citizens': [{'citizen_id': 4}]},
+        {'citizens': [make_citizen(citizen_id=4), make_citizen(citizen_id=4)]},
+        # unknown citizen
+        {'removed': [4]},
+        # replaced and removed at once
+        {'citizens': [make_citizen(citizen_id=3)], 'removed': [3]},
+        # 2 would keep a removed relative
+        {'removed': [1]},
+        # 3 does not list 4
+        {'citizens': [make_citizen(citizen_id=4, relatives=[3])]},
+        # 2 still lists 1
+        {'citizens': [make_citizen(citizen_id=1, relatives=[])]},
+        # unknown relative
+        {'citizens': [make_citizen(citizen_id=3, relatives=[5])]},
+        # new relatives do not agree
+        {'citizens': [make_citizen(citizen_id=3, relatives=[4]), make_citizen(citizen_id=4)]},
+    ]
+    for body in bad_deltas:
+        status, data = send_apply_delta_request(client, import_id, body)
+        assert status == 400, body
+
+    # nothing has changed
+    status, data = send_get_citizens_request(client, import_id)
+    assert [x['relatives'] for x in data['data']] == [[2], [1], []]
+
+
+def test_apply_delta(client):
+    import_id = create_import(client, [make_citizen(citizen_id=1, relatives=[2]),
+                                       make_citizen(citizen_id=2, relatives=[1]),
+                                       make_citizen(citizen_id=3, relatives=[4]),
+                                       make_citizen(citizen_id=4, relatives=[3]),
+                                       make_citizen(citizen_id=5)])
+    # warm up cached derived data
+    send_get_families_request(client, import_id)
+    send_get_ages_request(client, import_id)
+
+    status, data = send_apply_delta_request(client, import_id, {
+        'citizens': [make_citizen(citizen_id=2, town='Керчь', birth_date='01.02.2000', relatives=[5, 6]),
+                     make_citizen(citizen_id=5, relatives=[2]),
+                     make_citizen(citizen_id=6, relatives=[2, 6])],
+        'removed': [1],
+    })
+    assert status == 200
+    assert data['data'] == {'import_id': import_id, 'inserted': 1, 'replaced': 2, 'deleted': 1}
+
+    status, data = send_get_citizens_request(client, import_id)
+    assert status == 200
+    citizens = {x['citizen_id']: x for x in data['data']}
+    assert sorted(citizens) == [2, 3, 4, 5, 6]
+    assert citizens[2]['town'] == 'Керчь'
+    assert citizens[2]['birth_date'] == '01.02.2000'
+    assert {k: sorted(v['relatives']) for k, v in citizens.items()} == {2: [5, 6], 3: [4], 4: [3], 5: [2],
+                                                                           6: [2, 6]}
+
+    status, data = send_get_families_request(client, import_id)
+    assert data['data'] == expected_families(list(citizens.values()))
+
+    status, data = send_get_birthdays_request(client, import_id)
+    assert status == 200
+    assert data['data']['2'] == [{'citizen_id': 5, 'presents': 1}, {'citizen_id': 6, 'presents': 1}]
+
+    status, data = send_get_ages_request(client, import_id)
+    assert [x['town'] for x in data['data']] == ['Керчь', 'Москва']
+    with app.app_context():
+        storage = get_storage()
+        maintained = storage.birth_histogram(import_id)
+        storage.rebuild_birth_histogram(import_id)
+        assert storage.birth_histogram(import_id) == maintained
+
+
+def test_random_deltas(client):
+    random.seed(45)
+    relatives = {x: set() for x in range(1, 21)}
+    import_id = create_import(client, [make_citizen(citizen_id=x) for x in relatives])
+    send_get_families_request(client, import_id)
+    next_id = 21
+
+    for step in range(20):
+        # odd deltas insert and delete citizens, even ones only replace, cached families are rebuilt in place
+        removed = random.sample(sorted(relatives), 2) if step % 2 else []
+        # relatives of removed citizens have to be replaced as well
+        listed = set(random.sample(sorted(relatives), 3)) | {r for x in removed for r in relatives[x]}
+        listed -= set(removed)
+        for citizen in removed:
+            for relative in relatives.pop(citizen):
+                relatives.get(relative, set()).discard(citizen)
+        if step % 2:
+            listed.add(next_id)
+            relatives[next_id] = set()
+            next_id += 1
+        affected = set(listed)
+        for citizen in sorted(listed):
+            for relative in random.sample(sorted(relatives[citizen]), min(1, len(relatives[citizen]))):
+                relatives[citizen].discard(relative)
+                relatives[relative].discard(citizen)
+                affected.add(relative)
+            for relative in random.sample(sorted(relatives), 2):
+                relatives[citizen].add(relative)
+                relatives[relative].add(citizen)
+                affected.add(relative)
+        listed = affected
+
+        status, data = send_apply_delta_request(client, import_id, {
+            'citizens': [make_citizen(citizen_id=x, relatives=sorted(relatives[x])) for x in sorted(listed)],
+            'removed': removed,
+        })
+        assert status == 200
+
+        status, data = send_get_citizens_request(client, import_id)
+        assert {x['citizen_id']: sorted(x['relatives']) for x in data['data']} == \
+               {k: sorted(v) for k, v in relatives.items()}
+        status, families = send_get_families_request(client, import_id)
+        assert families['data'] == expected_families(data['data'])
+
+
+def test_concurrent_removals(client):
+    if app.config['STORAGE_BACKEND'] != 'sql':
+        pytest.skip('workers share nothing but the database with sql storage')
+    import_id = create_import(client, [make_citizen(citizen_id=x) for x in range(1, 4)])
+
+    # every worker validates the same removal, the ones locking the import after the first see it gone
+    workers = [SQLStorage(engine=create_engine(app.config['SQLALCHEMY_DATABASE_URI'])) for _ in range(4)]
+    outcomes = []
+
+    def remove(storage: SQLStorage) -> None:
+        try:
+            outcomes.append(storage.apply_delta(import_id, [], [3])['deleted'])
+        except ValidationError:
+            outcomes.append('invalid')
+
+    threads = [threading.Thread(target=remove, args=(storage,)) for storage in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for storage in workers:
+        storage.engine.dispose()
+    assert sorted(outcomes, key=str) == [1, 'invalid', 'invalid', 'invalid']
+
+    status, data = send_apply_delta_request(client, import_id, {'removed': [3]})
+    assert status == 400
+    status, data = send_get_citizens_request(client, import_id)
+    assert [x['citizen_id'] for x in data['data']] == [1, 2]
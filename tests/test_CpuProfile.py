@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import sys
+from time import sleep
+
+import pytest
+
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, send_get_metrics_request
+from yandex_school import cpuprof
+from yandex_school.app import app
+from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+from yandex_school.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    app.config['TESTING'] = True
+    client = app.test_client()
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
+    monkeypatch.setitem(app.config, 'CPU_PROFILING', True)
+    monkeypatch.setitem(app.config, 'CPU_PROFILING_DIR', str(tmp_path))
+    reset_storage(app)
+    yield client
+
+
+def profiles(directory) -> list:
+    """
+    Tags of the written profiles, oldest first
+    """
+    names = sorted(x for x in os.listdir(directory) if x.endswith('.json'))
+    return [json.loads((directory / x).read_text()) for x in names]
+
+
+def create_import(client, count: int) -> int:
+    status, data = send_create_import_request(client, {'citizens': [make_citizen(citizen_id=x)
+                                                                     for x in range(1, count + 1)]})
+    assert status == 201
+    return data['data']['import_id']
+
+
+def test_collapse():
+    stack = cpuprof.collapse(sys._getframe())
+    assert stack.split(';')[-1].startswith('test_collapse (test_CpuProfile.py:')
+    # outer frames come first
+    assert stack.index('pytest_pyfunc_call (') < stack.index('test_collapse (')
+
+
+def test_fast_requests_not_written(client, tmp_path):
+    import_id = create_import(client, 3)
+    assert client.get(f'/imports/{import_id}/citizens').status_code == 200
+    assert profiles(tmp_path) == []
+
+
+def test_slow_requests_written(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'CPU_PROFILING_THRESHOLD', 0.0)
+    import_id = create_import(client, 5)
+    assert client.get(f'/imports/{import_id}/citizens/birthdays').status_code == 200
+
+    created, birthdays = profiles(tmp_path)
+    assert created['endpoint'] == 'createimport'
+    assert created['citizens'] == 5
+    assert birthdays['endpoint'] == 'getbirthdays'
+    assert birthdays['import_id'] == import_id
+    assert birthdays['citizens'] == 5
+    assert not birthdays['forced']
+    if app.config['STORAGE_BACKEND'] != 'memory':
+        assert 0 < birthdays['db_time'] <= birthdays['duration']
+
+    # every collapsed stack line ends with its number of samples
+    for name in os.listdir(tmp_path):
+        if name.endswith('.folded'):
+            for line in (tmp_path / name).read_text().splitlines():
+                stack, count = line.rsplit(' ', 1)
+                assert stack and int(count) > 0
+
+    status, data = send_get_metrics_request(client)
+    assert data['data']['counters']['cpu_profiled.getbirthdays'] >= 1
+
+
+def test_debug_header(client, monkeypatch, tmp_path):
+    import_id = create_import(client, 3)
+    header = {app.config['CPU_PROFILING_HEADER']: '1'}
+    assert client.get(f'/imports/{import_id}/citizens', headers=header).status_code == 200
+    assert [x['forced'] for x in profiles(tmp_path)] == [True]
+
+    # the header is ignored from addresses outside of the allowlist
+    monkeypatch.setitem(app.config, 'CPU_PROFILING_ALLOWLIST', ('10.0.0.0/8',))
+    assert client.get(f'/imports/{import_id}/citizens', headers=header).status_code == 200
+    assert len(profiles(tmp_path)) == 1
+
+
+def test_sampled_past_threshold(client, tmp_path, monkeypatch):
+    import_id = create_import(client, 3)
+    with app.app_context():
+        storage = get_storage()
+    fetch = storage.citizens_with_relatives
+
+    def citizens_with_relatives(import_id: int) -> list:
+        sleep(0.05)
+        return fetch(import_id)
+
+    sampled = []
+
+    def collapse(frame) -> str:
+        sampled.append(1)
+        return 'sampled'
+
+    monkeypatch.setattr(storage, 'citizens_with_relatives', citizens_with_relatives)
+    monkeypatch.setattr(cpuprof, 'collapse', collapse)
+    # ten sampling intervals long, still below the threshold
+    assert client.get(f'/imports/{import_id}/citizens').status_code == 200
+    assert sampled == []
+
+    header = {app.config['CPU_PROFILING_HEADER']: '1'}
+    assert client.get(f'/imports/{import_id}/citizens', headers=header).status_code == 200
+    assert profiles(tmp_path)[-1]['samples'] == len(sampled) > 0
+
+
+def test_retention(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'CPU_PROFILING_THRESHOLD', 0.0)
+    monkeypatch.setitem(app.config, 'CPU_PROFILING_KEEP', 2)
+    import_id = create_import(client, 3)
+    for _ in range(3):
+        assert client.get(f'/imports/{import_id}/citizens').status_code == 200
+    assert [x['endpoint'] for x in profiles(tmp_path)] == ['getcitizens', 'getcitizens']
+    assert len(os.listdir(tmp_path)) == 4
+
+
+def test_size_not_queried(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'CPU_PROFILING_THRESHOLD', 0.0)
+    import_id = create_import(client, 3)
+
+    # the size is only tagged by resources which have got the citizens at hand
+    def citizen_ids(import_id: int) -> list:
+        raise AssertionError('import size read after the request')
+
+    with app.app_context():
+        monkeypatch.setattr(get_storage(), 'citizen_ids', citizen_ids)
+    assert client.patch(f'/imports/{import_id}/citizens/1', json={'name': 'Петров'}).status_code == 200
+    created, patched = profiles(tmp_path)
+    assert patched['endpoint'] == 'patchcitizen'
+    assert patched['import_id'] == import_id
+    assert 'citizens' not in patched
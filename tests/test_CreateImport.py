@@ -1,12 +1,17 @@
 import logging
+import threading
 
 import pytest
 from flask.testing import FlaskClient
+from sqlalchemy import create_engine
 
-from tests.testing_utils import send_create_import_request, make_citizen
-from yandex_school import db
+from tests.testing_utils import reset_storage, send_create_import_request, make_citizen, send_patch_citizen_request, \
+    send_get_metrics_request
 from yandex_school.app import app
 from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+from yandex_school.dedup import citizens_digest
+from yandex_school.storage.sql import SQLStorage
+from yandex_school.validation import citizensSchema
 
 logger = logging.getLogger(__name__)
 
@@ -18,8 +23,7 @@ def client():
     app.config['TESTING'] = True
     client: FlaskClient = app.test_client()
     app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
-    db.drop_all()
-    db.create_all()
+    reset_storage(app)
     yield client
 
 
@@ -198,3 +202,116 @@ def test_good_citizens_relationships(client: FlaskClient):
     body = {'citizens': [good_citizen1, good_citizen2]}
     status, data = send_create_import_request(client, body)
     assert status == 201
+
+
+def test_dedup_always_new(client: FlaskClient, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMPORT_DEDUP_POLICY', 'always_new')
+    body = {'citizens': [make_citizen()]}
+    status, first = send_create_import_request(client, body)
+    assert status == 201
+    status, second = send_create_import_request(client, body)
+    assert status == 201
+    assert first['data']['import_id'] != second['data']['import_id']
+
+
+def test_dedup_policy_switch(client: FlaskClient, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMPORT_DEDUP_POLICY', 'dedup')
+    body = {'citizens': [make_citizen()]}
+    status, first = send_create_import_request(client, body)
+    assert status == 201
+
+    # the import changes while no hashes are looked up, its stored hash must go anyway
+    monkeypatch.setitem(app.config, 'IMPORT_DEDUP_POLICY', 'always_new')
+    status, data = send_patch_citizen_request(client, first['data']['import_id'], 1, {'name': 'Петров Петр Петрович'})
+    assert status == 200
+
+    monkeypatch.setitem(app.config, 'IMPORT_DEDUP_POLICY', 'dedup')
+    status, second = send_create_import_request(client, body)
+    assert status == 201
+    assert second['data']['import_id'] != first['data']['import_id']
+
+
+def test_dedup_same_content(client: FlaskClient, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMPORT_DEDUP_POLICY', 'dedup')
+    citizens = [make_citizen(citizen_id=1, relatives=[2, 3]),
+                make_citizen(citizen_id=2, relatives=[1]),
+                make_citizen(citizen_id=3, relatives=[1])]
+    status, first = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+
+    # same citizens, different order of citizens and relatives
+    reordered = [make_citizen(citizen_id=3, relatives=[1]),
+                 make_citizen(citizen_id=1, relatives=[3, 2]),
+                 make_citizen(citizen_id=2, relatives=[1])]
+    status, second = send_create_import_request(client, {'citizens': reordered})
+    assert status == 201
+    assert first['data']['import_id'] == second['data']['import_id']
+
+    changed = [make_citizen(citizen_id=3, relatives=[1], name='Петров Петр Петрович'),
+               make_citizen(citizen_id=1, relatives=[3, 2]),
+               make_citizen(citizen_id=2, relatives=[1])]
+    status, third = send_create_import_request(client, {'citizens': changed})
+    assert status == 201
+    assert first['data']['import_id'] != third['data']['import_id']
+
+    status, data = send_get_metrics_request(client)
+    assert status == 200
+    assert data['data']['counters']['dedup_hits'] >= 1
+
+
+def test_dedup_concurrent_workers(client: FlaskClient):
+    if app.config['STORAGE_BACKEND'] != 'sql':
+        pytest.skip('workers share nothing but the database with sql storage')
+    citizens = citizensSchema.load({'citizens': [make_citizen(citizen_id=x) for x in range(1, 201)]})
+    digest = citizens_digest(citizens)
+
+    # storages with their own engines share no process-local lock, like storages of different workers
+    workers = [SQLStorage(engine=create_engine(app.config['SQLALCHEMY_DATABASE_URI'])) for _ in range(4)]
+    barrier = threading.Barrier(len(workers))
+    results = []
+
+    def upload(storage: SQLStorage) -> None:
+        barrier.wait()
+        results.append(storage.create_unique_import([dict(x) for x in citizens], [], digest))
+
+    threads = [threading.Thread(target=upload, args=(storage,)) for storage in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(created for _, created in results) == [False, False, False, True]
+    assert len({import_id for import_id, _ in results}) == 1
+    for storage in workers:
+        storage.engine.dispose()
+
+
+def test_dedup_after_patch(client: FlaskClient, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMPORT_DEDUP_POLICY', 'dedup')
+    body = {'citizens': [make_citizen()]}
+    status, first = send_create_import_request(client, body)
+    assert status == 201
+
+    import_id = first['data']['import_id']
+    status, data = send_patch_citizen_request(client, import_id, 1, {'name': 'Петров Петр Петрович'})
+    assert status == 200
+
+    # patched import no longer matches the original data
+    status, second = send_create_import_request(client, body)
+    assert status == 201
+    assert second['data']['import_id'] != import_id
+
+
+def test_dedup_window(client: FlaskClient, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMPORT_DEDUP_POLICY', 'dedup_window')
+    body = {'citizens': [make_citizen()]}
+
+    monkeypatch.setitem(app.config, 'IMPORT_DEDUP_WINDOW', 600)
+    status, first = send_create_import_request(client, body)
+    status, second = send_create_import_request(client, body)
+    assert first['data']['import_id'] == second['data']['import_id']
+
+    monkeypatch.setitem(app.config, 'IMPORT_DEDUP_WINDOW', 0)
+    status, third = send_create_import_request(client, body)
+    assert status == 201
+    assert first['data']['import_id'] != third['data']['import_id']
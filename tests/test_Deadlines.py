@@ -0,0 +1,88 @@
+import logging
+from time import perf_counter
+
+import pytest
+
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, \
+    send_get_citizens_request, send_get_birthdays_request, send_get_metrics_request
+from yandex_school import db
+from yandex_school.app import app
+from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    if app.config['STORAGE_BACKEND'] != 'sql':
+        pytest.skip('statement_timeout is specific to sql storage')
+    app.config['TESTING'] = True
+    client = app.test_client()
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
+    monkeypatch.setitem(app.config, 'REQUEST_DEADLINES', dict(app.config['REQUEST_DEADLINES']))
+    reset_storage(app)
+    yield client
+
+
+def create_import(client) -> int:
+    citizens = [make_citizen(citizen_id=x) for x in range(1, 11)]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+    return data['data']['import_id']
+
+
+def test_within_deadline(client):
+    import_id = create_import(client)
+    status, data = send_get_citizens_request(client, import_id)
+    assert status == 200
+    assert len(data['data']) == 10
+
+
+def test_spent_budget(client):
+    import_id = create_import(client)
+    app.config['REQUEST_DEADLINES']['getbirthdays'] = 1e-9
+
+    status, data = send_get_birthdays_request(client, import_id)
+    assert status == 504
+    assert 'getbirthdays' in data['message']
+
+    status, data = send_get_metrics_request(client)
+    assert data['data']['counters']['deadline_exceeded.getbirthdays'] >= 1
+
+
+def test_statement_cancelled(client):
+    import_id = create_import(client)
+    app.config['REQUEST_DEADLINES']['getcitizens'] = 0.2
+
+    with app.app_context():
+        # another transaction holds the table, the request would wait for it forever
+        with db.engine.connect() as connection, connection.begin():
+            connection.execute('LOCK TABLE citizen IN ACCESS EXCLUSIVE MODE')
+            started = perf_counter()
+            status, data = send_get_citizens_request(client, import_id)
+            assert perf_counter() - started < 5
+        assert status == 504
+
+    # the connection is usable afterwards
+    status, data = send_get_citizens_request(client, import_id)
+    assert status == 200
+
+
+def test_import_cancelled(client):
+    app.config['REQUEST_DEADLINES']['createimport'] = 0.2
+    citizens = [make_citizen(citizen_id=x) for x in range(1, 11)]
+
+    with app.app_context():
+        with db.engine.connect() as connection, connection.begin():
+            connection.execute('LOCK TABLE citizen IN ACCESS EXCLUSIVE MODE')
+            started = perf_counter()
+            status, data = send_create_import_request(client, {'citizens': citizens})
+            assert perf_counter() - started < 5
+        assert status == 504
+        assert 'createimport' in data['message']
+
+    # the import is rolled back as a whole
+    status, data = send_get_citizens_request(client, 1)
+    assert status == 404
+    status, data = send_get_metrics_request(client)
+    assert data['data']['counters']['deadline_exceeded.createimport'] >= 1
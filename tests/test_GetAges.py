@@ -2,11 +2,12 @@ import logging
 
 import pytest
 
-from tests.testing_utils import make_citizen, send_create_import_request, \
-    send_get_ages_request, send_get_citizens_request
-from yandex_school import db
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, \
+    send_get_ages_request, send_get_citizens_request, send_get_request_accepting, send_get_town_stats_request, \
+    send_patch_citizen_request, send_get_metrics_request
 from yandex_school.app import app
 from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+from yandex_school.storage import get_storage
 
 logger = logging.getLogger(__name__)
 
@@ -16,8 +17,7 @@ def client():
     app.config['TESTING'] = True
     client = app.test_client()
     app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
-    db.drop_all()
-    db.create_all()
+    reset_storage(app)
     yield client
 
 
@@ -57,3 +57,130 @@ def test_basic_test_2(client):
 
     status, data = send_get_ages_request(client, import_id=import_id)
     assert status == 200
+
+
+def test_binary_formats(client):
+    msgpack = pytest.importorskip('msgpack')
+    pyarrow = pytest.importorskip('pyarrow')
+    citizens = [make_citizen(citizen_id=x, town=str(x % 3)) for x in range(1, 11)]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    import_id = data['data']['import_id']
+
+    status, data = send_get_ages_request(client, import_id)
+    expected = [[x['town'], x['p50'], x['p75'], x['p99']] for x in data['data']]
+
+    query = f'/imports/{import_id}/towns/stat/percentile/age'
+    status, mimetype, body = send_get_request_accepting(client, query, 'application/x-msgpack')
+    assert status == 200
+    assert msgpack.unpackb(body)['rows'] == expected
+
+    status, mimetype, body = send_get_request_accepting(client, query, 'application/vnd.apache.arrow.stream')
+    assert status == 200
+    table = pyarrow.ipc.open_stream(body).read_all()
+    assert [list(x.values()) for x in table.to_pylist()] == expected
+
+
+def test_town_stats(client):
+    citizens = [make_citizen(citizen_id=1, town='A', street='s1', building='1', birth_date='01.01.1950'),
+                make_citizen(citizen_id=2, town='A', street='s1', building='2', birth_date='01.01.1960',
+                             gender='female'),
+                make_citizen(citizen_id=3, town='A', street='s2', building='1', birth_date='01.01.1970'),
+                make_citizen(citizen_id=4, town='B', street='s1', building='1', birth_date='01.01.1980')]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    import_id = data['data']['import_id']
+
+    status, data = send_get_town_stats_request(client, import_id, 'count,male,female,streets,buildings')
+    assert status == 200
+    assert data['data'] == [
+        {'town': 'A', 'count': 3, 'male': 2, 'female': 1, 'streets': 2, 'buildings': 3},
+        {'town': 'B', 'count': 1, 'male': 1, 'female': 0, 'streets': 1, 'buildings': 1},
+    ]
+
+    status, data = send_get_town_stats_request(client, import_id)
+    assert status == 200
+    town = data['data'][0]
+    assert town['age_max'] - town['age_min'] == 20
+    assert town['age_mean'] == town['p50'] == town['age_min'] + 10
+
+    status, ages = send_get_ages_request(client, import_id)
+    assert ages['data'] == [{k: x[k] for k in ('town', 'p50', 'p75', 'p99')} for x in data['data']]
+
+    status, data = send_get_town_stats_request(client, import_id, 'count,unknown')
+    assert status == 400
+
+    status, data = send_get_town_stats_request(client, import_id + 1, 'count')
+    assert status == 404
+
+
+def test_town_stats_after_patch(client):
+    citizens = [make_citizen(citizen_id=x, town='A') for x in range(1, 4)]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    import_id = data['data']['import_id']
+
+    status, data = send_get_town_stats_request(client, import_id, 'count')
+    assert data['data'] == [{'town': 'A', 'count': 3}]
+
+    status, data = send_patch_citizen_request(client, import_id, 3, {'town': 'B'})
+    assert status == 200
+
+    # cached result of the previous version must not be served
+    status, data = send_get_town_stats_request(client, import_id, 'count')
+    assert data['data'] == [{'town': 'A', 'count': 2}, {'town': 'B', 'count': 1}]
+
+
+def test_histogram_percentiles():
+    numpy = pytest.importorskip('numpy')
+    from yandex_school.stats import histogram_percentiles
+
+    generator = numpy.random.default_rng(42)
+    for size in (1, 2, 3, 7, 100, 1001):
+        values = generator.integers(0, 100, size)
+        distinct, counts = numpy.unique(values, return_counts=True)
+        for percent in (0, 1, 50, 75, 99, 100):
+            assert histogram_percentiles(distinct, counts, percent) == numpy.percentile(values, percent)
+
+
+def test_ages_after_patch(client):
+    citizens = [make_citizen(citizen_id=x, town='ABC'[x % 3], birth_date=f'{x % 28 + 1:02}.{x % 12 + 1:02}.{1950 + x}',
+                             relatives=[]) for x in range(1, 31)]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    import_id = data['data']['import_id']
+
+    def assert_consistent():
+        status, ages = send_get_ages_request(client, import_id)
+        assert status == 200
+        # town stats scan citizens, ages come from the birth histogram
+        status, scanned = send_get_town_stats_request(client, import_id, 'p50,p75,p99,count')
+        assert ages['data'] == [{k: x[k] for k in ('town', 'p50', 'p75', 'p99')} for x in scanned['data']]
+        return ages['data']
+
+    def counter(name: str) -> int:
+        status, data = send_get_metrics_request(client)
+        return data['data']['counters'].get(name, 0)
+
+    before = assert_consistent()
+    misses, invalidations = counter('histograms_cache_misses'), counter('histograms_invalidations')
+    patches = [
+        (1, {'town': 'D'}),
+        (2, {'birth_date': '01.01.2015'}),
+        (3, {'town': 'A', 'birth_date': '29.02.2000'}),
+        (4, {'town': 'B', 'relatives': [5]}),
+        (5, {'name': 'Петров'}),
+        (6, {'town': 'A'}),
+        (1, {'town': 'B'}),
+    ]
+    for citizen_id, body in patches:
+        status, data = send_patch_citizen_request(client, import_id, citizen_id, body)
+        assert status == 200
+        assert_consistent()
+    assert assert_consistent() != before
+    # every patch moved the cached histogram in place
+    assert counter('histograms_cache_misses') == misses
+    assert counter('histograms_invalidations') == invalidations
+
+    with app.app_context():
+        storage = get_storage()
+        maintained = storage.birth_histogram(import_id)
+        storage.rebuild_birth_histogram(import_id)
+        assert storage.birth_histogram(import_id) == maintained
+        assert sum(x[2] for x in maintained) == 30
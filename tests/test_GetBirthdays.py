@@ -1,10 +1,12 @@
 import logging
+import random
+from datetime import date
 
 import pytest
 
-from tests.testing_utils import make_citizen, send_create_import_request, \
-    send_get_birthdays_request, send_get_citizens_request
-from yandex_school import db
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, \
+    send_get_birthdays_request, send_get_citizens_request, send_get_request_accepting
+from yandex_school import aggregation
 from yandex_school.app import app
 from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
 
@@ -16,8 +18,7 @@ def client():
     app.config['TESTING'] = True
     client = app.test_client()
     app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
-    db.drop_all()
-    db.create_all()
+    reset_storage(app)
     yield client
 
 
@@ -45,3 +46,64 @@ def test_basic_test(client):
 
     status, data = send_get_birthdays_request(client, import_id=import_id)
     assert status == 200
+
+
+def test_binary_formats(client):
+    msgpack = pytest.importorskip('msgpack')
+    pyarrow = pytest.importorskip('pyarrow')
+    citizens = [make_citizen(citizen_id=1, relatives=[2, 3]),
+                make_citizen(citizen_id=2, relatives=[1], birth_date='01.02.2000'),
+                make_citizen(citizen_id=3, relatives=[1], birth_date='01.02.2001')]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    import_id = data['data']['import_id']
+
+    status, data = send_get_birthdays_request(client, import_id)
+    expected = sorted([int(month), x['citizen_id'], x['presents']] for month, entries in data['data'].items()
+                      for x in entries)
+    assert expected == [[2, 1, 2], [12, 2, 1], [12, 3, 1]]
+
+    query = f'/imports/{import_id}/citizens/birthdays'
+    status, mimetype, body = send_get_request_accepting(client, query, 'application/x-msgpack')
+    assert status == 200
+    assert msgpack.unpackb(body)['rows'] == expected
+
+    status, mimetype, body = send_get_request_accepting(client, query, 'application/vnd.apache.arrow.stream')
+    assert status == 200
+    table = pyarrow.ipc.open_stream(body).read_all()
+    assert [list(x.values()) for x in table.to_pylist()] == expected
+
+
+def test_engines_identical(client, monkeypatch):
+    random.seed(40)
+    count = 200
+    family = {x: set() for x in range(1, count + 1)}
+    for _ in range(count * 3):
+        a, b = random.randint(1, count), random.randint(1, count)
+        family[a].add(b)
+        family[b].add(a)
+    citizens = [make_citizen(citizen_id=x, relatives=sorted(family[x]),
+                             birth_date=f'{random.randint(1, 28):02}.{random.randint(1, 12):02}.1990')
+                for x in random.sample(range(1, count + 1), count)]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+    import_id = data['data']['import_id']
+
+    responses = {}
+    for engine in ('python', 'numpy'):
+        monkeypatch.setitem(app.config, 'BIRTHDAYS_ENGINE', engine)
+        status, responses[engine] = send_get_birthdays_request(client, import_id)
+        assert status == 200
+    assert responses['python'] == responses['numpy']
+
+
+def test_birthday_cells_sparse_ids():
+    # database ids far apart are looked up by binary search instead of a direct table
+    rows = [(1, 1, date(2000, 3, 1), 7000),
+            (1, 1, date(2000, 3, 1), 90000),
+            (7000, 2, date(2000, 5, 1), 1),
+            (7000, 2, date(2000, 5, 1), 7000),
+            (90000, 3, date(2000, 5, 1), 1),
+            (500, 4, date(2000, 1, 1), None)]
+    expected = list(aggregation.presents_cells(aggregation.birthday_presents(rows)))
+    assert sorted(aggregation.birthday_cells(rows)) == sorted(expected) == [(1, 5, 2), (2, 3, 1), (2, 5, 1),
+                                                                             (3, 3, 1)]
@@ -2,8 +2,8 @@ import logging
 
 import pytest
 
-from tests.testing_utils import make_citizen, send_create_import_request, send_get_citizens_request
-from yandex_school import db
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, send_get_citizens_request, \
+    send_get_request_accepting
 from yandex_school.app import app
 from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
 
@@ -15,8 +15,7 @@ def client():
     app.config['TESTING'] = True
     client = app.test_client()
     app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
-    db.drop_all()
-    db.create_all()
+    reset_storage(app)
     yield client
 
 
@@ -55,3 +54,63 @@ def test_multiple_citizens(client):
 
     status, data = send_get_citizens_request(client, import_id)
     assert status == 200
+
+
+def make_family_import(client):
+    citizens = [make_citizen(citizen_id=1, relatives=[2, 3]),
+                make_citizen(citizen_id=2, relatives=[1], birth_date='01.02.2000', gender='female'),
+                make_citizen(citizen_id=3, relatives=[1]),
+                make_citizen(citizen_id=4, town='Керч')]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+    return data['data']['import_id']
+
+
+def test_msgpack_citizens(client):
+    msgpack = pytest.importorskip('msgpack')
+    import_id = make_family_import(client)
+
+    status, mimetype, body = send_get_request_accepting(client, f'/imports/{import_id}/citizens',
+                                                        'application/x-msgpack')
+    assert status == 200
+    assert mimetype == 'application/x-msgpack'
+
+    data = msgpack.unpackb(body, timestamp=3)
+    status, expected = send_get_citizens_request(client, import_id)
+    assert len(data['rows']) == len(expected['data'])
+    for row, citizen in zip(data['rows'], expected['data']):
+        row = dict(zip(data['columns'], row))
+        assert row['birth_date'].strftime('%d.%m.%Y') == citizen['birth_date']
+        assert sorted(row['relatives']) == sorted(citizen['relatives'])
+        for key in ('citizen_id', 'town', 'street', 'building', 'apartment', 'name', 'gender'):
+            assert row[key] == citizen[key]
+
+
+def test_arrow_citizens(client):
+    pyarrow = pytest.importorskip('pyarrow')
+    import_id = make_family_import(client)
+
+    status, mimetype, body = send_get_request_accepting(client, f'/imports/{import_id}/citizens',
+                                                        'application/vnd.apache.arrow.stream')
+    assert status == 200
+    assert mimetype == 'application/vnd.apache.arrow.stream'
+
+    table = pyarrow.ipc.open_stream(body).read_all()
+    assert table.schema.field('birth_date').type == pyarrow.date32()
+    assert table.schema.field('relatives').type == pyarrow.list_(pyarrow.int32())
+
+    status, expected = send_get_citizens_request(client, import_id)
+    rows = table.to_pylist()
+    assert len(rows) == len(expected['data'])
+    for row, citizen in zip(rows, expected['data']):
+        assert row['birth_date'].strftime('%d.%m.%Y') == citizen['birth_date']
+        assert sorted(row['relatives']) == sorted(citizen['relatives'])
+        assert row['gender'] == citizen['gender']
+
+
+def test_json_is_default(client):
+    import_id = make_family_import(client)
+    for accept in ('*/*', 'text/html', 'application/json'):
+        status, mimetype, body = send_get_request_accepting(client, f'/imports/{import_id}/citizens', accept)
+        assert status == 200
+        assert mimetype == 'application/json'
@@ -0,0 +1,120 @@
+import logging
+import random
+
+import pytest
+
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, \
+    send_get_families_request, send_patch_citizen_request, send_get_citizens_request
+from yandex_school.app import app
+from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    client = app.test_client()
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
+    reset_storage(app)
+    yield client
+
+
+def expected_families(citizens: list) -> list:
+    """
+    Families calculated straight from GetCitizens response by graph traversal
+    """
+    relatives = {citizen['citizen_id']: citizen['relatives'] for citizen in citizens}
+    seen, result = set(), []
+    for citizen_id in sorted(relatives):
+        if citizen_id in seen:
+            continue
+        family, stack = [], [citizen_id]
+        seen.add(citizen_id)
+        while stack:
+            current = stack.pop()
+            family.append(current)
+            for relative in relatives[current]:
+                if relative not in seen:
+                    seen.add(relative)
+                    stack.append(relative)
+        result.append({'size': len(family), 'citizens': sorted(family)})
+    result.sort(key=lambda x: (-x['size'], x['citizens'][0]))
+    return result
+
+
+def test_bad_import_id(client):
+    status, data = send_get_families_request(client, 1)
+    assert status == 404
+
+    status, data = send_get_families_request(client, 1, min_size='x')
+    assert status == 400
+
+
+def test_families(client):
+    citizens = [make_citizen(citizen_id=1, relatives=[2]),
+                make_citizen(citizen_id=2, relatives=[1, 3]),
+                make_citizen(citizen_id=3, relatives=[2]),
+                make_citizen(citizen_id=4, relatives=[5]),
+                make_citizen(citizen_id=5, relatives=[4]),
+                make_citizen(citizen_id=6, relatives=[6])]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+    import_id = data['data']['import_id']
+
+    status, data = send_get_families_request(client, import_id)
+    assert status == 200
+    assert data['data'] == [{'size': 3, 'citizens': [1, 2, 3]},
+                            {'size': 2, 'citizens': [4, 5]},
+                            {'size': 1, 'citizens': [6]}]
+
+    status, data = send_get_families_request(client, import_id, min_size=2)
+    assert status == 200
+    assert [x['size'] for x in data['data']] == [3, 2]
+
+
+def test_families_after_patch(client):
+    citizens = [make_citizen(citizen_id=x) for x in range(1, 7)]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+    import_id = data['data']['import_id']
+
+    status, data = send_get_families_request(client, import_id)
+    assert [x['size'] for x in data['data']] == [1] * 6
+
+    # links are merged into the cached index
+    send_patch_citizen_request(client, import_id, 1, {'relatives': [2, 3]})
+    send_patch_citizen_request(client, import_id, 4, {'relatives': [3, 5]})
+    status, data = send_get_families_request(client, import_id)
+    assert data['data'][0] == {'size': 5, 'citizens': [1, 2, 3, 4, 5]}
+
+    # removal splits the family
+    send_patch_citizen_request(client, import_id, 3, {'relatives': [1]})
+    status, data = send_get_families_request(client, import_id)
+    assert data['data'][:2] == [{'size': 3, 'citizens': [1, 2, 3]}, {'size': 2, 'citizens': [4, 5]}]
+
+    # patches not touching relatives keep the index valid
+    send_patch_citizen_request(client, import_id, 6, {'name': 'Петров Пётр'})
+    status, data = send_get_families_request(client, import_id)
+    assert data['data'][-1] == {'size': 1, 'citizens': [6]}
+
+
+def test_families_random_patches(client):
+    random.seed(34)
+    count = 40
+    citizens = [make_citizen(citizen_id=x) for x in range(1, count + 1)]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+    import_id = data['data']['import_id']
+    send_get_families_request(client, import_id)
+
+    for _ in range(30):
+        citizen_id = random.randint(1, count)
+        relatives = random.sample(range(1, count + 1), random.randint(0, 3))
+        status, _ = send_patch_citizen_request(client, import_id, citizen_id, {'relatives': relatives})
+        assert status == 200
+
+        status, data = send_get_families_request(client, import_id)
+        assert status == 200
+        _, current = send_get_citizens_request(client, import_id)
+        assert data['data'] == expected_families(current['data'])
@@ -0,0 +1,81 @@
+import logging
+
+import pytest
+
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, send_get_diff_request
+from yandex_school.app import app
+from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    client = app.test_client()
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
+    reset_storage(app)
+    yield client
+
+
+def create_import(client, citizens: list) -> int:
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+    return data['data']['import_id']
+
+
+def test_bad_import_id(client):
+    import_id = create_import(client, [make_citizen(citizen_id=1)])
+
+    status, data = send_get_diff_request(client, import_id, import_id + 1)
+    assert status == 404
+
+    status, data = send_get_diff_request(client, import_id + 1, import_id)
+    assert status == 404
+
+
+def test_same_imports(client):
+    citizens = [make_citizen(citizen_id=1, relatives=[2]), make_citizen(citizen_id=2, relatives=[1])]
+    first = create_import(client, citizens)
+    second = create_import(client, citizens)
+
+    status, data = send_get_diff_request(client, first, second)
+    assert status == 200
+    assert data['data'] == {'added': [], 'removed': [], 'changed': [], 'relatives': {'added': [], 'removed': []}}
+
+
+def test_diff(client):
+    first = create_import(client, [
+        make_citizen(citizen_id=1, relatives=[2]),
+        make_citizen(citizen_id=2, relatives=[1, 3]),
+        make_citizen(citizen_id=3, relatives=[2]),
+        make_citizen(citizen_id=5, name='Петров Пётр'),
+    ])
+    second = create_import(client, [
+        make_citizen(citizen_id=1, relatives=[4]),
+        make_citizen(citizen_id=2, relatives=[]),
+        make_citizen(citizen_id=4, relatives=[1], birth_date='01.02.2000'),
+        make_citizen(citizen_id=5, name='Петров Павел', apartment=8),
+    ])
+
+    status, data = send_get_diff_request(client, first, second)
+    assert status == 200
+    data = data['data']
+
+    assert data['added'] == [make_citizen(citizen_id=4, relatives=[1], birth_date='01.02.2000')]
+    assert data['removed'] == [3]
+    assert data['changed'] == [
+        {'citizen_id': 1, 'changes': {'relatives': {'old': [2], 'new': [4]}}},
+        {'citizen_id': 2, 'changes': {'relatives': {'old': [1, 3], 'new': []}}},
+        {'citizen_id': 5, 'changes': {'apartment': {'old': 7, 'new': 8},
+                                      'name': {'old': 'Петров Пётр', 'new': 'Петров Павел'}}},
+    ]
+    assert data['relatives'] == {'added': [[1, 4]], 'removed': [[1, 2], [2, 3]]}
+
+    # reverse direction swaps everything
+    status, data = send_get_diff_request(client, second, first)
+    assert status == 200
+    data = data['data']
+    assert [x['citizen_id'] for x in data['added']] == [3]
+    assert data['removed'] == [4]
+    assert data['relatives'] == {'added': [[1, 2], [2, 3]], 'removed': [[1, 4]]}
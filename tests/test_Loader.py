@@ -0,0 +1,99 @@
+import csv
+import json
+import logging
+
+import pytest
+
+from tests.testing_utils import reset_storage, make_citizen, send_get_citizens_request, send_create_import_request
+from yandex_school.app import app
+from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+from yandex_school.loader import load_files, LoaderError
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def client():
+    if app.config['STORAGE_BACKEND'] != 'sql':
+        pytest.skip('loader writes to postgres only')
+    app.config['TESTING'] = True
+    client = app.test_client()
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
+    reset_storage(app)
+    yield client
+
+
+def make_family(offset: int = 0):
+    return [make_citizen(citizen_id=1, relatives=[2, 3], name=f'Tab\tи \\слэш {offset}'),
+            make_citizen(citizen_id=2, relatives=[1], birth_date='01.02.2000'),
+            make_citizen(citizen_id=3, relatives=[1]),
+            make_citizen(citizen_id=4 + offset)]
+
+
+def write_ndjson(path, citizens):
+    with open(path, 'w', encoding='utf-8') as file:
+        for citizen in citizens:
+            file.write(json.dumps(citizen, ensure_ascii=False) + '\n')
+
+
+def write_csv(path, citizens):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=list(citizens[0]))
+        writer.writeheader()
+        for citizen in citizens:
+            writer.writerow(dict(citizen, relatives=' '.join(map(str, citizen['relatives']))))
+
+
+def test_load_files(client, tmp_path):
+    write_ndjson(tmp_path / 'a.ndjson', make_family(0))
+    write_csv(tmp_path / 'b.csv', make_family(1))
+    state_path = str(tmp_path / 'state.json')
+
+    paths = [str(tmp_path / 'a.ndjson'), str(tmp_path / 'b.csv')]
+    state, failed = load_files(paths, jobs=2, state_path=state_path)
+    assert not failed
+    assert len(state) == 2
+
+    for offset, path in enumerate(paths):
+        status, data = send_get_citizens_request(client, state[path])
+        assert status == 200
+        expected = sorted(make_family(offset), key=lambda x: x['citizen_id'])
+        assert [dict(x, relatives=sorted(x['relatives'])) for x in data['data']] == expected
+
+    # everything is recorded, nothing is loaded again
+    resumed, failed = load_files(paths, jobs=2, state_path=state_path)
+    assert resumed == state
+    assert not failed
+
+
+def test_load_invalid_files(client, tmp_path):
+    write_ndjson(tmp_path / 'not_mutual.ndjson', [make_citizen(citizen_id=1, relatives=[2]),
+                                                  make_citizen(citizen_id=2)])
+    write_ndjson(tmp_path / 'duplicates.ndjson', [make_citizen(), make_citizen()])
+    write_ndjson(tmp_path / 'bad_date.ndjson', [make_citizen(birth_date='1.1.2000')])
+    write_ndjson(tmp_path / 'good.ndjson', [make_citizen()])
+
+    paths = [str(tmp_path / x) for x in ('not_mutual.ndjson', 'duplicates.ndjson', 'bad_date.ndjson', 'good.ndjson')]
+    state, failed = load_files(paths, jobs=2)
+    assert set(failed) == set(paths[:3])
+    assert list(state) == paths[3:]
+    assert 'bad_date.ndjson:1' in failed[paths[2]]
+
+
+def test_dedup_hash(client, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMPORT_DEDUP_POLICY', 'dedup')
+    write_csv(tmp_path / 'a.csv', make_family(0))
+    state, failed = load_files([str(tmp_path / 'a.csv')])
+    assert not failed
+
+    # upload of the same data resolves to the loaded import
+    status, data = send_create_import_request(client, {'citizens': make_family(0)[::-1]})
+    assert status == 201
+    assert data['data']['import_id'] == state[str(tmp_path / 'a.csv')]
+
+
+def test_sharded_storage_refused(client, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'STORAGE_BACKEND', 'sharded')
+    write_ndjson(tmp_path / 'a.ndjson', make_family(0))
+    with pytest.raises(LoaderError):
+        load_files([str(tmp_path / 'a.ndjson')])
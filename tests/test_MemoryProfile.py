@@ -0,0 +1,87 @@
+import logging
+
+import pytest
+
+from tests.testing_utils import reset_storage, make_citizen, send_get_metrics_request, \
+    send_get_citizens_request, send_get_birthdays_request
+from yandex_school import memprof
+from yandex_school.app import app
+from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+
+logger = logging.getLogger(__name__)
+
+CITIZENS = 10000
+# ceilings of traced bytes per citizen, about twice as much as measured
+REQUEST_BYTES_PER_CITIZEN = 6500
+PHASE_BYTES_PER_CITIZEN = {
+    'parse': 2500,
+    'load': 2000,
+    'validate': 250,
+    'store': 2600,
+}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    app.config['TESTING'] = True
+    client = app.test_client()
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
+    monkeypatch.setitem(app.config, 'MEMORY_PROFILING', True)
+    reset_storage(app)
+    memprof.profiles.clear()
+    yield client
+
+
+def profiled(client, method: str, query: str, **kwargs):
+    response = getattr(client, method)(query, headers={app.config['MEMORY_PROFILING_HEADER']: '1'}, **kwargs)
+    return response.status_code, response.get_json()
+
+
+def generate_citizens(count: int) -> list:
+    """
+    Citizens living in couples, every citizen has got exactly one relative
+    """
+    return [make_citizen(citizen_id=x, relatives=[x + 1 if x % 2 else x - 1], name=f'Житель {x}',
+                         birth_date=f'{x % 28 + 1:02}.{x % 12 + 1:02}.{1950 + x % 50}')
+            for x in range(1, count + 1)]
+
+
+def test_not_profiled(client):
+    response = client.post('/imports', json={'citizens': generate_citizens(2)})
+    assert response.status_code == 201
+    status, data = send_get_metrics_request(client)
+    assert 'createimport' not in data['data']['gauges']['memory']
+
+
+def test_import_memory_ceiling(client):
+    status, data = profiled(client, 'post', '/imports', json={'citizens': generate_citizens(CITIZENS)})
+    assert status == 201
+    import_id = data['data']['import_id']
+
+    status, data = send_get_metrics_request(client)
+    profile = data['data']['gauges']['memory']['createimport']
+    logger.info(f'bytes per citizen: {profile["peak"] / CITIZENS}, '
+                f'{ {k: v / CITIZENS for k, v in profile["phases"].items()} }')
+
+    assert profile['peak'] / CITIZENS < REQUEST_BYTES_PER_CITIZEN
+    for name, ceiling in PHASE_BYTES_PER_CITIZEN.items():
+        assert profile['phases'][name] / CITIZENS < ceiling
+
+    # read endpoints are profiled by phases as well
+    status, _ = profiled(client, 'get', f'/imports/{import_id}/citizens')
+    assert status == 200
+    status, _ = profiled(client, 'get', f'/imports/{import_id}/citizens/birthdays')
+    assert status == 200
+    status, data = send_get_metrics_request(client)
+    memory = data['data']['gauges']['memory']
+    assert set(memory['getcitizens']['phases']) == {'fetch', 'build'}
+    assert set(memory['getbirthdays']['phases']) == {'fetch', 'aggregate', 'build'}
+
+
+def test_top_allocations_logged(client, monkeypatch, caplog):
+    monkeypatch.setitem(app.config, 'MEMORY_PROFILING_TOP', 3)
+    with caplog.at_level(logging.INFO, logger='yandex_school.memprof'):
+        status, data = profiled(client, 'post', '/imports', json={'citizens': generate_citizens(100)})
+    assert status == 201
+    assert 'createimport.load: peak' in caplog.text
+    assert 'top allocations' in caplog.text
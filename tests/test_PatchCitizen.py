@@ -1,12 +1,15 @@
 import logging
+import threading
 
 import pytest
+from sqlalchemy import create_engine
 
-from tests.testing_utils import make_citizen, send_create_import_request, \
-    send_patch_citizen_request, send_get_citizens_request
-from yandex_school import db
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, \
+    send_patch_citizen_request, send_get_citizens_request, send_get_metrics_request
 from yandex_school.app import app
 from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+from yandex_school.storage import get_storage
+from yandex_school.storage.sql import SQLStorage
 
 logger = logging.getLogger(__name__)
 
@@ -16,8 +19,7 @@ def client():
     app.config['TESTING'] = True
     client = app.test_client()
     app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
-    db.drop_all()
-    db.create_all()
+    reset_storage(app)
     yield client
 
 
@@ -105,3 +107,78 @@ def test_patch_relationships(client):
     del body['citizen_id']
     status, data = send_patch_citizen_request(client, import_id, citizen_id, body)
     assert status == 200
+
+
+def test_prepared_statements(client, monkeypatch):
+    if app.config['STORAGE_BACKEND'] != 'sql':
+        pytest.skip('prepared statements are specific to sql storage')
+    monkeypatch.setitem(app.extensions['storage'], 'sql', SQLStorage(prepared=True))
+
+    citizens = [make_citizen(citizen_id=x) for x in range(1, 4)]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+
+    import_id = data['data']['import_id']
+
+    # second round runs already prepared statements
+    for _ in range(2):
+        status, data = send_patch_citizen_request(client, import_id, 1, {'relatives': [2, 3]})
+        assert status == 200
+        assert sorted(data['relatives']) == [2, 3]
+
+        status, data = send_patch_citizen_request(client, import_id, 2, {'town': 'Керч', 'relatives': [1]})
+        assert status == 200
+        assert data['town'] == 'Керч'
+
+        status, data = send_patch_citizen_request(client, import_id, 3, {'name': 'Петров Петр Петрович'})
+        assert status == 200
+        assert data['name'] == 'Петров Петр Петрович'
+        assert data['relatives'] == [1]
+
+        status, data = send_get_citizens_request(client, import_id)
+        assert status == 200
+        assert [x['relatives'] for x in data['data']] == [[2, 3], [1], [1]]
+
+        status, data = send_patch_citizen_request(client, import_id, 1, {'relatives': []})
+        assert status == 200
+
+    status, data = send_get_metrics_request(client)
+    timings = data['data']['timings']
+    assert timings['query.citizens_with_relatives']['count'] >= 2
+    # every statement of a patch goes through the registry
+    for name in ('lock_import', 'citizen', 'relative_id_map', 'citizen_id_map', 'add_relatives', 'remove_relatives',
+                 'remove_relatives_opposite', 'update_citizen_by_id__town', 'bump_version'):
+        assert timings[f'query.{name}']['count'] >= 2, name
+
+
+def test_concurrent_workers(client):
+    if app.config['STORAGE_BACKEND'] != 'sql':
+        pytest.skip('workers share nothing but the database with sql storage')
+    citizens = [make_citizen(citizen_id=x, town='A', relatives=[]) for x in range(1, 5)]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    import_id = data['data']['import_id']
+
+    # storages with their own engines share no process-local lock, like storages of different workers
+    workers = [SQLStorage(engine=create_engine(app.config['SQLALCHEMY_DATABASE_URI'])) for _ in range(4)]
+
+    def patch(storage: SQLStorage, worker: int) -> None:
+        for step in range(10):
+            storage.patch_citizen(import_id, step % 4 + 1, {'town': 'AB'[(step + worker) % 2],
+                                                             'relatives': [(step + worker) % 4 + 1]})
+
+    threads = [threading.Thread(target=patch, args=(storage, worker)) for worker, storage in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        storage = get_storage()
+        assert storage.import_version(import_id) == 40
+        maintained = storage.birth_histogram(import_id)
+        storage.rebuild_birth_histogram(import_id)
+        assert storage.birth_histogram(import_id) == maintained
+        pairs = {tuple(x) for x in storage.relative_pairs(import_id)}
+        assert pairs == {(relative, citizen) for citizen, relative in pairs}
+    for storage in workers:
+        storage.engine.dispose()
@@ -0,0 +1,105 @@
+import logging
+import os
+
+import pytest
+from sqlalchemy import create_engine, exc
+
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, \
+    send_get_citizens_request, send_get_metrics_request
+from yandex_school import metrics
+from yandex_school.app import app
+from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+from yandex_school.pool import pool_size, engine_options, InstrumentedQueuePool
+from yandex_school.storage import _create
+
+logger = logging.getLogger(__name__)
+
+TEST_URI = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
+
+
+@pytest.fixture
+def client():
+    if app.config['STORAGE_BACKEND'] == 'memory':
+        pytest.skip('pools belong to sql storage')
+    app.config['TESTING'] = True
+    client = app.test_client()
+    app.config['SQLALCHEMY_DATABASE_URI'] = TEST_URI
+    reset_storage(app)
+    yield client
+
+
+@pytest.fixture
+def engine(client):
+    settings = {'DB_CONNECTION_BUDGET': 2, 'DB_WORKERS': 1, 'DB_POOL_OVERFLOW_SHARE': 0.5, 'DB_POOL_TIMEOUT': 0.1,
+                'DB_POOL_RECYCLE': 1800}
+    engine = create_engine(TEST_URI, **engine_options(settings))
+    yield engine
+    engine.dispose()
+
+
+def test_pool_size():
+    assert pool_size(40, 9, 0.5) == {'pool_size': 2, 'max_overflow': 2}
+    assert pool_size(40, 4, 0.25) == {'pool_size': 8, 'max_overflow': 2}
+    assert pool_size(5, 9, 0.5) == {'pool_size': 1, 'max_overflow': 0}
+    for budget in range(1, 50):
+        for workers in range(1, 20):
+            size = pool_size(budget, workers, 0.5)
+            assert size['pool_size'] >= 1
+            assert (size['pool_size'] + size['max_overflow']) * workers <= max(budget, workers)
+
+
+def test_default_engine(client):
+    with app.app_context():
+        from yandex_school import db
+        assert isinstance(db.engine.pool, InstrumentedQueuePool)
+        assert db.engine.pool._pre_ping
+
+    status, data = send_create_import_request(client, {'citizens': [make_citizen(citizen_id=1)]})
+    status, data = send_get_citizens_request(client, data['data']['import_id'])
+    assert status == 200
+
+    status, data = send_get_metrics_request(client)
+    assert data['data']['timings']['db_pool_checkout_wait']['count'] >= 1
+    pool = data['data']['gauges']['db_pool']['default']
+    assert pool['size'] == pool_size(app.config['DB_CONNECTION_BUDGET'], app.config['DB_WORKERS'],
+                                     app.config['DB_POOL_OVERFLOW_SHARE'])['pool_size']
+    assert pool['checked_out'] == 0
+    assert pool['idle'] >= 1
+
+
+def test_overflow_and_timeout(engine):
+    overflows, timeouts = metrics.counters['db_pool_overflows'], metrics.counters['db_pool_timeouts']
+    first = engine.connect()
+    assert metrics.counters['db_pool_overflows'] == overflows
+    second = engine.connect()
+    assert metrics.counters['db_pool_overflows'] == overflows + 1
+    assert engine.pool.status() == {'size': 1, 'checked_out': 2, 'idle': 0, 'overflow': 1}
+
+    with pytest.raises(exc.TimeoutError):
+        engine.connect()
+    assert metrics.counters['db_pool_timeouts'] == timeouts + 1
+
+    second.close()
+    first.close()
+    assert engine.pool.status() == {'size': 1, 'checked_out': 0, 'idle': 1, 'overflow': 0}
+
+
+def test_recycle_on_fork(engine):
+    with engine.connect() as connection:
+        backend = connection.execute('SELECT pg_backend_pid()').scalar()
+        record = connection.connection._connection_record
+    # pretend the pooled connection was opened by the parent process
+    record.info['pid'] = os.getpid() + 1
+
+    recycles = metrics.counters['db_pool_fork_recycles']
+    with engine.connect() as connection:
+        assert connection.execute('SELECT pg_backend_pid()').scalar() != backend
+    assert metrics.counters['db_pool_fork_recycles'] == recycles + 1
+
+
+def test_pgbouncer_disables_prepared_statements(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'SQL_PREPARED_STATEMENTS', True)
+    with app.app_context():
+        assert _create('sql').queries.prepared
+        monkeypatch.setitem(app.config, 'DB_PGBOUNCER', True)
+        assert not _create('sql').queries.prepared
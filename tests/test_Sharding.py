@@ -0,0 +1,174 @@
+import logging
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, \
+    send_patch_citizen_request, send_get_citizens_request, send_get_birthdays_request, send_get_ages_request, \
+    send_get_town_stats_request, send_get_families_request, send_get_diff_request
+from yandex_school.app import app
+from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+from yandex_school.rebalance import rebalance
+from yandex_school.storage import get_storage
+from yandex_school.storage.sharded import shard_of, next_import_id
+from yandex_school.storage.sql import SQLStorage
+
+logger = logging.getLogger(__name__)
+
+SHARD_URIS = [f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test_shard{x}' for x in range(3)]
+
+
+def create_databases() -> None:
+    """
+    Creates local shard databases missing on the test server
+    :return: None
+    """
+    engine = create_engine(f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/postgres', poolclass=NullPool,
+                           isolation_level='AUTOCOMMIT')
+    try:
+        existing = {x for x, in engine.execute('SELECT datname FROM pg_database').fetchall()}
+        for uri in SHARD_URIS:
+            name = uri.rsplit('/', 1)[1]
+            if name not in existing:
+                engine.execute(f"CREATE DATABASE {name} ENCODING 'UTF8' TEMPLATE template0")
+    finally:
+        engine.dispose()
+
+
+def use_shards(monkeypatch, uris: list) -> None:
+    """
+    Switches the application to sharded storage over the given databases
+    :param monkeypatch: pytest monkeypatch fixture
+    :param uris: shard database URIs
+    :return: None
+    """
+    storages = app.extensions.setdefault('storage', {})
+    if 'sharded' in storages:
+        storages.pop('sharded').dispose()
+    monkeypatch.setitem(app.config, 'STORAGE_BACKEND', 'sharded')
+    monkeypatch.setitem(app.config, 'SHARDS', uris)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    if app.config['STORAGE_BACKEND'] == 'memory':
+        pytest.skip('shards are Postgres databases')
+    create_databases()
+    # the spare shard starts empty for rebalancing
+    for uri in SHARD_URIS[2:]:
+        engine = create_engine(uri, poolclass=NullPool)
+        SQLStorage(engine=engine).reset()
+        engine.dispose()
+    app.config['TESTING'] = True
+    client = app.test_client()
+    use_shards(monkeypatch, SHARD_URIS[:2])
+    reset_storage(app)
+    yield client
+    app.extensions['storage'].pop('sharded').dispose()
+
+
+def create_import(client, citizens: list) -> int:
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+    return data['data']['import_id']
+
+
+def family_citizens() -> list:
+    return [
+        make_citizen(citizen_id=1, relatives=[2], birth_date='01.02.1990'),
+        make_citizen(citizen_id=2, relatives=[1], birth_date='03.04.1995', town='Казань'),
+        make_citizen(citizen_id=3, relatives=[], birth_date='05.06.2000'),
+    ]
+
+
+def import_ids_of(uri: str) -> list:
+    engine = create_engine(uri, poolclass=NullPool)
+    try:
+        return [x for x, in engine.execute('SELECT id FROM import ORDER BY id').fetchall()]
+    finally:
+        engine.dispose()
+
+
+def test_shard_of():
+    assert [shard_of(x, 3) for x in range(1, 8)] == [0, 1, 2, 0, 1, 2, 0]
+    for shards in range(1, 5):
+        for shard in range(shards):
+            for after in range(10):
+                import_id = next_import_id(shard, shards, after)
+                assert import_id > after
+                assert import_id - after <= shards
+                assert shard_of(import_id, shards) == shard
+
+
+def test_import_ids_derive_shard(client):
+    import_ids = [create_import(client, family_citizens()) for _ in range(4)]
+    assert import_ids == [1, 2, 3, 4]
+    assert import_ids_of(SHARD_URIS[0]) == [1, 3]
+    assert import_ids_of(SHARD_URIS[1]) == [2, 4]
+
+
+def test_resources_routed(client):
+    first = create_import(client, family_citizens())
+    second = create_import(client, family_citizens())
+    assert shard_of(first, 2) != shard_of(second, 2)
+
+    status, data = send_patch_citizen_request(client, second, 3, {'relatives': [1], 'name': 'Сидоров'})
+    assert status == 200
+    assert data['relatives'] == [1]
+
+    status, data = send_get_citizens_request(client, first)
+    assert status == 200
+    assert [x['relatives'] for x in data['data']] == [[2], [1], []]
+    status, data = send_get_citizens_request(client, second)
+    assert status == 200
+    assert [x['relatives'] for x in data['data']] == [[2, 3], [1], [1]]
+
+    for import_id in (first, second):
+        status, data = send_get_birthdays_request(client, import_id)
+        assert status == 200
+        status, data = send_get_ages_request(client, import_id)
+        assert status == 200
+        status, data = send_get_town_stats_request(client, import_id)
+        assert status == 200
+
+    status, data = send_get_families_request(client, second)
+    assert status == 200
+    assert data['data'] == [{'size': 3, 'citizens': [1, 2, 3]}]
+
+    status, data = send_get_diff_request(client, first, second)
+    assert status == 200
+    assert [x['citizen_id'] for x in data['data']['changed']] == [1, 3]
+    assert data['data']['relatives']['added'] == [[1, 3]]
+
+    status, data = send_get_citizens_request(client, second + 1)
+    assert status == 404
+
+
+def test_rebalance(client, monkeypatch):
+    import_ids = [create_import(client, family_citizens()) for _ in range(5)]
+    status, before = send_get_citizens_request(client, 4)
+    assert status == 200
+
+    assert rebalance(SHARD_URIS, dry_run=True) == [(3, 0, 2), (4, 1, 0), (5, 0, 1)]
+    assert import_ids_of(SHARD_URIS[2]) == []
+    assert rebalance(SHARD_URIS) == [(3, 0, 2), (4, 1, 0), (5, 0, 1)]
+    assert rebalance(SHARD_URIS) == []
+
+    for index, uri in enumerate(SHARD_URIS):
+        assert import_ids_of(uri) == [x for x in import_ids if shard_of(x, 3) == index]
+
+    use_shards(monkeypatch, SHARD_URIS)
+    status, after = send_get_citizens_request(client, 4)
+    assert status == 200
+    assert after == before
+    status, data = send_get_families_request(client, 5)
+    assert status == 200
+    assert data['data'] == [{'size': 2, 'citizens': [1, 2]}, {'size': 1, 'citizens': [3]}]
+
+    # sequences continue past the moved imports, each shard still allocates its own ids
+    assert sorted(create_import(client, family_citizens()) for _ in range(3)) == [6, 7, 8]
+    with app.app_context():
+        assert get_storage().import_version(8) == 0
+    for index, uri in enumerate(SHARD_URIS):
+        assert all(shard_of(x, 3) == index for x in import_ids_of(uri))
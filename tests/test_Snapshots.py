@@ -0,0 +1,141 @@
+import logging
+import os
+
+import pytest
+
+from tests.testing_utils import reset_storage, make_citizen, send_create_import_request, \
+    send_patch_citizen_request, send_get_birthdays_request, send_get_ages_request, send_get_families_request, \
+    send_get_metrics_request, send_apply_delta_request
+from yandex_school import families, histograms, snapshots, stats
+from yandex_school.app import app
+from yandex_school.config import DB_LOGIN, DB_PASSWORD, DB_URL, DB_NAME
+from yandex_school.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    app.config['TESTING'] = True
+    client = app.test_client()
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@{DB_URL}/{DB_NAME}_test'
+    monkeypatch.setitem(app.config, 'SNAPSHOTS', True)
+    monkeypatch.setitem(app.config, 'SNAPSHOT_DIR', str(tmp_path))
+    reset_storage(app)
+    yield client
+
+
+def create_import(client) -> int:
+    citizens = [make_citizen(citizen_id=x * 3, town=f'Город {x % 4}', birth_date=f'{x % 28 + 1:02}.{x % 12 + 1:02}.1990',
+                             relatives=[y * 3 for y in (x - 1, x + 1) if 1 <= y <= 20 and x % 5 and y % 5])
+                for x in range(1, 21)]
+    status, data = send_create_import_request(client, {'citizens': citizens})
+    assert status == 201
+    return data['data']['import_id']
+
+
+def responses(client, import_id: int) -> list:
+    # derived results are cached per version, drop them so every response is computed again
+    for cache in (families.cache, histograms.cache, stats.cache):
+        cache.clear()
+    result = []
+    for send in (send_get_birthdays_request, send_get_ages_request, send_get_families_request):
+        status, data = send(client, import_id)
+        assert status == 200
+        result.append(data['data'])
+    return result
+
+
+def counter(client, name: str) -> int:
+    status, data = send_get_metrics_request(client)
+    return data['data']['counters'].get(name, 0)
+
+
+def assert_same_as_storage(client, monkeypatch, import_id: int) -> None:
+    hits = counter(client, 'snapshot_hits')
+    from_snapshot = responses(client, import_id)
+    assert counter(client, 'snapshot_hits') == hits + 3
+    with monkeypatch.context() as context:
+        context.setitem(app.config, 'SNAPSHOTS', False)
+        assert responses(client, import_id) == from_snapshot
+
+
+def test_written_on_import(client, monkeypatch, tmp_path):
+    import_id = create_import(client)
+    assert os.listdir(tmp_path) == [f'{import_id}.0.snap']
+    assert_same_as_storage(client, monkeypatch, import_id)
+
+
+def test_zero_copy(client):
+    import_id = create_import(client)
+    with app.app_context():
+        snapshot = snapshots.get(import_id)
+        assert snapshot.citizen_ids.tolist() == [x * 3 for x in range(1, 21)]
+        for column in (snapshot.citizen_ids, snapshot.town_codes, snapshot.birth_dates, snapshot.offsets,
+                       snapshot.indices):
+            assert not column.flags.writeable
+            assert not column.flags.owndata
+        assert snapshot.towns == sorted(f'Город {x}' for x in range(4))
+        assert snapshots.get(import_id) is snapshot
+        assert snapshots.get(import_id + 1) is None
+
+
+def test_rewritten_after_patch(client, monkeypatch, tmp_path):
+    import_id = create_import(client)
+    patches = [(3, {'relatives': [6, 9, 12]}), (6, {'birth_date': '29.02.2000'}), (9, {'town': 'Новый'}),
+               (12, {'relatives': []})]
+    for version, (citizen_id, body) in enumerate(patches, 1):
+        status, data = send_patch_citizen_request(client, import_id, citizen_id, body)
+        assert status == 200
+        # a patch only drops the snapshot, the next read writes the new version
+        assert os.listdir(tmp_path) == []
+        assert_same_as_storage(client, monkeypatch, import_id)
+        assert os.listdir(tmp_path) == [f'{import_id}.{version}.snap']
+
+
+def test_rebuilt_once(client, monkeypatch, tmp_path):
+    import_id = create_import(client)
+    writes = counter(client, 'snapshot_writes')
+    for citizen_id in (3, 6, 9):
+        status, data = send_patch_citizen_request(client, import_id, citizen_id, {'name': 'Петров'})
+        assert status == 200
+    assert counter(client, 'snapshot_writes') == writes
+
+    rebuilds = counter(client, 'snapshot_rebuilds')
+    assert_same_as_storage(client, monkeypatch, import_id)
+    assert counter(client, 'snapshot_rebuilds') == rebuilds + 1
+    assert counter(client, 'snapshot_writes') == writes + 1
+
+
+def test_missing_falls_back(client, monkeypatch, tmp_path):
+    import_id = create_import(client)
+    expected = responses(client, import_id)
+    os.remove(tmp_path / f'{import_id}.0.snap')
+    snapshots.cache.clear()
+
+    # the import changes while it is streamed, the snapshot is not written for a version it does not match
+    with app.app_context(), monkeypatch.context() as context:
+        context.setattr(get_storage(), 'import_version', lambda import_id: 1)
+        assert snapshots.get(import_id, 0) is None
+    assert os.listdir(tmp_path) == []
+
+    misses = counter(client, 'snapshot_misses')
+    assert responses(client, import_id) == expected
+    assert counter(client, 'snapshot_misses') == misses + 1
+    assert os.listdir(tmp_path) == [f'{import_id}.0.snap']
+
+
+def test_emptied_import_not_found(client, monkeypatch, tmp_path):
+    import_id = create_import(client)
+    status, data = send_apply_delta_request(client, import_id, {'citizens': [],
+                                                                'removed': [x * 3 for x in range(1, 21)]})
+    assert status == 200
+
+    # same answer from the snapshot of no citizens and from storage
+    status, data = send_get_birthdays_request(client, import_id)
+    assert status == 404
+    assert os.listdir(tmp_path) == [f'{import_id}.1.snap']
+    with monkeypatch.context() as context:
+        context.setitem(app.config, 'SNAPSHOTS', False)
+        status, data = send_get_birthdays_request(client, import_id)
+        assert status == 404
@@ -0,0 +1,14 @@
+import subprocess
+import sys
+
+# imported lazily by the endpoints using them, preloaded in the master by gunicorn.preload.py.ini
+LAZY_MODULES = ('numpy',)
+
+
+def test_app_import_is_lazy():
+    # a fresh interpreter, the test process has got them imported already
+    code = 'import sys\n' \
+           'from yandex_school.app import app\n' \
+           f'print(",".join(x for x in {LAZY_MODULES!r} if x in sys.modules))'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ''
@@ -1,12 +1,31 @@
 import logging
 from typing import Tuple, Any
 
+from flask import Flask
 from flask.testing import FlaskClient
 from flask.wrappers import Response
 
+from yandex_school import families, histograms, snapshots, stats
+from yandex_school.storage import get_storage
+
 logger = logging.getLogger(__name__)
 
 
+def reset_storage(app: Flask) -> None:
+    """
+    Wipes all the data of the storage backend selected by app config
+    :param app: application under test
+    :return: None
+    """
+    with app.app_context():
+        get_storage().reset()
+    # import ids start over, results cached by them are no longer valid
+    stats.cache.clear()
+    families.cache.clear()
+    histograms.cache.clear()
+    snapshots.cache.clear()
+
+
 def make_citizen(**kwargs):
     result = {
         "citizen_id": 1,
@@ -43,6 +62,20 @@ def _send_request(client: FlaskClient, method: str, query: str, body=None) -> Tu
     return response.status_code, response.json
 
 
+def send_get_request_accepting(client: FlaskClient, query: str, mimetype: str) -> Tuple[int, str, bytes]:
+    """
+    Sends get request with Accept header, for non-JSON responses
+    :param client: an instance of flask.testing.FlaskClient to make http requests
+    :param query: http query of the request
+    :param mimetype: accepted mimetype
+    :return: Tuple[response_status_code, response_mimetype, response_body]
+    """
+    logging.info(f'get {query} accepting {mimetype}')
+    response: Response = client.get(query, headers={'Accept': mimetype})
+    logging.info(response.status_code)
+    return response.status_code, response.mimetype, response.data
+
+
 def send_create_import_request(client: FlaskClient, body) -> Tuple[int, Any]:
     """
     Send post request to /imports
@@ -67,6 +100,18 @@ def send_patch_citizen_request(client: FlaskClient, import_id: int, citizen_id:
     return _send_request(client, 'patch', query, body)
 
 
+def send_apply_delta_request(client: FlaskClient, import_id: int, body) -> Tuple[int, Any]:
+    """
+    Send post request to /imports/$import_id/delta
+    :param client: an instance of flask.testing.FlaskClient to make http requests
+    :param import_id: query parameter
+    :param body: json serializable object - request body
+    :return: Tuple[response_status_code, response_json]
+    """
+    query = f'/imports/{import_id}/delta'
+    return _send_request(client, 'post', query, body)
+
+
 def send_get_citizens_request(client: FlaskClient, import_id: int) -> Tuple[int, Any]:
     """
     Send get request to /imports/$import_id/citizens/
@@ -98,3 +143,52 @@ def send_get_ages_request(client: FlaskClient, import_id: int) -> Tuple[int, Any
     """
     query = f'/imports/{import_id}/towns/stat/percentile/age'
     return _send_request(client, 'get', query)
+
+
+def send_get_town_stats_request(client: FlaskClient, import_id: int, metrics: str = None) -> Tuple[int, Any]:
+    """
+    Send get request to /imports/$import_id/towns/stat
+    :param client: an instance of flask.testing.FlaskClient to make http requests
+    :param import_id: query parameter
+    :param metrics: [OPTIONAL] comma separated metric names
+    :return: Tuple[response_status_code, response_json]
+    """
+    query = f'/imports/{import_id}/towns/stat'
+    if metrics is not None:
+        query += f'?metrics={metrics}'
+    return _send_request(client, 'get', query)
+
+
+def send_get_families_request(client: FlaskClient, import_id: int, min_size: int = None) -> Tuple[int, Any]:
+    """
+    Send get request to /imports/$import_id/citizens/families
+    :param client: an instance of flask.testing.FlaskClient to make http requests
+    :param import_id: query parameter
+    :param min_size: [OPTIONAL] smallest family size to report
+    :return: Tuple[response_status_code, response_json]
+    """
+    query = f'/imports/{import_id}/citizens/families'
+    if min_size is not None:
+        query += f'?min_size={min_size}'
+    return _send_request(client, 'get', query)
+
+
+def send_get_diff_request(client: FlaskClient, import_id: int, other_import_id: int) -> Tuple[int, Any]:
+    """
+    Send get request to /imports/$import_id/diff/$other_import_id
+    :param client: an instance of flask.testing.FlaskClient to make http requests
+    :param import_id: query parameter
+    :param other_import_id: query parameter
+    :return: Tuple[response_status_code, response_json]
+    """
+    return _send_request(client, 'get', f'/imports/{import_id}/diff/{other_import_id}')
+
+
+def send_get_metrics_request(client: FlaskClient) -> Tuple[int, Any]:
+    """
+    Send get request to /metrics
+    :param client: an instance of flask.testing.FlaskClient to make http requests
+    :return: Tuple[response_status_code, response_json]
+    """
+    query = '/metrics'
+    return _send_request(client, 'get', query)
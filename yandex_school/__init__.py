@@ -3,9 +3,11 @@ from flask_cors import CORS
 from flask_restful import Api
 from flask_sqlalchemy import SQLAlchemy
 
+from yandex_school import config, pool
 from yandex_school.config import DB_URL, DB_LOGIN, DB_PASSWORD, DB_NAME
 
 app = Flask(__name__)
+app.config.from_object(config)  # exposes tunables from config.py as app.config entries
 api = Api(app)
 cors = CORS(app, resources={r'/*': {'origins': '*'}})  # headache reducer
 
@@ -13,4 +15,6 @@ app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_LOGIN}:{DB_PASSWORD}@
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # turning off an outdated feature
 
 # TODO: experimental alchemy flags, might blame weird behavior on them
-db = SQLAlchemy(app, engine_options={'echo': False}, session_options={'autoflush': False, 'expire_on_commit': False})
+db = SQLAlchemy(app, engine_options={'echo': False, **pool.engine_options()},
+                session_options={'autoflush': False, 'expire_on_commit': False})
+pool.register('default', lambda: db.engine)
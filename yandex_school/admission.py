@@ -0,0 +1,206 @@
+import fcntl
+import itertools
+import json
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter, sleep
+from typing import Optional, Iterator
+
+from flask import Flask, current_app, g, request
+
+from yandex_school.metrics import increment, observe, register_gauge
+
+"""
+    Admission control in front of the resources.
+
+    Every endpoint gets a budget of concurrency slots shared by all the workers on the host.
+    Busy slots and the queue of waiting requests of an endpoint are kept in its state file, read and written
+    under a short flock() of the file. Requests are admitted first come first served, a request needing more
+    slots than are free blocks the ones behind it, so heavy requests are not starved by a stream of light ones.
+    Entries of dead processes are dropped whenever the file is read, so a crashed worker releases its slots.
+    When the queue is full or the wait times out the request is rejected with 503.
+"""
+
+POLL_INTERVAL = 0.005
+
+
+def _path(endpoint: str) -> str:
+    """
+    :param endpoint: endpoint name
+    :return: state file path
+    """
+    return os.path.join(current_app.config['ADMISSION_DIR'], f'{endpoint}.state')
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def _state(path: str, exclusive: bool = True) -> Iterator[dict]:
+    """
+    Locks the state file of an endpoint for the block, the lock is never held while a request is served
+    :param path: state file path
+    :param exclusive: False for a read-only look, changes to the state are not written then
+    :return: context manager giving {'busy': [...], 'queue': [...]}, both lists of [ticket id, pid, slots]
+    in the order of arrival
+    """
+    with open(path, 'a+b') as file:
+        fcntl.flock(file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        file.seek(0)
+        try:
+            state = json.loads(file.read() or b'{}')
+        except ValueError:
+            # written by a worker killed in the middle of the write
+            state = {}
+        alive = {}
+        for kind in ('busy', 'queue'):
+            state[kind] = [x for x in state.get(kind, []) if alive.setdefault(x[1], _alive(x[1]))]
+        yield state
+        if exclusive:
+            file.truncate(0)
+            file.write(json.dumps(state).encode())
+            file.flush()
+
+
+class _Ticket:
+    """
+    Slots of a request, queued until admitted
+    """
+
+    _ids = itertools.count()
+
+    def __init__(self, path: str, slots: int):
+        """
+        :param path: state file of the endpoint
+        :param slots: number of slots the request needs
+        """
+        self.path = path
+        self.slots = slots
+        self.id = f'{os.getpid()}.{threading.get_ident()}.{next(self._ids)}'
+
+    @property
+    def entry(self) -> list:
+        return [self.id, os.getpid(), self.slots]
+
+    def release(self) -> None:
+        with _state(self.path) as state:
+            for kind in ('busy', 'queue'):
+                state[kind] = [x for x in state[kind] if x[0] != self.id]
+
+
+def _free(state: dict, limit: int) -> int:
+    """
+    :param state: endpoint state
+    :param limit: endpoint budget
+    :return: number of free slots
+    """
+    return limit - sum(x[2] for x in state['busy'])
+
+
+def weight(endpoint: str, limit: int) -> int:
+    """
+    Number of slots the current request costs. Each ADMISSION_WEIGHT_BYTES of payload take an extra slot.
+    :param endpoint: endpoint name
+    :param limit: endpoint budget
+    :return: number of slots
+    """
+    per_slot = current_app.config['ADMISSION_WEIGHT_BYTES']
+    extra = (request.content_length or 0) // per_slot if per_slot else 0
+    return min(1 + extra, limit)
+
+
+def acquire(endpoint: str, limit: int, slots: int) -> Optional[_Ticket]:
+    """
+    Takes slots of an endpoint, waiting in the queue if needed
+    :param endpoint: endpoint name
+    :param limit: endpoint budget
+    :param slots: number of slots to take
+    :return: admitted ticket or None if request is rejected
+    """
+    ticket = _Ticket(_path(endpoint), slots)
+    with _state(ticket.path) as state:
+        if not state['queue'] and _free(state, limit) >= slots:
+            state['busy'].append(ticket.entry)
+            return ticket
+        if len(state['queue']) >= current_app.config['ADMISSION_QUEUE_SIZE']:
+            increment(f'admission_rejected.{endpoint}')
+            return None
+        state['queue'].append(ticket.entry)
+
+    started = perf_counter()
+    deadline = started + current_app.config['ADMISSION_TIMEOUT']
+    while perf_counter() < deadline:
+        sleep(POLL_INTERVAL)
+        with _state(ticket.path) as state:
+            # only the head of the queue is admitted, later requests wait even if they would fit
+            if state['queue'] and state['queue'][0][0] == ticket.id and _free(state, limit) >= slots:
+                state['busy'].append(state['queue'].pop(0))
+                observe(f'admission_wait.{endpoint}', perf_counter() - started)
+                return ticket
+
+    ticket.release()
+    increment(f'admission_timeouts.{endpoint}')
+    return None
+
+
+def state() -> dict:
+    """
+    :return: host-wide busy slots and queue depth per endpoint, read from the state files without touching slots
+    """
+    if not current_app.config['ADMISSION_CONTROL']:
+        return {}
+    os.makedirs(current_app.config['ADMISSION_DIR'], exist_ok=True)
+    result = {}
+    for endpoint, limit in current_app.config['ADMISSION_LIMITS'].items():
+        with _state(_path(endpoint), exclusive=False) as current:
+            result[endpoint] = {'limit': limit, 'busy': limit - _free(current, limit), 'queue': len(current['queue'])}
+    return result
+
+
+def before_request():
+    """
+    Admits or rejects incoming request
+    """
+    if not current_app.config['ADMISSION_CONTROL']:
+        return None
+    endpoint = request.endpoint
+    limit = current_app.config['ADMISSION_LIMITS'].get(endpoint)
+    if not limit:
+        return None
+
+    os.makedirs(current_app.config['ADMISSION_DIR'], exist_ok=True)
+    ticket = acquire(endpoint, limit, weight(endpoint, limit))
+    if ticket is None:
+        retry_after = str(current_app.config['ADMISSION_RETRY_AFTER'])
+        return {'message': f'Too many concurrent {endpoint} requests, retry later'}, 503, {'Retry-After': retry_after}
+    increment(f'admission_admitted.{endpoint}')
+    g.admission_ticket = ticket
+    return None
+
+
+def teardown_request(exception=None):
+    """
+    Releases slots of the finished request
+    """
+    ticket = g.pop('admission_ticket', None)
+    if ticket:
+        ticket.release()
+
+
+def init_app(app: Flask) -> None:
+    """
+    Installs admission control hooks
+    :param app: application
+    :return: None
+    """
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
+    register_gauge('admission', state)
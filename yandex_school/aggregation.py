@@ -0,0 +1,108 @@
+from operator import itemgetter
+from typing import List, Dict, Tuple, Iterable, Sequence
+
+from yandex_school.rows import BIRTHDAY_ID, BIRTHDAY_CITIZEN_ID, BIRTHDAY_DATE, BIRTHDAY_RELATIVE_ID
+
+"""
+    Aggregation steps of the resources working on plain rows, no database or request needed.
+"""
+
+
+def relatives_diff(current: Iterable[int], requested: Iterable[int]) -> Tuple[set, set]:
+    """
+    Set difference of relatives
+    :param current: current relatives
+    :param requested: proposed relatives
+    :return: sets of citizen_ids to be added and to be removed from relatives
+    """
+    current, requested = set(current), set(requested)
+    return requested - current, current - requested
+
+
+def birthday_presents(rows: Sequence[Sequence]) -> Dict[int, Dict[int, int]]:
+    """
+    Counts presents every citizen buys per month
+    :param rows: birthday_rows, a row per relationship ordered by citizen_id
+    :return: citizen_id -> month -> number of presents
+    """
+    month_map = {row[BIRTHDAY_ID]: row[BIRTHDAY_DATE].month for row in rows}
+
+    presents = {}
+
+    for row in rows:
+        db_relative_id = row[BIRTHDAY_RELATIVE_ID]
+        if not db_relative_id:  # no relatives :(
+            continue
+
+        citizen_id = row[BIRTHDAY_CITIZEN_ID]
+        months = presents.get(citizen_id)
+        if months is None:
+            months = presents[citizen_id] = {}
+        month = month_map[db_relative_id]
+        months[month] = months.get(month, 0) + 1
+
+    return presents
+
+
+def presents_cells(presents: Dict[int, Dict[int, int]]) -> Iterable[Tuple[int, int, int]]:
+    """
+    :param presents: citizen_id -> month -> number of presents
+    :return: (citizen_id, month, presents) cells in citizen order
+    """
+    return ((citizen_id, month, count) for citizen_id, months in presents.items() for month, count in months.items())
+
+
+def birthday_cells(rows: Sequence[Sequence]) -> Iterable[Tuple[int, int, int]]:
+    """
+    Counts presents every citizen buys per month with numpy.
+    Citizens get dense indices in row order, relative months are looked up by fancy indexing
+    and (citizen index, month) cells are counted with bincount.
+    :param rows: birthday_rows, a row per relationship ordered by citizen_id
+    :return: non-empty (citizen_id, month, presents) cells in citizen order, months ascending
+    """
+    import numpy
+
+    size = len(rows)
+    citizen_ids = numpy.fromiter(map(itemgetter(BIRTHDAY_CITIZEN_ID), rows), numpy.int64, size)
+    relative_ids = numpy.fromiter([row[BIRTHDAY_RELATIVE_ID] or 0 for row in rows], numpy.int64, size)
+
+    # rows of a citizen are adjacent, a new index starts where citizen_id changes
+    starts = numpy.concatenate(([True], citizen_ids[1:] != citizen_ids[:-1]))
+    citizen_index = numpy.cumsum(starts) - 1
+    starts = numpy.flatnonzero(starts)
+    count = len(starts)
+
+    # per citizen columns are read from the first row of each citizen only
+    first_rows = [rows[i] for i in starts.tolist()]
+    ids = numpy.fromiter([row[BIRTHDAY_ID] for row in first_rows], numpy.int64, count)
+    months = numpy.fromiter([row[BIRTHDAY_DATE].month for row in first_rows], numpy.int64, count) - 1
+
+    # database id -> month, database ids of an import are mostly contiguous so a direct table usually fits
+    related = relative_ids != 0
+    relative_ids = relative_ids[related]
+    low = ids.min()
+    span = ids.max() - low + 1
+    if span <= 4 * count:
+        month_table = numpy.zeros(span, dtype=numpy.int64)
+        month_table[ids - low] = months
+        relative_months = month_table[relative_ids - low]
+    else:
+        order = numpy.argsort(ids)
+        relative_months = months[order][numpy.searchsorted(ids[order], relative_ids)]
+
+    counts = numpy.bincount(citizen_index[related] * 12 + relative_months, minlength=count * 12)
+    cells = numpy.flatnonzero(counts)
+
+    return zip(citizen_ids[starts][cells // 12].tolist(), (cells % 12 + 1).tolist(), counts[cells].tolist())
+
+
+def cells_by_month(cells: Iterable[Tuple[int, int, int]]) -> Dict[int, List[Dict]]:
+    """
+    Builds GetBirthdays response data
+    :param cells: (citizen_id, month, presents) cells in citizen order
+    :return: month -> list of citizen_id and presents dicts
+    """
+    months_dict: Dict[int, List] = {x: [] for x in range(1, 13)}
+    for citizen_id, month, count in cells:
+        months_dict[month].append({'citizen_id': citizen_id, 'presents': count})
+    return months_dict
@@ -1,11 +1,23 @@
-from yandex_school import app, api
-from yandex_school.resources import CreateImport, PatchCitizen, GetCitizens, GetBirthdays, GetAges
+from yandex_school import app, api, admission, cpuprof, deadlines, memprof
+from yandex_school.metrics import Metrics
+from yandex_school.resources import CreateImport, PatchCitizen, GetCitizens, GetBirthdays, GetAges, \
+    GetTownStats, GetFamilies, GetImportDiff, ApplyDelta
 
 api.add_resource(CreateImport, '/imports')
+api.add_resource(ApplyDelta, '/imports/<int:import_id>/delta')
 api.add_resource(PatchCitizen, '/imports/<int:import_id>/citizens/<int:citizen_id>')
 api.add_resource(GetCitizens, '/imports/<int:import_id>/citizens')
+api.add_resource(GetFamilies, '/imports/<int:import_id>/citizens/families')
 api.add_resource(GetBirthdays, '/imports/<int:import_id>/citizens/birthdays')
 api.add_resource(GetAges, '/imports/<int:import_id>/towns/stat/percentile/age')
+api.add_resource(GetTownStats, '/imports/<int:import_id>/towns/stat')
+api.add_resource(GetImportDiff, '/imports/<int:import_id>/diff/<int:other_import_id>')
+api.add_resource(Metrics, '/metrics')
+
+deadlines.init_app(app)
+admission.init_app(app)
+memprof.init_app(app)
+cpuprof.init_app(app)
 
 if __name__ == '__main__':
     app.run()
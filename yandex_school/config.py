@@ -1,5 +1,114 @@
+import multiprocessing
+import os
+
 DB_LOGIN = ''
 DB_PASSWORD = ''
 DB_URL = 'localhost'
 DB_NAME = 'yandex_school'
 LOGGING_FORMAT = '%(asctime)s - %(filename)s - %(module)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s'
+
+# import deduplication policy: 'always_new', 'dedup' or 'dedup_window'
+IMPORT_DEDUP_POLICY = 'always_new'
+# seconds an import stays eligible for deduplication under 'dedup_window' policy
+IMPORT_DEDUP_WINDOW = 600
+
+# GetBirthdays aggregation: 'numpy' counts with bincount over arrays, 'python' walks rows with dicts
+BIRTHDAYS_ENGINE = 'numpy'
+
+# number of computed town statistics kept in memory of every worker
+TOWN_STATS_CACHE_SIZE = 128
+# number of family indexes (relatives graph components) kept in memory of every worker
+FAMILIES_CACHE_SIZE = 32
+# columnar snapshot files of imports, mapped by every worker for birthdays, ages and families.
+# Written on import, removed by every change and written again by the next read of the import
+SNAPSHOTS = False
+# directory of snapshot files, shared by all the workers of a host, holds snapshots of a single database
+SNAPSHOT_DIR = '/tmp/yandex_school_snapshots'
+# number of mapped snapshots kept open by every worker
+SNAPSHOT_CACHE_SIZE = 64
+# number of birth histograms (per-town birth date counts) kept in memory of every worker
+HISTOGRAMS_CACHE_SIZE = 32
+
+# request deadlines: endpoint -> seconds, statements still running when the time is up are cancelled
+REQUEST_DEADLINES = {
+    'createimport': 60.0,
+    'getcitizens': 30.0,
+    'getbirthdays': 30.0,
+    'getages': 30.0,
+    'gettownstats': 30.0,
+    'getfamilies': 30.0,
+    'getimportdiff': 60.0,
+    'patchcitizen': 10.0,
+    'applydelta': 30.0,
+}
+
+# memory profiling: off by default, requests with the header or a random sample of them are traced
+MEMORY_PROFILING = False
+MEMORY_PROFILING_HEADER = 'X-Memory-Profile'
+MEMORY_PROFILING_SAMPLE_RATE = 0.0
+# number of top allocation sites logged per phase, taking snapshots is slow so 0 disables it
+MEMORY_PROFILING_TOP = 0
+
+# sampling profiler: off by default, stacks of requests slower than the threshold (sampled past it) or carrying
+# the header from an allowlisted address (sampled from the start) are written to the directory as collapsed stacks
+CPU_PROFILING = False
+CPU_PROFILING_HEADER = 'X-Cpu-Profile'
+CPU_PROFILING_ALLOWLIST = ('127.0.0.1/32', '::1/128')
+# seconds
+CPU_PROFILING_THRESHOLD = 1.0
+# seconds between stack samples
+CPU_PROFILING_INTERVAL = 0.005
+CPU_PROFILING_DIR = '/tmp/yandex_school_profiles'
+# number of latest profiles kept in the directory
+CPU_PROFILING_KEEP = 100
+
+# admission control: per-endpoint concurrency budgets shared by all the workers of the host
+ADMISSION_CONTROL = False
+# directory for state files of the endpoints, must be the same for all the workers
+ADMISSION_DIR = '/tmp/yandex_school_admission'
+# endpoint -> number of concurrency slots
+ADMISSION_LIMITS = {
+    'createimport': 4,
+    'getcitizens': 4,
+    'getbirthdays': 4,
+    'getages': 8,
+    'gettownstats': 8,
+    'getfamilies': 8,
+    'getimportdiff': 2,
+    'patchcitizen': 32,
+    'applydelta': 8,
+}
+# requests allowed to wait for slots per endpoint, the rest is rejected immediately
+ADMISSION_QUEUE_SIZE = 16
+# seconds a request may wait in the queue
+ADMISSION_TIMEOUT = 5.0
+# Retry-After header value of rejected requests, seconds
+ADMISSION_RETRY_AFTER = 1
+# every this many bytes of request body cost an extra slot
+ADMISSION_WEIGHT_BYTES = 1024 * 1024
+
+# storage of imports: 'sql' for Postgres, 'sharded' for several Postgres databases listed in SHARDS,
+# 'memory' for process-local storage (tests, profiling)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sql')
+
+# run hot queries as server-side prepared statements, one PREPARE per statement per connection
+SQL_PREPARED_STATEMENTS = False
+
+# database URIs of 'sharded' storage, comma separated in the environment. Import N lives in SHARDS[(N - 1) % len(SHARDS)],
+# changing the list requires moving imports with `python3 -m yandex_school.rebalance`
+SHARDS = [x for x in os.environ.get('SHARDS', '').split(',') if x]
+
+# connections of a database all the workers of the host may hold together, every worker gets an equal share.
+# Applies to every shard database separately
+DB_CONNECTION_BUDGET = int(os.environ.get('DB_CONNECTION_BUDGET', 40))
+# number of workers sharing the budget, same default as gunicorn configs
+DB_WORKERS = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# share of a worker's connections opened only under load and closed when returned
+DB_POOL_OVERFLOW_SHARE = 0.5
+# seconds a request waits for a free connection before failing
+DB_POOL_TIMEOUT = 10
+# seconds after which a pooled connection is replaced
+DB_POOL_RECYCLE = 1800
+# PgBouncer in transaction pooling mode in front of Postgres: nothing may outlive a transaction on a server
+# connection, so hot statements are not prepared
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', '') == '1'
@@ -0,0 +1,244 @@
+import ipaddress
+import json
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+from time import perf_counter, sleep
+from typing import Dict, Optional
+
+from flask import Flask, current_app, g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from yandex_school.metrics import increment
+
+"""
+    Opt-in sampling profiler of slow requests.
+
+    With CPU_PROFILING on, a sampler thread reads the stacks of the threads serving requests every
+    CPU_PROFILING_INTERVAL seconds. Requests carrying CPU_PROFILING_HEADER from an address of CPU_PROFILING_ALLOWLIST
+    are sampled from their start, others only once they have run for CPU_PROFILING_THRESHOLD, so fast requests
+    are never sampled and profiles of slow ones cover the time past the threshold. Both leave their samples in
+    CPU_PROFILING_DIR as a collapsed-stack file (input of flamegraph.pl, speedscope and the like) next to a JSON file
+    of tags: endpoint, import_id, number of citizens if the resource knows it, duration and time spent in the database.
+    Only the CPU_PROFILING_KEEP latest profiles are kept.
+
+    The sampler thread starts with the first profiled request of a worker and sleeps while no request is due for
+    sampling, database time is measured only once the first request has been profiled.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class Profile:
+    """
+    Stack samples of a single request
+    """
+
+    def __init__(self, endpoint: str, forced: bool, threshold: float):
+        self.endpoint = endpoint
+        self.forced = forced
+        self.started = perf_counter()
+        # perf_counter value the request is sampled from
+        self.armed = self.started if forced else self.started + threshold
+        self.samples = Counter()
+        self.db_time = 0.0
+        self.query_started = None
+        self.tags: Dict = {}
+
+
+# thread ident -> profile of the request it is serving
+_requests: Dict[int, Profile] = {}
+_condition = threading.Condition()
+_sampler: Optional[threading.Thread] = None
+_listening = False
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+
+def collapse(frame) -> str:
+    """
+    :param frame: innermost frame of a stack
+    :return: stack in collapsed format, frames from the outermost one separated by semicolons
+    """
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def _sample(interval: float) -> None:
+    """
+    Sampler thread loop, waits while no request is profiled or armed
+    :param interval: seconds between samples
+    :return: None
+    """
+    while True:
+        with _condition:
+            while not _requests:
+                _condition.wait()
+            now = perf_counter()
+            armed = min(profile.armed for profile in _requests.values())
+            if armed > now:
+                # a new request notifies the condition, it may be forced
+                _condition.wait(armed - now)
+                continue
+            # under the condition, so a finished request never gets a sample while its profile is written
+            frames = sys._current_frames()
+            for ident, profile in _requests.items():
+                frame = frames.get(ident)
+                if frame is not None and profile.armed <= now:
+                    profile.samples[collapse(frame)] += 1
+            frame = frames = None
+        sleep(interval)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    profile = _requests.get(threading.get_ident())
+    if profile is not None:
+        profile.query_started = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    profile = _requests.get(threading.get_ident())
+    if profile is not None and profile.query_started is not None:
+        profile.db_time += perf_counter() - profile.query_started
+        profile.query_started = None
+
+
+def _start() -> None:
+    """
+    Starts the sampler thread and database time listeners of this process, must be called under the condition
+    :return: None
+    """
+    global _sampler, _listening
+    # a thread started before fork does not exist in the child
+    if _sampler is None or not _sampler.is_alive():
+        _sampler = threading.Thread(target=_sample, args=(current_app.config['CPU_PROFILING_INTERVAL'],),
+                                    name='cpuprof-sampler', daemon=True)
+        _sampler.start()
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+
+def _allowed(address: Optional[str]) -> bool:
+    """
+    :param address: client address
+    :return: whether the address belongs to CPU_PROFILING_ALLOWLIST
+    """
+    if not address:
+        return False
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network)
+               for network in current_app.config['CPU_PROFILING_ALLOWLIST'])
+
+
+def tag(**tags) -> None:
+    """
+    Adds tags to the profile of the current request. Does nothing if the request is not profiled.
+    :param tags: tag values, JSON serializable, or callables giving them, called only if the profile is written
+    :return: None
+    """
+    if not has_request_context():
+        return
+    profile = g.get('cpu_profile')
+    if profile is not None:
+        profile.tags.update(tags)
+
+
+def before_request():
+    """
+    Registers the request with the sampler
+    """
+    if not current_app.config['CPU_PROFILING'] or request.endpoint is None:
+        return
+    forced = current_app.config['CPU_PROFILING_HEADER'] in request.headers and _allowed(request.remote_addr)
+    profile = Profile(request.endpoint, forced, current_app.config['CPU_PROFILING_THRESHOLD'])
+    with _condition:
+        _start()
+        _requests[threading.get_ident()] = profile
+        _condition.notify()
+    g.cpu_profile = profile
+
+
+def _prune(directory: str, keep: int) -> None:
+    """
+    Removes all the profiles except the latest ones
+    :param directory: profile directory
+    :param keep: number of profiles to keep
+    :return: None
+    """
+    # names start with the time of the request, so they sort chronologically
+    names = sorted(x[:-len('.folded')] for x in os.listdir(directory) if x.endswith('.folded'))
+    for name in names[:max(0, len(names) - keep)]:
+        for extension in ('.folded', '.json'):
+            try:
+                os.remove(os.path.join(directory, name + extension))
+            except FileNotFoundError:
+                pass
+
+
+def write(directory: str, profile: Profile, duration: float, keep: int) -> str:
+    """
+    Writes collapsed stacks and tags of a profiled request
+    :param directory: profile directory
+    :param profile: profile of the request
+    :param duration: request duration, seconds
+    :param keep: number of profiles to keep in the directory
+    :return: path of the collapsed stacks file
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f'{datetime.utcnow():%Y%m%dT%H%M%S.%f}-{os.getpid()}-{profile.endpoint}'
+    path = os.path.join(directory, f'{name}.folded')
+    with open(path, 'w') as file:
+        file.writelines(f'{stack} {count}\n' for stack, count in profile.samples.most_common())
+    tags = {'endpoint': profile.endpoint, 'forced': profile.forced, 'duration': round(duration, 6),
+            'db_time': round(profile.db_time, 6), 'samples': sum(profile.samples.values()),
+            **{name: value() if callable(value) else value for name, value in profile.tags.items()}}
+    with open(os.path.join(directory, f'{name}.json'), 'w') as file:
+        json.dump(tags, file, ensure_ascii=False)
+    _prune(directory, keep)
+    return path
+
+
+def teardown_request(exception=None):
+    """
+    Stops sampling of the request, writes its profile if the request was slow or asked for it
+    """
+    profile = g.pop('cpu_profile', None)
+    if profile is None:
+        return
+    with _condition:
+        _requests.pop(threading.get_ident(), None)
+    duration = perf_counter() - profile.started
+
+    if not profile.forced and duration < current_app.config['CPU_PROFILING_THRESHOLD']:
+        return
+    import_id = (request.view_args or {}).get('import_id')
+    if import_id is not None:
+        profile.tags.setdefault('import_id', import_id)
+    path = write(current_app.config['CPU_PROFILING_DIR'], profile, duration, current_app.config['CPU_PROFILING_KEEP'])
+    increment(f'cpu_profiled.{profile.endpoint}')
+    logger.info(f'{profile.endpoint}: {duration:.3f}s, db {profile.db_time:.3f}s, profile {path}')
+
+
+def init_app(app: Flask) -> None:
+    """
+    Installs sampling profiler hooks
+    :param app: application
+    :return: None
+    """
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Optional, Iterator
+
+from flask import Flask, current_app, g, request, has_request_context
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError
+from werkzeug.exceptions import GatewayTimeout
+
+from yandex_school.metrics import increment
+
+"""
+    Request deadlines.
+
+    Every endpoint may get a time budget. Each database statement of the request runs in a transaction
+    with SET LOCAL statement_timeout set to what is left of the budget, so postgres cancels the work nobody
+    waits for anymore. Once the budget is spent no more statements are issued and the request ends with 504.
+"""
+
+# postgres error code of a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+
+class DeadlineExceeded(GatewayTimeout):
+    """
+    Raised when request budget runs out. Rendered as 504 by flask-restful like any other HTTP error.
+    """
+
+
+def before_request():
+    """
+    Starts the clock of an endpoint with a budget
+    """
+    budget = current_app.config['REQUEST_DEADLINES'].get(request.endpoint)
+    if budget:
+        g.deadline = perf_counter() + budget
+
+
+def remaining() -> Optional[float]:
+    """
+    :return: seconds left of the current request budget, None if there is no budget
+    """
+    if not has_request_context() or 'deadline' not in g:
+        return None
+    return g.deadline - perf_counter()
+
+
+def exceeded() -> DeadlineExceeded:
+    """
+    Counts deadline hit of the current endpoint, once per request
+    :return: exception to be raised
+    """
+    endpoint = request.endpoint
+    if not g.get('deadline_exceeded'):
+        g.deadline_exceeded = True
+        increment(f'deadline_exceeded.{endpoint}')
+    budget = current_app.config['REQUEST_DEADLINES'][endpoint]
+    return DeadlineExceeded(f'{endpoint} request did not finish in {budget} seconds')
+
+
+def check() -> Optional[float]:
+    """
+    Makes sure the request has still got time to do more work
+    :return: seconds left, None if there is no budget
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise exceeded()
+    return left
+
+
+def statement_timeout(connection: Connection) -> None:
+    """
+    Limits statements of the connection's current transaction by the rest of the request budget
+    :param connection: connection with an open transaction
+    :return: None
+    """
+    left = check()
+    if left is not None:
+        connection.execute(f'SET LOCAL statement_timeout = {max(int(left * 1000), 1)}')
+
+
+@contextmanager
+def budgeted(connection: Connection) -> Iterator[None]:
+    """
+    Runs statements of the block in a transaction limited by the request budget.
+    Does nothing if the request has got no budget.
+    :param connection: connection to execute on
+    :return: context manager
+    """
+    if remaining() is None:
+        yield
+        return
+    try:
+        with connection.begin():
+            statement_timeout(connection)
+            yield
+    except DBAPIError as ex:
+        if getattr(ex.orig, 'pgcode', None) == QUERY_CANCELED:
+            raise exceeded() from ex
+        raise
+
+
+def init_app(app: Flask) -> None:
+    """
+    Installs request deadline hooks
+    :param app: application
+    :return: None
+    """
+    app.before_request(before_request)
@@ -0,0 +1,82 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import List, Dict, Tuple
+
+from yandex_school.metrics import increment
+from yandex_school.storage import get_storage
+
+"""
+    Import deduplication policies
+"""
+ALWAYS_NEW = 'always_new'
+DEDUP = 'dedup'
+DEDUP_WINDOW = 'dedup_window'
+
+POLICIES = (ALWAYS_NEW, DEDUP, DEDUP_WINDOW)
+
+
+def canonical_citizen(citizen: Dict) -> bytes:
+    """
+    :param citizen: validated citizen
+    :return: part of the import hash contributed by the citizen, order of relatives does not matter
+    """
+    return json.dumps([
+        citizen['citizen_id'],
+        citizen['town'],
+        citizen['street'],
+        citizen['building'],
+        citizen['apartment'],
+        citizen['name'],
+        citizen['birth_date'].isoformat(),
+        citizen['gender'],
+        sorted(citizen['relatives'])
+    ], ensure_ascii=False).encode()
+
+
+def citizens_digest(citizens: List[Dict]) -> str:
+    """
+    Calculates canonical hash of validated citizens. Neither order of citizens nor order
+    of relatives affects the result.
+    :param citizens: list of citizens where each citizen is a dict
+    :return: hex encoded sha256 digest
+    """
+    digest = hashlib.sha256()
+    for citizen in sorted(citizens, key=lambda x: x['citizen_id']):
+        digest.update(canonical_citizen(citizen))
+    return digest.hexdigest()
+
+
+def create_import(citizens: List[Dict], relative_links: List[Tuple[int, int]], digest: str, policy: str,
+                  window: int) -> Tuple[int, bool]:
+    """
+    Stores a new import unless an import with the same content hash exists according to policy.
+    Looking the hash up and storing it along with the new import is a single storage operation,
+    so concurrent uploads of the same data resolve to one import.
+    :param citizens: validated citizens, each citizen is a dict
+    :param relative_links: relationship links list of citizen_ids
+    :param digest: content hash of the import
+    :param policy: one of POLICIES but ALWAYS_NEW
+    :param window: seconds an import stays eligible for DEDUP_WINDOW policy
+    :return: import_id of the existing or the new import and whether it is new
+    """
+    since = datetime.utcnow() - timedelta(seconds=window) if policy == DEDUP_WINDOW else None
+    import_id, created = get_storage().create_unique_import(citizens, relative_links, digest, since)
+
+    if created:
+        increment('dedup_misses')
+    else:
+        increment('dedup_hits')
+    return import_id, created
+
+
+def forget(import_id: int) -> None:
+    """
+    Drops content hash of an import. Must be called whenever import data changes,
+    otherwise a later upload of the original data would be resolved to the modified import.
+    Runs under every policy, hashes stored before a switch to 'always_new' would outlive the change otherwise.
+    :param import_id: id of the import
+    :return: None
+    """
+    if get_storage().drop_import_hash(import_id):
+        increment('dedup_invalidations')
@@ -0,0 +1,78 @@
+from typing import Iterator, Tuple, Optional, Dict, List
+
+"""
+    Difference between two imports. Both imports are read as citizen_id ordered streams and merged
+    in a single pass, so only the current row of each stream is held besides the result.
+"""
+
+FIELDS = ('town', 'street', 'building', 'apartment', 'name', 'birth_date', 'gender')
+DATE_FORMAT = '%d.%m.%Y'
+
+
+def merge(old: Iterator[Tuple], new: Iterator[Tuple]) -> Iterator[Tuple[Optional[Tuple], Optional[Tuple]]]:
+    """
+    Merge join of two citizen_id ordered streams
+    :param old: rows of the old import
+    :param new: rows of the new import
+    :return: iterator of (old row, new row) pairs, missing side is None
+    """
+    before, after = next(old, None), next(new, None)
+    while before is not None or after is not None:
+        if after is None or before is not None and before[0] < after[0]:
+            yield before, None
+            before = next(old, None)
+        elif before is None or after[0] < before[0]:
+            yield None, after
+            after = next(new, None)
+        else:
+            yield before, after
+            before, after = next(old, None), next(new, None)
+
+
+def _value(field: str, value):
+    return value.strftime(DATE_FORMAT) if field == 'birth_date' else value
+
+
+def _citizen(row: Tuple) -> Dict:
+    citizen = {'citizen_id': row[0]}
+    citizen.update((field, _value(field, value)) for field, value in zip(FIELDS, row[1:]))
+    citizen['relatives'] = list(row[-1])
+    return citizen
+
+
+def _links(citizen_id: int, relatives: List[int]) -> List[List[int]]:
+    # every link is reported once, by the citizen with the smaller citizen_id
+    return [[citizen_id, relative] for relative in relatives if citizen_id <= relative]
+
+
+def diff_imports(old: Iterator[Tuple], new: Iterator[Tuple]) -> Dict:
+    """
+    Compares two imports
+    :param old: citizen_id ordered rows of the old import, see Storage.citizen_stream
+    :param new: citizen_id ordered rows of the new import
+    :return: added citizens, removed citizen_ids, per field changes of the rest and changed relative links
+    """
+    added, removed, changed = [], [], []
+    links_added, links_removed = [], []
+
+    for before, after in merge(old, new):
+        if before is None:
+            added.append(_citizen(after))
+            links_added.extend(_links(after[0], after[-1]))
+        elif after is None:
+            removed.append(before[0])
+            links_removed.extend(_links(before[0], before[-1]))
+        else:
+            changes = {field: {'old': _value(field, old_value), 'new': _value(field, new_value)}
+                       for field, old_value, new_value in zip(FIELDS, before[1:], after[1:]) if old_value != new_value}
+            if before[-1] != after[-1]:
+                old_relatives, new_relatives = set(before[-1]), set(after[-1])
+                changes['relatives'] = {'old': list(before[-1]), 'new': list(after[-1])}
+                links_added.extend(_links(after[0], sorted(new_relatives - old_relatives)))
+                links_removed.extend(_links(after[0], sorted(old_relatives - new_relatives)))
+            if changes:
+                changed.append({'citizen_id': after[0], 'changes': changes})
+
+    # links come out ordered as the streams are
+    return {'added': added, 'removed': removed, 'changed': changed,
+            'relatives': {'added': links_added, 'removed': links_removed}}
@@ -0,0 +1,246 @@
+from threading import Lock
+from typing import List, Dict, Optional, Iterable, Tuple
+
+from flask import current_app
+
+from yandex_school import snapshots
+from yandex_school.metrics import increment
+from yandex_school.stats import StatsCache
+from yandex_school.storage import get_storage
+
+
+class FamilyIndex:
+    """
+    Array-backed union-find over citizens of a single import.
+    Citizens are addressed by their position in the sorted citizen_id array, every root keeps the list
+    of its component members so a component can be rebuilt without scanning the whole import.
+    """
+
+    def __init__(self, citizen_ids: Iterable[int], pairs: Iterable[Tuple[int, int]]):
+        import numpy
+
+        self.citizen_ids = numpy.fromiter(citizen_ids, dtype=numpy.int64)
+        count = len(self.citizen_ids)
+        self.parent = list(range(count))
+        self.size = [1] * count
+        self.members: Dict[int, List[int]] = {i: [i] for i in range(count)}
+        pairs = numpy.asarray(pairs, dtype=numpy.int64).reshape(-1, 2)
+        # every relationship of the import is stored twice, one direction is enough
+        self.union_pairs(pairs[pairs[:, 0] < pairs[:, 1]])
+
+    def index(self, citizen_id: int) -> int:
+        """
+        :param citizen_id: citizen_id of the import
+        :return: position of the citizen in the arrays
+        """
+        import numpy
+
+        return int(numpy.searchsorted(self.citizen_ids, citizen_id))
+
+    def find(self, i: int) -> int:
+        parent = self.parent
+        while parent[i] != i:
+            # path halving
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i: int, j: int) -> None:
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        self.members[i].extend(self.members.pop(j))
+
+    def union_pairs(self, pairs: Iterable[Tuple[int, int]]) -> None:
+        """
+        Merges components of related citizens
+        :param pairs: (citizen_id, relative citizen_id) pairs
+        :return: None
+        """
+        import numpy
+
+        pairs = numpy.asarray(pairs, dtype=numpy.int64).reshape(-1, 2)
+        positions = numpy.searchsorted(self.citizen_ids, pairs)
+        for i, j in positions.tolist():
+            self.union(i, j)
+
+    def component(self, citizen_id: int) -> List[int]:
+        """
+        :param citizen_id: citizen_id of the import
+        :return: citizen_ids of the citizen's family
+        """
+        return self.citizen_ids[self.members[self.find(self.index(citizen_id))]].tolist()
+
+    def rebuild(self, citizen_ids: Iterable[int], pairs: Iterable[Tuple[int, int]]) -> None:
+        """
+        Splits families of the citizens into singletons and merges them back by their current relationships
+        :param citizen_ids: citizen_ids of the import
+        :param pairs: current relationships of the family members
+        :return: None
+        """
+        roots = {self.find(self.index(citizen_id)) for citizen_id in citizen_ids}
+        # nobody outside of the components points into them, so their members can be reset in place
+        for root in roots:
+            for i in self.members.pop(root):
+                self.parent[i] = i
+                self.size[i] = 1
+                self.members[i] = [i]
+        self.union_pairs(pairs)
+
+    def families(self, min_size: int = 1) -> List[Dict]:
+        """
+        :param min_size: smallest family size to report
+        :return: families sorted by size descending, then by smallest citizen_id
+        """
+        result = [{'size': len(members), 'citizens': sorted(self.citizen_ids[members].tolist())}
+                  for members in self.members.values() if len(members) >= min_size]
+        result.sort(key=lambda family: (-family['size'], family['citizens'][0]))
+        return result
+
+
+# (storage id, import_id) -> (version, index)
+cache = StatsCache()
+_lock = Lock()
+
+
+def family_index(import_id: int) -> Optional[FamilyIndex]:
+    """
+    Builds or fetches cached family index of an import.
+    The lock is taken only around the cache, the import is read without it.
+    :param import_id: requested import_id
+    :return: family index or None if import does not exist
+    """
+    storage = get_storage()
+    version = storage.import_version(import_id)
+    if version is None:
+        return None
+
+    key = (id(storage), import_id)
+    with _lock:
+        entry = cache.get(key)
+        if entry is not None and entry[0] == version:
+            increment('families_cache_hits')
+            return entry[1]
+
+    increment('families_cache_misses')
+    snapshot = snapshots.get(import_id, version)
+    if snapshot is not None:
+        index, consistent = FamilyIndex(snapshot.citizen_ids, snapshot.relative_pairs()), True
+    else:
+        index = FamilyIndex(storage.citizen_ids(import_id), storage.relative_pairs(import_id))
+        # version is bumped in the transaction of the change, unchanged version means unchanged relatives
+        consistent = storage.import_version(import_id) == version
+    if consistent:
+        with _lock:
+            entry = cache.get(key)
+            if entry is None or entry[0] < version:
+                cache.put(key, (version, index), current_app.config['FAMILIES_CACHE_SIZE'])
+    return index
+
+
+def families(import_id: int, min_size: int = 1) -> Optional[List[Dict]]:
+    """
+    Connected components of the import relatives graph
+    :param import_id: requested import_id
+    :param min_size: smallest family size to report
+    :return: list of families or None if import does not exist
+    """
+    index = family_index(import_id)
+    if index is None:
+        return None
+    with _lock:
+        return index.families(min_size)
+
+
+def apply_patch(import_id: int, version: Optional[int], citizen_id: int,
+                added: Iterable[int] = (), removed: Iterable[int] = ()) -> None:
+    """
+    Brings cached family index of an import to the new version after a citizen has been patched.
+    Added relatives are merged in place, removals rebuild the citizen's former family only.
+    The index is dropped if it lags behind by more than this patch.
+    :param import_id: patched import_id
+    :param version: import version after the patch
+    :param citizen_id: patched citizen_id
+    :param added: citizen_ids of new relatives
+    :param removed: citizen_ids of lost relatives
+    :return: None
+    """
+    storage = get_storage()
+    key = (id(storage), import_id)
+    with _lock:
+        entry = cache.get(key)
+        if entry is None:
+            return
+        if version is None or entry[0] != version - 1:
+            cache.discard(key)
+            increment('families_invalidations')
+            return
+
+        index = entry[1]
+        if not removed:
+            index.union_pairs([(citizen_id, relative) for relative in added])
+            cache.put(key, (version, index), current_app.config['FAMILIES_CACHE_SIZE'])
+            return
+        members = index.component(citizen_id)
+    _rebuild(storage, import_id, version, members)
+
+
+def apply_delta(import_id: int, version: Optional[int], citizen_ids: Iterable[int], resized: bool) -> None:
+    """
+    Brings cached family index of an import to the new version after a delta has been applied.
+    Families of the replaced citizens are rebuilt, the index is dropped if the set of citizens has changed,
+    as its arrays are laid out by citizen_id, or if it lags behind by more than this delta.
+    :param import_id: changed import_id
+    :param version: import version after the delta
+    :param citizen_ids: citizen_ids of the replaced citizens
+    :param resized: citizens were inserted or deleted
+    :return: None
+    """
+    storage = get_storage()
+    key = (id(storage), import_id)
+    with _lock:
+        entry = cache.get(key)
+        if entry is None:
+            return
+        if resized or version is None or entry[0] != version - 1:
+            cache.discard(key)
+            increment('families_invalidations')
+            return
+
+        index = entry[1]
+        members = {member for citizen_id in citizen_ids for member in index.component(citizen_id)}
+    _rebuild(storage, import_id, version, sorted(members))
+
+
+def _rebuild(storage, import_id: int, version: int, members: List[int]) -> None:
+    """
+    Rebuilds families of the members in the cached index of the previous import version.
+    Relationships are read without the lock, the index is dropped if it has been moved meanwhile
+    or another worker has changed the import again.
+    :param storage: storage of the import
+    :param import_id: changed import_id
+    :param version: import version after the change
+    :param members: citizen_ids of the changed families
+    :return: None
+    """
+    pairs = storage.relative_pairs(import_id, members)
+    # version is bumped in the transaction of the change, unchanged version means unchanged relatives
+    consistent = storage.import_version(import_id) == version
+    key = (id(storage), import_id)
+    with _lock:
+        entry = cache.get(key)
+        if entry is None:
+            return
+        if not consistent or entry[0] != version - 1:
+            cache.discard(key)
+            increment('families_invalidations')
+            return
+
+        index = entry[1]
+        index.rebuild(members, pairs)
+        increment('families_rebuilds')
+        cache.put(key, (version, index), current_app.config['FAMILIES_CACHE_SIZE'])
@@ -0,0 +1,191 @@
+from datetime import date, datetime, timezone
+from typing import List, Dict, Sequence, Iterable, Tuple
+
+from flask import request, Response
+
+from yandex_school.rows import ID, CITIZEN_ID, TOWN, STREET, BUILDING, APARTMENT, NAME, BIRTH_DATE, GENDER, \
+    RELATIVE_ID
+
+"""
+    Response formats of the read endpoints, chosen by Accept header.
+    JSON is the default, binary formats are available when their optional packages are installed:
+    msgpack for MessagePack and pyarrow for Arrow IPC stream.
+"""
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+ARROW = 'application/vnd.apache.arrow.stream'
+
+CITIZEN_COLUMNS = ('citizen_id', 'town', 'street', 'building', 'apartment', 'name', 'birth_date', 'gender',
+                   'relatives')
+BIRTHDAY_COLUMNS = ('month', 'citizen_id', 'presents')
+AGE_COLUMNS = ('town', 'p50', 'p75', 'p99')
+
+
+def _available() -> List[str]:
+    """
+    :return: mimetypes which can be produced in this environment, JSON first
+    """
+    mimetypes = [JSON]
+    try:
+        import msgpack  # noqa: F401
+        mimetypes.append(MSGPACK)
+    except ImportError:
+        pass
+    try:
+        import pyarrow  # noqa: F401
+        mimetypes.append(ARROW)
+    except ImportError:
+        pass
+    return mimetypes
+
+
+def negotiate() -> str:
+    """
+    Picks response format for the current request. Falls back to JSON when nothing matches.
+    :return: one of JSON, MSGPACK, ARROW
+    """
+    if not request.accept_mimetypes:
+        return JSON
+    return request.accept_mimetypes.best_match(_available(), default=JSON)
+
+
+def _timestamp(value: date):
+    """
+    :param value: date
+    :return: MessagePack timestamp of the midnight UTC of the date
+    """
+    import msgpack
+    return msgpack.Timestamp.from_datetime(datetime(value.year, value.month, value.day, tzinfo=timezone.utc))
+
+
+def _msgpack_response(columns: Sequence[str], rows: List[list]) -> Response:
+    """
+    :param columns: column names
+    :param rows: rows as lists of values in column order
+    :return: MessagePack encoded {'columns': [...], 'rows': [[...], ...]}
+    """
+    import msgpack
+    return Response(msgpack.packb({'columns': columns, 'rows': rows}, use_bin_type=True), mimetype=MSGPACK)
+
+
+def _arrow_response(table) -> Response:
+    """
+    :param table: pyarrow.Table
+    :return: Arrow IPC stream response
+    """
+    import pyarrow
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(sink.getvalue().to_pybytes(), mimetype=ARROW)
+
+
+def citizens_msgpack(raw_citizens: Sequence) -> Response:
+    """
+    Builds MessagePack rows straight from joined citizen-relative rows.
+    Dates are encoded as MessagePack timestamps.
+    :param raw_citizens: rows of citizen columns and relative_id ordered by citizen_id
+    :return: response
+    """
+    id_map = {raw[ID]: raw[CITIZEN_ID] for raw in raw_citizens}
+    rows = []
+    prev_id = None
+    for raw in raw_citizens:
+        relative_id = raw[RELATIVE_ID]
+        if raw[ID] != prev_id:
+            rows.append([raw[CITIZEN_ID], raw[TOWN], raw[STREET], raw[BUILDING], raw[APARTMENT],
+                         raw[NAME], _timestamp(raw[BIRTH_DATE]), raw[GENDER], []])
+            prev_id = raw[ID]
+        if relative_id:
+            rows[-1][-1].append(id_map[relative_id])
+    return _msgpack_response(CITIZEN_COLUMNS, rows)
+
+
+def citizens_arrow(raw_citizens: Sequence) -> Response:
+    """
+    Builds a columnar Arrow table straight from joined citizen-relative rows.
+    Relatives are a list<int32> column, birth dates are date32.
+    :param raw_citizens: rows of citizen columns and relative_id ordered by citizen_id
+    :return: response
+    """
+    import pyarrow
+
+    id_map = {raw[ID]: raw[CITIZEN_ID] for raw in raw_citizens}
+    positions = dict(zip(CITIZEN_COLUMNS[:-1], (CITIZEN_ID, TOWN, STREET, BUILDING, APARTMENT, NAME, BIRTH_DATE,
+                                                GENDER)))
+    columns = {name: [] for name in CITIZEN_COLUMNS[:-1]}
+    offsets = [0]
+    relatives = []
+    prev_id = None
+    for raw in raw_citizens:
+        if raw[ID] != prev_id:
+            if prev_id is not None:
+                offsets.append(len(relatives))
+            for name, values in columns.items():
+                values.append(raw[positions[name]])
+            prev_id = raw[ID]
+        relative_id = raw[RELATIVE_ID]
+        if relative_id:
+            relatives.append(id_map[relative_id])
+    offsets.append(len(relatives))
+
+    table = pyarrow.table({
+        'citizen_id': pyarrow.array(columns['citizen_id'], pyarrow.int32()),
+        'town': pyarrow.array(columns['town'], pyarrow.string()),
+        'street': pyarrow.array(columns['street'], pyarrow.string()),
+        'building': pyarrow.array(columns['building'], pyarrow.string()),
+        'apartment': pyarrow.array(columns['apartment'], pyarrow.int32()),
+        'name': pyarrow.array(columns['name'], pyarrow.string()),
+        'birth_date': pyarrow.array(columns['birth_date'], pyarrow.date32()),
+        'gender': pyarrow.array(columns['gender'], pyarrow.string()).dictionary_encode(),
+        'relatives': pyarrow.ListArray.from_arrays(pyarrow.array(offsets, pyarrow.int32()),
+                                                   pyarrow.array(relatives, pyarrow.int32())),
+    })
+    return _arrow_response(table)
+
+
+def birthdays_msgpack(cells: Iterable[Tuple[int, int, int]]) -> Response:
+    """
+    :param cells: (citizen_id, month, presents) cells
+    :return: response with (month, citizen_id, presents) rows ordered by month
+    """
+    rows = sorted([month, citizen_id, count] for citizen_id, month, count in cells)
+    return _msgpack_response(BIRTHDAY_COLUMNS, rows)
+
+
+def birthdays_arrow(cells: Iterable[Tuple[int, int, int]]) -> Response:
+    """
+    :param cells: (citizen_id, month, presents) cells
+    :return: response with (month, citizen_id, presents) columns ordered by month
+    """
+    import pyarrow
+    rows = sorted((month, citizen_id, count) for citizen_id, month, count in cells)
+    months, citizen_ids, counts = zip(*rows) if rows else ((), (), ())
+    table = pyarrow.table({
+        'month': pyarrow.array(months, pyarrow.int8()),
+        'citizen_id': pyarrow.array(citizen_ids, pyarrow.int32()),
+        'presents': pyarrow.array(counts, pyarrow.int32()),
+    })
+    return _arrow_response(table)
+
+
+def ages_msgpack(towns: List[Dict]) -> Response:
+    """
+    :param towns: list of {'town', 'p50', 'p75', 'p99'} dicts
+    :return: response
+    """
+    return _msgpack_response(AGE_COLUMNS, [[x['town'], float(x['p50']), float(x['p75']), float(x['p99'])]
+                                           for x in towns])
+
+
+def ages_arrow(towns: List[Dict]) -> Response:
+    """
+    :param towns: list of {'town', 'p50', 'p75', 'p99'} dicts
+    :return: response
+    """
+    import pyarrow
+    table = pyarrow.table({
+        'town': pyarrow.array([x['town'] for x in towns], pyarrow.string()),
+        **{name: pyarrow.array([x[name] for x in towns], pyarrow.float64()) for name in AGE_COLUMNS[1:]}
+    })
+    return _arrow_response(table)
@@ -0,0 +1,169 @@
+from bisect import bisect_left, insort
+from datetime import date, datetime
+from threading import Lock
+from typing import List, Dict, Optional, Iterable, Tuple, Sequence
+
+from flask import current_app
+
+from yandex_school import memprof, snapshots, stats
+from yandex_school.metrics import increment
+from yandex_school.storage import get_storage
+
+
+class BirthHistogram:
+    """
+    Number of citizens of an import per town and birth date. Every town keeps its birth dates as a sorted list
+    of ordinals and their counts in a dict, so moving a citizen to a date already present in the town is O(1).
+    Age percentiles for any reference date come from cumulative counts, citizens are never rescanned.
+    """
+
+    def __init__(self, rows: Iterable[Tuple[str, date, int]]):
+        """
+        :param rows: rows of town, birth_date, number of citizens
+        """
+        self.dates: Dict[str, List[int]] = {}
+        self.counts: Dict[str, Dict[int, int]] = {}
+        for town, birth_date, count in rows:
+            self.add(town, birth_date, count)
+
+    def add(self, town: str, birth_date: date, count: int = 1) -> None:
+        """
+        Changes number of citizens of a cell, empty cells are dropped
+        :param town: town of the cell
+        :param birth_date: birth date of the cell
+        :param count: change of the number of citizens, negative for removals
+        :return: None
+        """
+        ordinal = birth_date.toordinal()
+        counts = self.counts.setdefault(town, {})
+        if ordinal not in counts:
+            insort(self.dates.setdefault(town, []), ordinal)
+            counts[ordinal] = 0
+        counts[ordinal] += count
+        if counts[ordinal]:
+            return
+        del counts[ordinal]
+        dates = self.dates[town]
+        del dates[bisect_left(dates, ordinal)]
+        if not dates:
+            del self.counts[town], self.dates[town]
+
+    def remove(self, town: str, birth_date: date) -> None:
+        self.add(town, birth_date, -1)
+
+    def percentiles(self, today: date, names: Sequence[str] = stats.AGE_PERCENTILES) -> List[Dict]:
+        """
+        :param today: reference date for ages
+        :param names: percentile names, 'p' followed by percent
+        :return: list of {'town': town, <name>: age percentile, ...} sorted by town
+        """
+        import numpy
+
+        percents = numpy.array([int(x[1:]) for x in names])
+        result = []
+        for town in sorted(self.counts):
+            counts = self.counts[town]
+            # the latest birth date gives the youngest age, ages come out sorted ascending
+            ordinals = self.dates[town][::-1]
+            ages = stats.ages([date.fromordinal(x) for x in ordinals], today)
+            values = stats.histogram_percentiles(ages, numpy.fromiter((counts[x] for x in ordinals), numpy.int64,
+                                                                      len(ordinals)), percents)
+            result.append(dict(zip(('town', *names), (town, *values.tolist()))))
+        return result
+
+
+# (storage id, import_id) -> (version, histogram)
+cache = stats.StatsCache()
+_lock = Lock()
+
+
+def _histogram(storage, import_id: int, version: int) -> Tuple[BirthHistogram, bool]:
+    """
+    Fetches cached histogram of an import version or loads it from its snapshot or storage.
+    The lock is taken only around the cache, storage is read without it.
+    :param storage: storage of the import
+    :param import_id: requested import_id
+    :param version: import version read by the caller
+    :return: birth histogram and whether it belongs to the version, a change committed by any worker while
+    the histogram was read makes it newer than the version, it is neither cached nor may its result be
+    """
+    key = (id(storage), import_id)
+    with _lock:
+        entry = cache.get(key)
+        if entry is not None and entry[0] == version:
+            increment('histograms_cache_hits')
+            return entry[1], True
+
+    increment('histograms_cache_misses')
+    with memprof.phase('fetch'):
+        snapshot = snapshots.get(import_id, version)
+        if snapshot is not None:
+            histogram, consistent = BirthHistogram(snapshot.birth_histogram()), True
+        else:
+            histogram = BirthHistogram(storage.birth_histogram(import_id))
+            # version is bumped in the transaction of the change, unchanged version means unchanged cells
+            consistent = storage.import_version(import_id) == version
+    if consistent:
+        with _lock:
+            entry = cache.get(key)
+            if entry is None or entry[0] < version:
+                cache.put(key, (version, histogram), current_app.config['HISTOGRAMS_CACHE_SIZE'])
+    return histogram, consistent
+
+
+def age_percentiles(import_id: int) -> Optional[List[Dict]]:
+    """
+    Computes or fetches cached age percentiles per town of an import
+    :param import_id: requested import_id
+    :return: list of {'town', 'p50', 'p75', 'p99'} or None if import does not exist
+    """
+    storage = get_storage()
+    today = datetime.utcnow().date()
+    version = storage.import_version(import_id)
+    if version is None:
+        return None
+
+    key = (id(storage), import_id, version, stats.AGE_PERCENTILES, today)
+    result = stats.cache.get(key)
+    if result is not None:
+        increment('town_stats_cache_hits')
+        return result
+
+    increment('town_stats_cache_misses')
+    histogram, consistent = _histogram(storage, import_id, version)
+    # cached histograms are moved by move_cells under the lock, a result of a later version cached under
+    # this one is never served stale, versions only grow
+    with _lock, memprof.phase('compute'):
+        result = histogram.percentiles(today)
+    if not result:
+        return None
+    if consistent:
+        stats.cache.put(key, result, current_app.config['TOWN_STATS_CACHE_SIZE'])
+    return result
+
+
+def move_cells(import_id: int, version: int, cells: Dict[Tuple[str, date], int]) -> None:
+    """
+    Brings cached histogram to the import version a change has committed. Storage is not touched,
+    the change has already moved the stored cells and bumped the version in its own transaction.
+    A gap of versions means another worker has changed the import, the cached histogram is dropped then.
+    :param import_id: changed import_id
+    :param version: import version after the change
+    :param cells: (town, birth_date) -> change of count made by the change
+    :return: None
+    """
+    key = (id(get_storage()), import_id)
+    with _lock:
+        entry = cache.get(key)
+        # nothing cached or already loaded after the change
+        if entry is None or entry[0] >= version:
+            return
+        if entry[0] != version - 1:
+            cache.discard(key)
+            increment('histograms_invalidations')
+            return
+
+        histogram = entry[1]
+        for (town, birth_date), change in cells.items():
+            histogram.add(town, birth_date, change)
+        cache.put(key, (version, histogram), current_app.config['HISTOGRAMS_CACHE_SIZE'])
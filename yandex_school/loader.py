@@ -0,0 +1,322 @@
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime
+from multiprocessing import Pool
+from time import perf_counter
+from typing import Iterator, Dict, List, Tuple, Optional, TextIO
+
+import psycopg2
+from marshmallow import ValidationError
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+from yandex_school import dedup
+from yandex_school.app import app
+from yandex_school.config import LOGGING_FORMAT
+from yandex_school.validation import citizenSchema, validate_relatives
+
+"""
+    Offline bulk loader. Every dump file becomes one import.
+
+    Usage:
+        python3 -m yandex_school.loader dump1.ndjson dump2.csv --jobs 4 --state loader_state.json
+
+    NDJSON files contain one citizen object per line, same as in POST /imports body.
+    CSV files need a header with citizen fields, relatives are separated by spaces or semicolons.
+    Each file is loaded in a single transaction with COPY, files are processed in parallel processes.
+    Loaded files are recorded in the state file, rerunning the same command skips them.
+
+    COPY writes to the application database directly, so the loader refuses to run with any storage but 'sql':
+    a sharded storage routes imports by their ids, which the loader can not follow. Content hashes are stored
+    unless IMPORT_DEDUP_POLICY is 'always_new', snapshots are written by the first read of a loaded import.
+"""
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_EVERY = 10000
+
+COPY_COLUMNS = ('import_id', 'citizen_id', 'town', 'street', 'building', 'apartment', 'name', 'birth_date', 'gender')
+INTEGER_FIELDS = ('citizen_id', 'apartment')
+
+
+class LoaderError(Exception):
+    """
+    File can not be loaded, message tells where and why
+    """
+
+
+def read_ndjson(file: TextIO) -> Iterator[Tuple[int, Dict]]:
+    """
+    :param file: opened NDJSON file
+    :return: iterator of (line number, raw citizen)
+    """
+    for line_number, line in enumerate(file, 1):
+        if line.strip():
+            yield line_number, json.loads(line)
+
+
+def read_csv(file: TextIO) -> Iterator[Tuple[int, Dict]]:
+    """
+    Reads CSV rows and converts them to the same shape as JSON citizens
+    :param file: opened CSV file
+    :return: iterator of (line number, raw citizen)
+    """
+    reader = csv.DictReader(file)
+    for row in reader:
+        for field in INTEGER_FIELDS:
+            if row.get(field, '').strip().isdigit():
+                row[field] = int(row[field])
+        relatives = row.get('relatives')
+        if relatives is not None:
+            row['relatives'] = [int(x) if x.isdigit() else x for x in re.split(r'[\s;]+', relatives.strip()) if x]
+        yield reader.line_num, row
+
+
+def _copy_value(value) -> str:
+    """
+    :param value: column value
+    :return: value in COPY text format
+    """
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def load_file(path: str, database_uri: str,
+              store_hash: bool = False) -> Tuple[str, Optional[int], int, float, Optional[str]]:
+    """
+    Validates a dump file and loads it as a new import in one transaction
+    :param path: dump file path, format is chosen by extension: .csv or anything else for NDJSON
+    :param database_uri: database to load into
+    :param store_hash: [OPTIONAL] store content hash of the import, so uploads of the same data deduplicate to it
+    :return: path, import_id or None, rows loaded, seconds spent, error message or None
+    """
+    started = perf_counter()
+    reader = read_csv if path.endswith('.csv') else read_ndjson
+    relatives_map: Dict[int, List[int]] = {}
+    # citizen_id -> offset and length of its canonical form in the hash spool file
+    hash_parts: Dict[int, Tuple[int, int]] = {}
+    count = 0
+
+    try:
+        with open(path, newline='', encoding='utf-8') as file, \
+                tempfile.TemporaryFile('w+', encoding='utf-8') as citizens_buffer, \
+                tempfile.TemporaryFile('w+b') as hash_buffer:
+            # first pass: validate every row, keep only relatives in memory, citizen rows go to a spool file
+            for line_number, raw in reader(file):
+                try:
+                    citizen = citizenSchema.load(raw)
+                except ValidationError as ex:
+                    raise LoaderError(f'{path}:{line_number}: {ex.messages}')
+                except (TypeError, AttributeError):
+                    raise LoaderError(f'{path}:{line_number}: malformed citizen')
+                relatives_map[citizen['citizen_id']] = citizen['relatives']
+                citizens_buffer.write('\t'.join(_copy_value(citizen[x]) for x in COPY_COLUMNS[1:]))
+                citizens_buffer.write('\n')
+                if store_hash:
+                    part = dedup.canonical_citizen(citizen)
+                    hash_parts[citizen['citizen_id']] = (hash_buffer.tell(), len(part))
+                    hash_buffer.write(part)
+                count += 1
+                if count % PROGRESS_EVERY == 0:
+                    logger.info(f'{path}: validated {count} rows, {count / (perf_counter() - started):.0f} rows/sec')
+
+            if not count:
+                raise LoaderError(f'{path}: no citizens')
+
+            try:
+                # relatives_map keys are unique already, duplicates show up as a shorter map
+                if len(relatives_map) != count:
+                    raise ValidationError('Duplicate citizen_id found!')
+                citizens = [{'citizen_id': k, 'relatives': v} for k, v in relatives_map.items()]
+                relative_links = validate_relatives(citizens)
+            except ValidationError as ex:
+                raise LoaderError(f'{path}: {ex.messages}')
+            del citizens, relatives_map
+
+            digest = None
+            if store_hash:
+                # same as dedup.citizens_digest, citizens in citizen_id order
+                digest = hashlib.sha256()
+                for citizen_id in sorted(hash_parts):
+                    offset, length = hash_parts[citizen_id]
+                    hash_buffer.seek(offset)
+                    digest.update(hash_buffer.read(length))
+                digest = digest.hexdigest()
+
+            # second pass: push everything in one transaction
+            import_id = _copy(database_uri, citizens_buffer, relative_links, digest)
+    except LoaderError as ex:
+        return path, None, count, perf_counter() - started, str(ex)
+    except (OSError, ValueError, psycopg2.Error) as ex:
+        return path, None, count, perf_counter() - started, f'{path}: {ex}'
+
+    return path, import_id, count, perf_counter() - started, None
+
+
+def _copy(database_uri: str, citizens_buffer: TextIO, relative_links: List[Tuple[int, int]],
+          digest: Optional[str] = None) -> int:
+    """
+    Creates import, copies citizens and relationships into it and counts its birth histogram
+    :param database_uri: database to load into
+    :param citizens_buffer: spool file of citizen rows in COPY text format without import_id
+    :param relative_links: relationship links list of citizen_ids
+    :param digest: [OPTIONAL] content hash of the import to store
+    :return: import_id
+    """
+    # a private engine, pool inherited from parent process must not be touched after fork
+    engine = create_engine(database_uri, poolclass=NullPool)
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('INSERT INTO import DEFAULT VALUES RETURNING id')
+            import_id = cursor.fetchone()[0]
+
+            # import_id is the same for every row, stream the spool file with it prepended
+            citizens_buffer.seek(0)
+            cursor.copy_expert(f'COPY citizen ({", ".join(COPY_COLUMNS)}) FROM STDIN',
+                               _Prefixed(citizens_buffer, f'{import_id}\t'))
+
+            if relative_links:
+                # map citizen_ids to database ids of the freshly copied citizens
+                cursor.execute('SELECT citizen_id, id FROM citizen WHERE import_id = %s', (import_id,))
+                id_map = dict(cursor.fetchall())
+                with tempfile.TemporaryFile('w+') as links_buffer:
+                    links_buffer.writelines(f'{id_map[citizen]}\t{id_map[relative]}\n'
+                                            for citizen, relative in relative_links)
+                    links_buffer.seek(0)
+                    cursor.copy_expert('COPY relative (citizen_id, relative_id) FROM STDIN', links_buffer)
+
+            cursor.execute('INSERT INTO birth_histogram (import_id, town, birth_date, count) '
+                           'SELECT import_id, town, birth_date, count(*) FROM citizen WHERE import_id = %s '
+                           'GROUP BY import_id, town, birth_date', (import_id,))
+            if digest:
+                cursor.execute('INSERT INTO import_hash (import_id, hash, created) VALUES (%s, %s, %s)',
+                               (import_id, digest, datetime.utcnow()))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+        engine.dispose()
+    return import_id
+
+
+class _Prefixed:
+    """
+    File-like reader prepending a prefix to every line, feeds COPY without rewriting the spool file
+    """
+
+    def __init__(self, file: TextIO, prefix: str):
+        self.file = file
+        self.prefix = prefix
+
+    def readline(self, size: int = -1) -> str:
+        line = self.file.readline()
+        return self.prefix + line if line else line
+
+    def read(self, size: int = -1) -> str:
+        lines = self.file.readlines(size if size > 0 else -1)
+        return ''.join(self.prefix + line for line in lines)
+
+
+def read_state(path: str) -> Dict[str, int]:
+    """
+    :param path: state file path
+    :return: loaded files: absolute path -> import_id
+    """
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_state(path: str, state: Dict[str, int]) -> None:
+    """
+    Atomically replaces state file
+    :param path: state file path
+    :param state: loaded files: absolute path -> import_id
+    :return: None
+    """
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(state, file, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def load_files(paths: List[str], jobs: int = 1, state_path: Optional[str] = None,
+               database_uri: Optional[str] = None) -> Tuple[Dict[str, int], Dict[str, str]]:
+    """
+    Loads dump files in parallel, skipping files already recorded in the state file
+    :param paths: dump files
+    :param jobs: number of worker processes
+    :param state_path: [OPTIONAL] state file for resuming
+    :param database_uri: [OPTIONAL] database to load into, application database by default
+    :return: loaded files (absolute path -> import_id), failed files (absolute path -> error)
+    :raises LoaderError: if the application storage is not 'sql'
+    """
+    backend = app.config['STORAGE_BACKEND']
+    if backend != 'sql':
+        raise LoaderError(f"{backend} storage is configured, the loader writes to a single Postgres database only, "
+                          f"run it with STORAGE_BACKEND=sql --database-uri <shard> or upload through POST /imports")
+    database_uri = database_uri or app.config['SQLALCHEMY_DATABASE_URI']
+    store_hash = app.config['IMPORT_DEDUP_POLICY'] != dedup.ALWAYS_NEW
+    state = read_state(state_path) if state_path else {}
+    pending = [x for x in map(os.path.abspath, paths) if x not in state]
+    for path in set(map(os.path.abspath, paths)) - set(pending):
+        logger.info(f'{path}: already loaded as import {state[path]}, skipping')
+
+    failed = {}
+    total_rows, started = 0, perf_counter()
+    with Pool(max(1, min(jobs, len(pending) or 1))) as pool:
+        results = pool.imap_unordered(_load_file_star, [(x, database_uri, store_hash) for x in pending])
+        for path, import_id, count, seconds, error in results:
+            if error:
+                failed[path] = error
+                logger.error(error)
+                continue
+            state[path] = import_id
+            if state_path:
+                write_state(state_path, state)
+            total_rows += count
+            logger.info(f'{path}: import {import_id}, {count} rows in {seconds:.1f}s, '
+                        f'{count / seconds:.0f} rows/sec')
+
+    elapsed = perf_counter() - started
+    logger.info(f'loaded {len(pending) - len(failed)}/{len(pending)} files, {total_rows} rows in {elapsed:.1f}s, '
+                f'{total_rows / elapsed if elapsed else 0:.0f} rows/sec')
+    return state, failed
+
+
+def _load_file_star(args: Tuple[str, str, bool]):
+    return load_file(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loads NDJSON/CSV citizen dumps as imports')
+    parser.add_argument('files', nargs='+', help='dump files, one import per file')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='parallel worker processes')
+    parser.add_argument('--state', default='loader_state.json', help='state file to resume from')
+    parser.add_argument('--database-uri', help='database to load into, application database by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=LOGGING_FORMAT)
+    try:
+        state, failed = load_files(args.files, args.jobs, args.state, args.database_uri)
+    except LoaderError as ex:
+        logger.error(ex)
+        sys.exit(2)
+    for path in map(os.path.abspath, args.files):
+        if path in state:
+            print(f'{path}\t{state[path]}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import logging
+import random
+import tracemalloc
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, Iterator, Optional
+
+from flask import Flask, current_app, g, request, has_request_context
+
+from yandex_school.metrics import increment, register_gauge
+
+"""
+    Opt-in memory profiling of requests.
+
+    A request is profiled when MEMORY_PROFILING is on and either carries the MEMORY_PROFILING_HEADER header
+    or gets picked by MEMORY_PROFILING_SAMPLE_RATE. Resources mark their phases with phase(), every phase
+    records its peak traced allocation above the memory in use when it started. With MEMORY_PROFILING_TOP
+    the allocation sites which grew the most during a phase are logged as well.
+    tracemalloc traces the whole process, so concurrent requests of a threaded worker inflate each other.
+"""
+
+logger = logging.getLogger(__name__)
+
+# endpoint -> last recorded profile
+profiles: Dict[str, Dict] = {}
+
+_lock = Lock()
+# number of requests being profiled, tracing started here stops with the last one
+_active = 0
+_started = False
+
+
+class Profile:
+    """
+    Memory profile of a single request
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.start = tracemalloc.get_traced_memory()[0]
+        self.peak = 0
+        self.phases: Dict[str, int] = {}
+
+    def as_dict(self) -> Dict:
+        return {'peak': self.peak, 'phases': dict(self.phases)}
+
+
+def _current() -> Optional[Profile]:
+    if not has_request_context():
+        return None
+    return g.get('memory_profile')
+
+
+def _top(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot, count: int) -> str:
+    """
+    :param before: snapshot taken when phase started
+    :param after: snapshot taken when phase ended
+    :param count: number of allocation sites
+    :return: printable list of allocation sites which grew the most
+    """
+    exclude = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+    stats = after.filter_traces(exclude).compare_to(before.filter_traces(exclude), 'lineno')
+    return '\n'.join(f'  {stat}' for stat in stats[:count])
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    Records peak traced allocation of the block as a phase of the profiled request.
+    Does nothing if the request is not profiled.
+    :param name: phase name
+    :return: context manager
+    """
+    profile = _current()
+    if profile is None:
+        yield
+        return
+
+    top = current_app.config['MEMORY_PROFILING_TOP']
+    before = tracemalloc.take_snapshot() if top else None
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        peak = tracemalloc.get_traced_memory()[1]
+        profile.phases[name] = peak - current
+        profile.peak = max(profile.peak, peak - profile.start)
+        if top:
+            logger.info(f'{profile.endpoint}.{name}: peak {peak - current} bytes, top allocations:\n'
+                        f'{_top(before, tracemalloc.take_snapshot(), top)}')
+
+
+def before_request():
+    """
+    Starts profiling of picked requests
+    """
+    global _active, _started
+    if not current_app.config['MEMORY_PROFILING'] or request.endpoint is None:
+        return
+    if current_app.config['MEMORY_PROFILING_HEADER'] not in request.headers and \
+            random.random() >= current_app.config['MEMORY_PROFILING_SAMPLE_RATE']:
+        return
+
+    with _lock:
+        if not _active and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started = True
+        _active += 1
+    g.memory_profile = Profile(request.endpoint)
+
+
+def teardown_request(exception=None):
+    """
+    Records and logs the profile of a finished request
+    """
+    global _active, _started
+    profile = g.pop('memory_profile', None)
+    if profile is None:
+        return
+
+    profiles[profile.endpoint] = profile.as_dict()
+    increment(f'memory_profiled.{profile.endpoint}')
+    logger.info(f'{profile.endpoint}: peak {profile.peak} bytes, phases {profile.phases}')
+    with _lock:
+        _active -= 1
+        if not _active and _started:
+            tracemalloc.stop()
+            _started = False
+
+
+def init_app(app: Flask) -> None:
+    """
+    Installs memory profiling hooks
+    :param app: application
+    :return: None
+    """
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
+    register_gauge('memory', lambda: profiles)
@@ -0,0 +1,73 @@
+from collections import defaultdict
+from typing import Dict, Callable, Any
+
+from flask_restful import Resource
+
+"""
+    Process-local counters. Every gunicorn worker keeps its own set,
+    so the numbers served by /metrics are per worker.
+"""
+counters: Dict[str, int] = defaultdict(int)
+
+"""
+    Process-local timings: name -> count, total and max duration in seconds
+"""
+timings: Dict[str, Dict[str, float]] = {}
+
+
+"""
+    Values computed on demand when /metrics is requested
+"""
+gauges: Dict[str, Callable[[], Any]] = {}
+
+
+def register_gauge(name: str, function: Callable[[], Any]) -> None:
+    """
+    Registers a function computing current value of a gauge
+    :param name: gauge name
+    :param function: function without arguments returning json serializable value
+    :return: None
+    """
+    gauges[name] = function
+
+
+def increment(name: str, value: int = 1) -> None:
+    """
+    Increments named counter
+    :param name: counter name
+    :param value: increment value
+    :return: None
+    """
+    counters[name] += value
+
+
+def observe(name: str, seconds: float) -> None:
+    """
+    Records a duration of a named operation
+    :param name: operation name
+    :param seconds: duration
+    :return: None
+    """
+    try:
+        timing = timings[name]
+    except KeyError:
+        timing = timings[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+    timing['count'] += 1
+    timing['total'] += seconds
+    if seconds > timing['max']:
+        timing['max'] = seconds
+
+
+class Metrics(Resource):
+    """
+        Serves /metrics endpoint
+    """
+
+    @staticmethod
+    def get():
+        """
+        Get request handler
+        """
+        return {'data': {'counters': dict(counters),
+                         'timings': timings,
+                         'gauges': {name: function() for name, function in gauges.items()}}}, 200
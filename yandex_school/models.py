@@ -10,15 +10,18 @@ from yandex_school import db
 
 """
     Presents an import entity. Serves as an import_id counter.
+    Version is incremented on every change of the import data, derived data is cached by it.
 """
 Import = db.Table(
     'import',
     db.metadata,
-    db.Column('id', db.Integer, primary_key=True)
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('version', db.Integer, nullable=False, server_default='0')
 )
 
 """
-    Presents a citizen entity, stores all the citizen data
+    Presents a citizen entity, stores all the citizen data.
+    Citizens are looked up by (import_id, citizen_id), which is unique.
 """
 Citizen = db.Table(
     'citizen',
@@ -32,18 +35,46 @@ Citizen = db.Table(
     db.Column('apartment', db.Integer, nullable=False),
     db.Column('name', db.String, nullable=False),
     db.Column('birth_date', db.Date, nullable=False),
-    db.Column('gender', db.String, nullable=False)
+    db.Column('gender', db.String, nullable=False),
+    db.Index('citizen_import_id_citizen_id', 'import_id', 'citizen_id', unique=True)
 )
 
 """
     Relationship entry between citizens. Consists of a composite primary key: citizen_id, relative_id both
-    referencing citizen's id field.
+    referencing citizen's id field. relative_id is indexed too, so deleting a citizen does not scan the table
+    for references to it.
 """
 Relative = db.Table(
     'relative',
     db.metadata,
     db.Column('citizen_id', db.Integer, db.ForeignKey('citizen.id'), primary_key=True),
-    db.Column('relative_id', db.Integer, db.ForeignKey('citizen.id'), primary_key=True)
+    db.Column('relative_id', db.Integer, db.ForeignKey('citizen.id'), primary_key=True),
+    db.Index('relative_relative_id', 'relative_id')
+)
+
+"""
+    Content hash of an import's citizens. Used to detect repeated uploads of the same data.
+    One entry per import, hash is indexed for lookups.
+"""
+ImportHash = db.Table(
+    'import_hash',
+    db.metadata,
+    db.Column('import_id', db.Integer, db.ForeignKey(Import.c.id), primary_key=True),
+    db.Column('hash', db.String(64), nullable=False, index=True),
+    db.Column('created', db.DateTime, nullable=False)
+)
+
+"""
+    Number of citizens of an import per town and birth date. Derived from the citizen table,
+    kept in step with it on every change and rebuildable from it at any time.
+"""
+BirthHistogram = db.Table(
+    'birth_histogram',
+    db.metadata,
+    db.Column('import_id', db.Integer, db.ForeignKey(Import.c.id), primary_key=True),
+    db.Column('town', db.String, primary_key=True),
+    db.Column('birth_date', db.Date, primary_key=True),
+    db.Column('count', db.Integer, nullable=False)
 )
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+import math
+import os
+from time import perf_counter
+from typing import Dict, Any, Callable
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from yandex_school import config
+from yandex_school.metrics import increment, observe, register_gauge
+
+"""
+    Connection pools of the worker processes.
+
+    Every worker gets an equal share of the connection budget of a database, so the pools of all the workers
+    together never exceed it. Connections are pinged on checkout, connections inherited over fork are thrown away
+    without closing the parent's sockets. Checkout waits, overflow connections and timeouts are counted,
+    pool occupancy is served as 'db_pool' gauge.
+"""
+
+# engine name -> function returning the engine, pools of these engines are shown in the gauge
+engines: Dict[str, Callable[[], Engine]] = {}
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    Queue pool measuring how long checkouts wait for a connection
+    """
+
+    def _do_get(self):
+        started = perf_counter()
+        overflow = self._overflow
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            increment('db_pool_timeouts')
+            raise
+        finally:
+            observe('db_pool_checkout_wait', perf_counter() - started)
+        # overflow counts from -pool_size, connections opened above zero are the overflow ones
+        if self._overflow > overflow and self._overflow > 0:
+            increment('db_pool_overflows')
+        return connection
+
+    def status(self) -> Dict[str, int]:
+        return {'size': self.size(), 'checked_out': self.checkedout(), 'idle': self.checkedin(),
+                'overflow': max(0, self.overflow())}
+
+
+def _on_connect(dbapi_connection, connection_record) -> None:
+    connection_record.info['pid'] = os.getpid()
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+    # the connection was opened by the parent process (e.g. the preloading gunicorn master), its socket must be
+    # left to the parent, closing it here or disposing the pool in the worker would break the parent's connection
+    if connection_record.info.get('pid') != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        increment('db_pool_fork_recycles')
+        raise exc.DisconnectionError('Connection belongs to another process')
+
+
+def _on_invalidate(dbapi_connection, connection_record, exception) -> None:
+    increment('db_pool_invalidations')
+
+
+# class level listeners survive pool re-creation by engine.dispose()
+event.listen(InstrumentedQueuePool, 'connect', _on_connect)
+event.listen(InstrumentedQueuePool, 'checkout', _on_checkout)
+event.listen(InstrumentedQueuePool, 'invalidate', _on_invalidate)
+
+
+def pool_size(budget: int, workers: int, overflow_share: float) -> Dict[str, int]:
+    """
+    Splits connection budget of a database between workers
+    :param budget: connections all the workers may hold together
+    :param workers: number of worker processes
+    :param overflow_share: share of a worker's connections opened only under load
+    :return: pool_size and max_overflow of a worker
+    """
+    connections = max(1, budget // max(1, workers))
+    size = max(1, math.ceil(connections * (1 - overflow_share)))
+    return {'pool_size': size, 'max_overflow': max(0, connections - size)}
+
+
+def engine_options(settings: Any = config) -> Dict[str, Any]:
+    """
+    :param settings: object or mapping with pool settings, config module by default
+    :return: create_engine keyword arguments of a worker pool
+    """
+    get = settings.get if isinstance(settings, dict) else lambda name: getattr(settings, name)
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_pre_ping': True,
+        'pool_timeout': get('DB_POOL_TIMEOUT'),
+        'pool_recycle': get('DB_POOL_RECYCLE'),
+        **pool_size(get('DB_CONNECTION_BUDGET'), get('DB_WORKERS'), get('DB_POOL_OVERFLOW_SHARE')),
+    }
+
+
+def register(name: str, engine: Callable[[], Engine]) -> None:
+    """
+    Publishes occupancy of an engine's pool
+    :param name: engine name in the gauge
+    :param engine: function returning the engine, engines may be re-created when configuration changes
+    :return: None
+    """
+    engines[name] = engine
+
+
+def _status() -> Dict[str, Dict[str, int]]:
+    result = {}
+    for name, engine in engines.items():
+        pool = engine().pool
+        if isinstance(pool, InstrumentedQueuePool):
+            result[name] = pool.status()
+    return result
+
+
+register_gauge('db_pool', _status)
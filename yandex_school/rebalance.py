@@ -0,0 +1,146 @@
+import argparse
+import logging
+from typing import List, Tuple
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+
+from yandex_school import db
+from yandex_school.app import app
+from yandex_school.config import LOGGING_FORMAT
+from yandex_school.models import Import, Citizen, Relative, ImportHash, BirthHistogram
+from yandex_school.storage.sharded import shard_of, allocate_import_ids
+
+"""
+    Prepares shard databases and moves imports to the shards owning them.
+
+    Usage:
+        python3 -m yandex_school.rebalance postgresql://.../shard0 postgresql://.../shard1 postgresql://.../shard2
+
+    Shards are listed in their new order, SHARDS from config.py by default. Every database holding imports
+    must be in the list. Missing tables are created, every import found outside of its owner shard is copied
+    there in one transaction keeping its id and then deleted from the old shard, import id sequences are
+    restarted past the largest import id. Rerunning after a failure completes interrupted moves.
+    The application must not write to the shards while rebalancing.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def plan_moves(engines: List[Engine]) -> List[Tuple[int, int, int]]:
+    """
+    :param engines: engines of the shard databases, in shard order
+    :return: (import_id, current shard, owner shard) of every misplaced import, ordered by import_id
+    """
+    moves = []
+    for index, engine in enumerate(engines):
+        for import_id, in engine.execute(db.select([Import.c.id]).order_by(Import.c.id)).fetchall():
+            owner = shard_of(import_id, len(engines))
+            if owner != index:
+                moves.append((import_id, index, owner))
+    return sorted(moves)
+
+
+def move_import(source: Engine, target: Engine, import_id: int) -> int:
+    """
+    Copies an import with its relationships, hash and birth histogram to the target database,
+    then deletes it from the source
+    :param source: engine of the database holding the import
+    :param target: engine of the database to move the import to
+    :param import_id: import to move
+    :return: number of moved citizens
+    """
+    relative = Citizen.alias('relative_citizen')
+    with source.connect() as connection:
+        version = connection.execute(db.select([Import.c.version]).where(Import.c.id == import_id)).scalar()
+        citizens = connection.execute(
+            db.select([x for x in Citizen.c if x.name != 'id']).where(Citizen.c.import_id == import_id)
+        ).fetchall()
+        pairs = connection.execute(
+            db.select([Citizen.c.citizen_id, relative.c.citizen_id])
+            .select_from(Relative.join(Citizen, Citizen.c.id == Relative.c.citizen_id)
+                         .join(relative, relative.c.id == Relative.c.relative_id))
+            .where(Citizen.c.import_id == import_id)
+        ).fetchall()
+        hashes = connection.execute(db.select([ImportHash]).where(ImportHash.c.import_id == import_id)).fetchall()
+
+    with target.begin() as connection:
+        # a copy left by an interrupted run is complete, transaction either committed or not
+        if connection.execute(db.select([Import.c.id]).where(Import.c.id == import_id)).scalar() is None:
+            connection.execute(Import.insert(), [{'id': import_id, 'version': version}])
+            if citizens:
+                connection.execute(Citizen.insert(), [dict(x) for x in citizens])
+            if pairs:
+                id_map = dict(connection.execute(
+                    db.select([Citizen.c.citizen_id, Citizen.c.id]).where(Citizen.c.import_id == import_id)
+                ).fetchall())
+                connection.execute(Relative.insert(), [{'citizen_id': id_map[citizen], 'relative_id': id_map[other]}
+                                                       for citizen, other in pairs])
+            if hashes:
+                connection.execute(ImportHash.insert(), [dict(x) for x in hashes])
+            # recounted from the copied citizens rather than copied
+            connection.execute(BirthHistogram.insert().from_select(
+                ['import_id', 'town', 'birth_date', 'count'],
+                db.select([Citizen.c.import_id, Citizen.c.town, Citizen.c.birth_date, func.count()])
+                .where(Citizen.c.import_id == import_id)
+                .group_by(Citizen.c.import_id, Citizen.c.town, Citizen.c.birth_date)
+            ))
+
+    with source.begin() as connection:
+        # both sides of a relationship belong to the same import
+        connection.execute(Relative.delete().where(
+            Relative.c.citizen_id.in_(db.select([Citizen.c.id]).where(Citizen.c.import_id == import_id))
+        ))
+        connection.execute(ImportHash.delete().where(ImportHash.c.import_id == import_id))
+        connection.execute(BirthHistogram.delete().where(BirthHistogram.c.import_id == import_id))
+        connection.execute(Citizen.delete().where(Citizen.c.import_id == import_id))
+        connection.execute(Import.delete().where(Import.c.id == import_id))
+    return len(citizens)
+
+
+def rebalance(uris: List[str], dry_run: bool = False) -> List[Tuple[int, int, int]]:
+    """
+    Creates missing tables, moves misplaced imports to their owner shards and restarts import id sequences
+    :param uris: database URIs of the shards, in shard order
+    :param dry_run: only report the moves
+    :return: (import_id, old shard, new shard) of every moved import
+    """
+    # a private engine per shard, nothing else runs in this process
+    engines = [create_engine(uri, poolclass=NullPool) for uri in uris]
+    try:
+        for engine in engines:
+            db.metadata.create_all(engine)
+        moves = plan_moves(engines)
+        if dry_run:
+            return moves
+
+        for import_id, source, target in moves:
+            count = move_import(engines[source], engines[target], import_id)
+            logger.info(f'import {import_id}: {count} citizens moved from shard {source} to shard {target}')
+
+        last = max(engine.execute(db.select([func.max(Import.c.id)])).scalar() or 0 for engine in engines)
+        for index, engine in enumerate(engines):
+            allocate_import_ids(engine, index, len(engines), last)
+        return moves
+    finally:
+        for engine in engines:
+            engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Moves imports to the shards owning them')
+    parser.add_argument('shards', nargs='*', help='database URIs of the shards in shard order, SHARDS by default')
+    parser.add_argument('--dry-run', action='store_true', help='only print the moves')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=LOGGING_FORMAT)
+    uris = args.shards or app.config['SHARDS']
+    if not uris:
+        parser.error('no shards given and SHARDS is empty')
+    for import_id, source, target in rebalance(uris, args.dry_run):
+        print(f'{import_id}\t{source}\t{target}')
+
+
+if __name__ == '__main__':
+    main()
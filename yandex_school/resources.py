@@ -1,15 +1,14 @@
-from typing import List, Dict, Tuple
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
+from typing import List, Dict
 
-from flask import request
+from flask import request, current_app
 from flask_restful import Resource
 from marshmallow import ValidationError
-import numpy
 
-from yandex_school import db
-from yandex_school.models import Import, Citizen, Relative
-from yandex_school.validation import citizenSchema, citizensSchema, validate_relatives, validate_citizen_ids
+from yandex_school import aggregation, cpuprof, dedup, diff, families, formats, histograms, memprof, rows, \
+    snapshots, stats
+from yandex_school.storage import get_storage
+from yandex_school.validation import citizenSchema, citizensSchema, deltaSchema, validate_relatives, \
+    validate_citizen_ids
 
 
 class CreateImport(Resource):
@@ -17,40 +16,25 @@ class CreateImport(Resource):
         Serves /imports endpoint
     """
 
-    @staticmethod
-    def store_relationships(import_id: int, relative_links: List[Tuple]) -> None:
-        """
-        Maps citizen_ids to database ids, pushes relationships into database
-        :param import_id: id of current import
-        :param relative_links: relationship links list of citizen_ids
-        :return: None
-        """
-        # get citizens ids of the current import
-        id_list = db.engine.execute(
-            db.select([Citizen.c.id, Citizen.c.citizen_id]).where(Citizen.c.import_id == import_id)
-        ).fetchall()
-        # map database ids to citizen ids
-        rev_id_map = {k: v for v, k in id_list}
-        # create relationships
-        relationships = [{'citizen_id': rev_id_map[citizen], 'relative_id': rev_id_map[relative]}
-                         for citizen, relative in relative_links]
-        # push into database
-        db.engine.execute(Relative.insert(), relationships)
-
     def post(self):
         """
         Post request handler
         """
         try:
+            with memprof.phase('parse'):
+                body = request.json
             # validates data, returns objects
-            citizens = citizensSchema.load(request.json)
+            with memprof.phase('load'):
+                citizens = citizensSchema.load(body)
             # check if there are no citizens
             if not citizens:
                 raise ValidationError('No citizens were present in the request body')
-            # check if ids are correct
-            validate_citizen_ids(citizens)
-            # validates relatives, returns relationship tuples
-            relative_links = validate_relatives(citizens)
+            cpuprof.tag(citizens=len(citizens))
+            with memprof.phase('validate'):
+                # check if ids are correct
+                validate_citizen_ids(citizens)
+                # validates relatives, returns relationship tuples
+                relative_links = validate_relatives(citizens)
         except ValidationError as ex:
             return {'message': f'Validation error', 'errors': ex.messages}, 400
         except KeyError as ex:
@@ -58,135 +42,75 @@ class CreateImport(Resource):
         except TypeError as ex:
             return {'message': f'Malformed data', 'errors': ex}, 400
 
-        # putting new import record into db and getting resulting primary key back
-        import_id = db.engine.execute(Import.insert(), [{}]).inserted_primary_key[0]
-
-        # assigning IDs manually as bulk saving ignores
-        # relationships
-        for citizen in citizens:
-            citizen['import_id'] = import_id
-
-        # putting citizens into db
-        db.engine.execute(Citizen.insert(), citizens)
+        # retried uploads of the same data resolve to the already stored import
+        policy = current_app.config['IMPORT_DEDUP_POLICY']
+        if policy == dedup.ALWAYS_NEW:
+            with memprof.phase('store'):
+                import_id = get_storage().create_import(citizens, relative_links)
+        else:
+            with memprof.phase('dedup'):
+                digest = dedup.citizens_digest(citizens)
+            with memprof.phase('store'):
+                import_id, created = dedup.create_import(citizens, relative_links, digest, policy,
+                                                         current_app.config['IMPORT_DEDUP_WINDOW'])
+            if not created:
+                return {'data': {'import_id': import_id}}, 201
 
-        # store relationships only if they exist
-        if relative_links:
-            self.store_relationships(import_id, relative_links)
+        with memprof.phase('snapshot'):
+            snapshots.store(import_id, citizens)
 
         return {'data': {'import_id': import_id}}, 201
 
 
-class PatchCitizen(Resource):
+class ApplyDelta(Resource):
     """
-        Serves /imports/<int:import_id>/citizens/<int:citizen_id> endpoint
+        Serves /imports/<int:import_id>/delta endpoint
     """
 
-    @staticmethod
-    def get_relatives_diff(import_id: int, citizen_id: int, requested_relatives: list) -> Tuple[int, list, list]:
+    def post(self, import_id):
         """
-        Calculates relative changes to be made by request.
-        :param import_id: requested import_id
-        :param citizen_id: requested citizen_id
-        :param requested_relatives: proposed relatives, should be final state of the operation
-        :return: citizen's database id, list of new relatives, list of lost relatives. All ids are database ids.
+        Post request handler. Body holds citizens to insert or replace as a whole and citizen_ids to delete:
+        {"citizens": [...], "removed": [...]}
         """
+        storage = get_storage()
+        if storage.import_version(import_id) is None:
+            return {'message': f'import_id {import_id} not found'}, 404
 
-        def get_diff(cur: List[int], req: List[int]) -> Tuple[set, set]:
-            """
-            Sub-function for set difference operations
-            :param cur: current relatives
-            :param req: proposed relatives
-            :return: list of citizen_ids to be added and to be removed from relatives
-            """
-            cur, req, add, rem = set(cur), set(req), set(), set()
-            rem = cur - req
-            add = cur - rem ^ req
-            return add, rem
-
-        join = Citizen.outerjoin(Relative, Relative.c.citizen_id == Citizen.c.id)
-        raw_relatives = db.engine.execute(
-            db.select([Relative.c.relative_id])
-                .where(Citizen.c.import_id == import_id)
-                .where(Citizen.c.citizen_id == citizen_id)
-                .select_from(join)
-        ).fetchall()
-
-        id_list = db.engine.execute(
-            db.select([Citizen.c.id, Citizen.c.citizen_id]).where(Citizen.c.import_id == import_id)
-        )
-
-        id_map = {k: v for k, v in id_list}
-        rev_id_map = {k: v for v, k in id_map.items()}
-
-        # raises KeyError if citizen_id does not exist
-        db_citizen_id = rev_id_map[citizen_id]
-
-        if not all([citizen_id in rev_id_map for citizen_id in requested_relatives]):
-            raise ValidationError(f'Citizen relatives contain unexistent citizen_id')
-
-        current_relatives = list(map(id_map.get, *zip(*raw_relatives)))
-
-        add_list, rem_list = get_diff(current_relatives, requested_relatives)
-
-        add_list = list(map(rev_id_map.get, add_list))
-        rem_list = list(map(rev_id_map.get, rem_list))
-
-        add_links = []
-
-        for x in add_list:
-            add_links.append({'citizen_id': db_citizen_id, 'relative_id': x})
-            add_links.append({'citizen_id': x, 'relative_id': db_citizen_id})
-
-        return db_citizen_id, add_links, rem_list
-
-    def process_relatives(self, import_id: int, citizen_id: int, requested_relatives: list) -> int:
-        """
-        Pushes relationship changes into database
-        :param import_id: requested import_id
-        :param citizen_id: requested citizen_id
-        :param requested_relatives: proposed relatives, should be final state of the operation
-        :return: citizen's database id.
-        """
-        db_citizen_id, add_links, rem_list = self.get_relatives_diff(import_id, citizen_id, requested_relatives)
-
-        # remove lost relationships
-        if rem_list:
-            # one side
-            db.engine.execute(Relative.delete().where(db.and_(Relative.c.citizen_id == db_citizen_id,
-                                                              Relative.c.relative_id.in_(rem_list))))
-            # opposite side
-            db.engine.execute(Relative.delete().where(db.and_(Relative.c.citizen_id.in_(rem_list),
-                                                              Relative.c.relative_id == db_citizen_id)))
-        # add new relationships
-        if add_links:
-            db.engine.execute(Relative.insert(), add_links)
-
-        return db_citizen_id
+        try:
+            with memprof.phase('load'):
+                delta = deltaSchema.load(request.json)
+            citizens, removed = delta['citizens'], delta['removed']
+            if not citizens and not removed:
+                raise ValidationError('No changes were present in the request body')
+        except ValidationError as ex:
+            return {'message': f'Validation error', 'errors': ex.messages}, 400
+        except TypeError as ex:
+            return {'message': f'Malformed data', 'errors': ex}, 400
 
-    @staticmethod
-    def merge_relatives(citizen_relatives: list, id_list: List[int]) -> dict:
-        """
-        Maps database ids to citizen_ids and merges joined citizen relationships
-        rows from database into properly serializable format.
-        Converts citizen from raw format to a named dict as a side-effect.
-        :param citizen_relatives: list of RowProxy of citizen and relative data
-        :param id_list: list of ids to citizen_ids
-        :return: citizen dict with relatives
-        """
-        citizen_relatives = [dict(citizen_relative) for citizen_relative in citizen_relatives]
-        citizen = dict(citizen_relatives[0])
+        try:
+            with memprof.phase('store'):
+                # validated in the transaction of the write, against relatives no other change can alter meanwhile
+                result = storage.apply_delta(import_id, citizens, removed)
+        except ValidationError as ex:
+            return {'message': f'Validation error', 'errors': ex.messages}, 400
+        if result is None:
+            return {'message': f'import_id {import_id} not found'}, 404
+        histograms.move_cells(import_id, result['version'], result['cells'])
 
-        if citizen['relative_id']:
-            id_map = {k: v for k, v in id_list}
-            relatives = [id_map[entry['relative_id']] for entry in citizen_relatives]
-        else:
-            relatives = []
+        # import content has changed, it can not serve as a deduplication target anymore
+        dedup.forget(import_id)
+        families.apply_delta(import_id, result['version'], result['replaced_ids'],
+                             resized=bool(result['inserted'] or result['deleted']))
+        snapshots.invalidate(import_id)
 
-        citizen['relatives'] = relatives
+        return {'data': {'import_id': import_id, 'inserted': result['inserted'], 'replaced': result['replaced'],
+                         'deleted': result['deleted']}}, 200
 
-        del citizen['relative_id']
 
-        return citizen
+class PatchCitizen(Resource):
+    """
+        Serves /imports/<int:import_id>/citizens/<int:citizen_id> endpoint
+    """
 
     def patch(self, import_id, citizen_id):
         """
@@ -201,55 +125,29 @@ class PatchCitizen(Resource):
         except TypeError as ex:
             return {'message': f'Malformed data', 'errors': ex}, 400
 
+        if not citizen_part:
+            return {'message': 'Nothing to patch'}, 400
+
         if 'citizen_id' in citizen_part:
             return {'message': 'citizen_id can not be patched'}, 400
 
-        if 'relatives' in citizen_part:  # resolve relative link changes, update and get citizen by id
-            requested_relatives = citizen_part['relatives']
-            try:
-                db_citizen_id = self.process_relatives(import_id, citizen_id, requested_relatives)
-            except ValidationError as ex:
-                return {'message': f'Validation error', 'errors': ex.messages}, 400
-            except KeyError:
-                # can't tell whats exactly wrong as its up to database querying result being empty
-                # or did I just masked out a weird bug? Probably not a good solution.
-                return {'message': f'import_id {import_id} or citizen_id {citizen_id} not found'}, 404
-
-            if len(citizen_part) > 1:  # this means we do have something to update besides relatives
-                db.engine.execute(Citizen.update().where(Citizen.c.id == db_citizen_id), citizen_part)
-
-            citizen = db.engine.execute(db.select([Citizen]).where(Citizen.c.id == db_citizen_id)).fetchone()
-            response = citizenSchema.dump(citizen)
-            # I know, but this saves precious time
-            response['relatives'] = citizen_part['relatives']
-
-        else:  # update and get citizen by import_id and citizen_id as we don't know the absolute id
-
-            update_result = db.engine.execute(Citizen.update()
-                                              .where(Citizen.c.import_id == import_id)
-                                              .where(Citizen.c.citizen_id == citizen_id),
-                                              citizen_part
-                                              )
-
-            # a dirty way of citizen_id and import_id validation
-            # it relies on database to report 0 rows updated which means
-            # either of parameters are missing
-            if update_result.rowcount != 1:
-                return {'message': f'citizen_id or import_id not found'}, 404
-
-            join = Citizen.outerjoin(Relative, Relative.c.citizen_id == Citizen.c.id)
-            citizen_relatives = db.engine.execute(db.select([Citizen, Relative.c.relative_id])
-                                                  .where(Citizen.c.import_id == import_id)
-                                                  .where(Citizen.c.citizen_id == citizen_id)
-                                                  .select_from(join)).fetchall()
-
-            # get list of ids to citizen_ids to resolve relatives
-            id_list = db.engine.execute(
-                db.select([Citizen.c.id, Citizen.c.citizen_id]).where(Citizen.c.import_id == import_id)
-            ).fetchall()
-
-            citizen = self.merge_relatives(citizen_relatives, id_list)
-            response = citizenSchema.dump(citizen)
+        try:
+            # columns, relatives, histogram cells and version change in one transaction
+            result = get_storage().patch_citizen(import_id, citizen_id, citizen_part)
+        except ValidationError as ex:
+            return {'message': f'Validation error', 'errors': ex.messages}, 400
+        if result is None:
+            return {'message': f'import_id {import_id} or citizen_id {citizen_id} not found'}, 404
+
+        response = citizenSchema.dump(result['citizen'])
+        response['relatives'] = result['relatives']
+
+        version = result['version']
+        histograms.move_cells(import_id, version, result['cells'])
+        # import content has changed, it can not serve as a deduplication target anymore
+        dedup.forget(import_id)
+        snapshots.invalidate(import_id)
+        families.apply_patch(import_id, version, citizen_id, result['added'], result['removed'])
 
         return response, 200
 
@@ -263,27 +161,22 @@ class GetCitizens(Resource):
     def merge_by_relatives(raw_citizens: List) -> List[Dict]:
         """
         Maps database ids to citizen_ids and merges joined citizen relationships
-        rows from database into properly serializable format.
-        Converts citizens from raw format to named dicts as a side-effect.
-        :param raw_citizens: list of RowProxy
+        rows from database into serialized citizens.
+        :param raw_citizens: citizens_with_relatives rows ordered by citizen_id
         :return: list of citizens where each citizen is a dict
         """
-        prev_id = 0
-        citizens = [dict(raw_citizen) for raw_citizen in raw_citizens]
-        id_map = {citizen['id']: citizen['citizen_id'] for citizen in citizens}
+        citizen_id, relative_id = rows.CITIZEN_ID, rows.RELATIVE_ID
+        id_map = {row[rows.ID]: row[citizen_id] for row in raw_citizens}
         result = []
-        for citizen in citizens:
-            relative_id = citizen['relative_id']
-            if prev_id == citizen['citizen_id']:
-                result[-1]['relatives'].append(id_map[relative_id])
-            else:
-                del citizen['relative_id']
-                if relative_id:
-                    citizen['relatives'] = [id_map[relative_id]]
-                else:
-                    citizen['relatives'] = []
-                result.append(citizen)
-            prev_id = citizen['citizen_id']
+        prev_id = 0
+        relatives = None
+        for row in raw_citizens:
+            if prev_id != row[citizen_id]:
+                relatives = []
+                result.append(rows.citizen_json(row, relatives))
+                prev_id = row[citizen_id]
+            if row[relative_id]:
+                relatives.append(id_map[row[relative_id]])
         return result
 
     def get(self, import_id):
@@ -291,23 +184,26 @@ class GetCitizens(Resource):
         Get request handler
         """
 
-        join = Citizen.outerjoin(Relative, Relative.c.citizen_id == Citizen.c.id)
-        raw_citizens = db.engine.execute(
-            db.select([Citizen, Relative.c.relative_id])
-                .where(Citizen.c.import_id == import_id)
-                .order_by(Citizen.c.citizen_id).select_from(join)
-        ).fetchall()
-
-        # form relatives lists
-        citizens = self.merge_by_relatives(raw_citizens)
+        with memprof.phase('fetch'):
+            raw_citizens = get_storage().citizens_with_relatives(import_id)
 
         # looks like import_id not found database
         # this not the best way to check this, probably
         # but the idea was to reduce database queries amount
-        if not citizens:
+        if not raw_citizens:
             return {'message': f'no data found for import_id: {import_id}'}, 404
+        cpuprof.tag(citizens=lambda: len({row[rows.ID] for row in raw_citizens}))
+
+        with memprof.phase('build'):
+            # binary formats are built straight from rows
+            mimetype = formats.negotiate()
+            if mimetype == formats.ARROW:
+                return formats.citizens_arrow(raw_citizens)
+            if mimetype == formats.MSGPACK:
+                return formats.citizens_msgpack(raw_citizens)
 
-        return {'data': citizensSchema.dump(citizens)}
+            # form relatives lists
+            return {'data': self.merge_by_relatives(raw_citizens)}
 
 
 class GetBirthdays(Resource):
@@ -321,104 +217,122 @@ class GetBirthdays(Resource):
         Get request handler
         """
 
-        # resulting dict template
-        months_dict: Dict[int, List] = {x: [] for x in range(1, 13)}
+        # get ids, citizen_ids, birthdays, relatives, unless the import has got a snapshot
+        with memprof.phase('fetch'):
+            snapshot = snapshots.get(import_id)
+            raw_citizens = get_storage().birthday_rows(import_id) if snapshot is None else None
 
-        # get ids, citizen_ids, birthdays, relatives
-        join = Citizen.outerjoin(Relative, Relative.c.citizen_id == Citizen.c.id)
-        raw_citizens = db.engine.execute(
-            db.select([Citizen.c.id, Citizen.c.citizen_id, Citizen.c.birth_date, Relative.c.relative_id])
-                .where(Citizen.c.import_id == import_id)
-                .order_by(Citizen.c.citizen_id)
-                .select_from(join)
-        ).fetchall()
+        # empty database response or snapshot, an import emptied by a delta is not found either way
+        if not (len(snapshot.citizen_ids) if snapshot is not None else raw_citizens):
+            return {'message': f'import_id {import_id} not found'}, 404
+        cpuprof.tag(citizens=lambda: len(snapshot.citizen_ids) if snapshot is not None
+                    else len({row[rows.BIRTHDAY_ID] for row in raw_citizens}))
+
+        # (citizen_id, month, number of presents) cells
+        with memprof.phase('aggregate'):
+            if snapshot is not None:
+                cells = snapshot.birthday_cells()
+            elif current_app.config['BIRTHDAYS_ENGINE'] == 'numpy':
+                cells = aggregation.birthday_cells(raw_citizens)
+            else:
+                cells = aggregation.presents_cells(aggregation.birthday_presents(raw_citizens))
 
-        # pack them into dicts
-        citizens_relatives = [dict(entry) for entry in raw_citizens]
+        with memprof.phase('build'):
+            mimetype = formats.negotiate()
+            if mimetype == formats.ARROW:
+                return formats.birthdays_arrow(cells)
+            if mimetype == formats.MSGPACK:
+                return formats.birthdays_msgpack(cells)
 
-        # empty database response
-        if not citizens_relatives:
-            return {'message': f'import_id {import_id} not found'}, 404
+            # build response from aggregation storage
+            return {'data': aggregation.cells_by_month(cells)}, 200
 
-        id_bd_map = {x['id']: {'citizen_id': x['citizen_id'], 'month': x['birth_date'].month}
-                     for x in citizens_relatives}
 
-        # aggregation storage: citizen_id -> month -> number of presents
-        presents = {}
+class GetAges(Resource):
+    """
+        Serves /imports/<int:import_id>/towns/stat/percentile/age endpoint
+    """
 
-        for citizen_relative in citizens_relatives:
-            db_citizen_id = citizen_relative['id']
-            citizen_id = id_bd_map[db_citizen_id]['citizen_id']
+    @staticmethod
+    def get(import_id):
+        """
+        Get request handler
+        """
+        response = histograms.age_percentiles(import_id)
 
-            db_relative_id = citizen_relative['relative_id']
-            if not db_relative_id:  # no relatives :(
-                continue
+        if response is None:
+            return {'message': f'import_id {import_id} not found'}, 404
 
-            relative_birth_month = id_bd_map[db_relative_id]['month']
+        mimetype = formats.negotiate()
+        if mimetype == formats.ARROW:
+            return formats.ages_arrow(response)
+        if mimetype == formats.MSGPACK:
+            return formats.ages_msgpack(response)
 
-            try:
-                presents[citizen_id][relative_birth_month] += 1
-            except KeyError:
-                try:
-                    presents[citizen_id][relative_birth_month] = 1
-                except KeyError:
-                    presents[citizen_id] = {relative_birth_month: 1}
+        return {'data': response}, 200
 
-        # build response from aggregation storage
 
-        for citizen_key in presents:
-            for month_key in presents[citizen_key]:
-                months_dict[month_key].append({
-                    'citizen_id': citizen_key,
-                    'presents': presents[citizen_key][month_key]
-                })
+class GetTownStats(Resource):
+    """
+        Serves /imports/<int:import_id>/towns/stat endpoint
+    """
 
-        return {'data': months_dict}, 200
+    @staticmethod
+    def get(import_id):
+        """
+        Get request handler. Metrics are chosen with ?metrics=count,p50,... all of them by default
+        """
+        try:
+            metrics = stats.parse_metrics(request.args.get('metrics'))
+        except ValueError as ex:
+            return {'message': str(ex), 'available': list(stats.METRICS)}, 400
 
+        response = stats.town_stats(import_id, metrics)
 
-class GetAges(Resource):
+        if response is None:
+            return {'message': f'import_id {import_id} not found'}, 404
+
+        return {'data': response}, 200
+
+
+class GetFamilies(Resource):
     """
-        Serves /imports/<int:import_id>/towns/stat/percentile/age endpoint
+        Serves /imports/<int:import_id>/citizens/families endpoint
     """
 
     @staticmethod
     def get(import_id):
         """
-        Get request handler
+        Get request handler. Families smaller than ?min_size= are left out, all of them are returned by default
         """
+        try:
+            min_size = int(request.args.get('min_size', 1))
+        except ValueError:
+            return {'message': 'min_size should be an integer'}, 400
 
-        raw_town_birthdays = db.engine.execute(
-            db.select([Citizen.c.town, Citizen.c.birth_date])
-                .where(Citizen.c.import_id == import_id)
-                .order_by(Citizen.c.town)
-        ).fetchall()
-
-        town_birthdays = [dict(entry) for entry in raw_town_birthdays]
+        response = families.families(import_id, min_size)
 
-        if not town_birthdays:
+        if response is None:
             return {'message': f'import_id {import_id} not found'}, 404
 
-        # keeps ages lists by towns
-        towns_ages = {}
-
-        for town_birthday in town_birthdays:
-            town = town_birthday['town']
-            birth_date = town_birthday['birth_date']
-            age = relativedelta(datetime.utcnow(), birth_date).years
-            try:
-                towns_ages[town].append(age)
-            except KeyError:
-                towns_ages[town] = [age]
-
-        response = []
-
-        for town, ages in towns_ages.items():
-            p50, p75, p99 = numpy.percentile(ages, [50, 75, 99])
-            response.append({
-                'town': town,
-                'p50': p50,
-                'p75': p75,
-                'p99': p99
-            })
+        return {'data': response}, 200
+
+
+class GetImportDiff(Resource):
+    """
+        Serves /imports/<int:import_id>/diff/<int:other_import_id> endpoint
+    """
+
+    @staticmethod
+    def get(import_id, other_import_id):
+        """
+        Get request handler. Reports changes made from import_id to other_import_id
+        """
+        storage = get_storage()
+        for requested_id in (import_id, other_import_id):
+            if storage.import_version(requested_id) is None:
+                return {'message': f'import_id {requested_id} not found'}, 404
+
+        response = diff.diff_imports(storage.citizen_stream(import_id), storage.citizen_stream(other_import_id))
 
         return {'data': response}, 200
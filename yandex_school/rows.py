@@ -0,0 +1,38 @@
+from typing import Dict, List, Sequence
+
+"""
+    Positional layouts of the rows the storages return to the read resources.
+    Rows are plain tuples straight from the database driver, columns are addressed by these indices,
+    so neither storage nor resources build a dict per row.
+"""
+
+# citizens_with_relatives: citizen table columns followed by relative_id, one row per relationship
+ID, IMPORT_ID, CITIZEN_ID, TOWN, STREET, BUILDING, APARTMENT, NAME, BIRTH_DATE, GENDER, RELATIVE_ID = range(11)
+
+# birthday_rows: one row per relationship
+BIRTHDAY_ID, BIRTHDAY_CITIZEN_ID, BIRTHDAY_DATE, BIRTHDAY_RELATIVE_ID = range(4)
+
+# town_stat_rows
+STAT_TOWN, STAT_BIRTH_DATE, STAT_GENDER, STAT_STREET, STAT_BUILDING = range(5)
+
+DATE_FORMAT = '%d.%m.%Y'
+
+
+def citizen_json(row: Sequence, relatives: List[int]) -> Dict:
+    """
+    Serializes a citizen row the same way citizenSchema.dump does
+    :param row: citizens_with_relatives row
+    :param relatives: relatives citizen_ids
+    :return: citizen dict
+    """
+    return {
+        'citizen_id': row[CITIZEN_ID],
+        'town': row[TOWN],
+        'street': row[STREET],
+        'building': row[BUILDING],
+        'apartment': row[APARTMENT],
+        'name': row[NAME],
+        'birth_date': row[BIRTH_DATE].strftime(DATE_FORMAT),
+        'gender': row[GENDER],
+        'relatives': relatives,
+    }
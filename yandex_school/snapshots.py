@@ -0,0 +1,270 @@
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+from datetime import date
+from functools import cached_property
+from operator import itemgetter
+from typing import List, Dict, Optional, Iterable, Tuple
+
+from flask import current_app
+
+from yandex_school.metrics import increment
+from yandex_school.stats import StatsCache
+from yandex_school.storage import get_storage
+
+"""
+    Columnar snapshot files of imports.
+
+    A snapshot holds what birthdays, ages and families need: sorted citizen_ids, town codes, birth dates as
+    YYYYMMDD integers and relatives as CSR offsets and indices (positions of relatives in the citizen arrays).
+    One file per import version, written when an import is created. A change only removes the files of its
+    import, the next read of the new version streams the import once and writes its file, so a burst of changes
+    costs no rewrites. Workers mmap the files and read them through NumPy views, so all the workers of a host
+    share one copy in the page cache. Read endpoints fall back to the storage when the file of the current
+    version can not be written, because the import changed again while it was streamed.
+
+    File layout: magic, header length, JSON header (import_id, version, towns, column dtype/offset/length),
+    then columns, every column aligned to 8 bytes.
+"""
+
+MAGIC = b'YSSNAP01'
+_HEADER = struct.Struct('<8sQ')
+ALIGNMENT = 8
+
+# (snapshot directory, import_id) -> opened snapshot
+cache = StatsCache()
+
+
+class Snapshot:
+    """
+    Mapped snapshot file, columns are read-only views of the mapping
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: snapshot file path
+        """
+        import numpy
+
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = _HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a snapshot file')
+        header = json.loads(self._map[_HEADER.size:_HEADER.size + length])
+        self.import_id: int = header['import_id']
+        self.version: int = header['version']
+        self.towns: List[str] = header['towns']
+        columns = {name: numpy.frombuffer(self._map, dtype=dtype, count=count, offset=offset)
+                   for name, (dtype, offset, count) in header['columns'].items()}
+        self.citizen_ids = columns['citizen_ids']
+        self.town_codes = columns['town_codes']
+        self.birth_dates = columns['birth_dates']
+        self.offsets = columns['offsets']
+        self.indices = columns['indices']
+
+    @cached_property
+    def sources(self):
+        """
+        :return: position of the citizen every relative entry belongs to
+        """
+        import numpy
+
+        return numpy.repeat(numpy.arange(len(self.citizen_ids)), numpy.diff(self.offsets))
+
+    def birthday_cells(self) -> Iterable[Tuple[int, int, int]]:
+        """
+        :return: non-empty (citizen_id, month, presents) cells in citizen order, months ascending,
+        same as aggregation.birthday_cells
+        """
+        import numpy
+
+        count = len(self.citizen_ids)
+        months = self.birth_dates // 100 % 100 - 1
+        counts = numpy.bincount(self.sources * 12 + months[self.indices], minlength=count * 12)
+        cells = numpy.flatnonzero(counts)
+        return zip(self.citizen_ids[cells // 12].tolist(), (cells % 12 + 1).tolist(), counts[cells].tolist())
+
+    def relative_pairs(self):
+        """
+        :return: (citizen_id, relative citizen_id) array of every relationship, both directions
+        """
+        import numpy
+
+        return numpy.column_stack((self.citizen_ids[self.sources], self.citizen_ids[self.indices]))
+
+    def birth_histogram(self) -> List[Tuple[str, date, int]]:
+        """
+        :return: rows of town, birth_date, number of citizens ordered by town and birth_date,
+        same as Storage.birth_histogram
+        """
+        import numpy
+
+        # towns are stored sorted, so code order is town order
+        keys, counts = numpy.unique(self.town_codes.astype(numpy.int64) * 100000000 + self.birth_dates,
+                                 return_counts=True)
+        towns, births = keys // 100000000, keys % 100000000
+        return [(self.towns[town], date(birth // 10000, birth // 100 % 100, birth % 100), count)
+                for town, birth, count in zip(towns.tolist(), births.tolist(), counts.tolist())]
+
+
+def _path(directory: str, import_id: int, version: int) -> str:
+    return os.path.join(directory, f'{import_id}.{version}.snap')
+
+
+def write(directory: str, import_id: int, version: int,
+          citizens: Iterable[Tuple[int, str, date, List[int]]]) -> str:
+    """
+    Writes snapshot file of an import version, readers never see a partially written file
+    :param directory: snapshot directory
+    :param import_id: import_id
+    :param version: import version
+    :param citizens: (citizen_id, town, birth_date, relatives citizen_ids) ordered by citizen_id
+    :return: path of the file
+    """
+    import numpy
+
+    citizen_ids, towns, births, offsets, relatives = [], [], [], [0], []
+    for citizen_id, town, birth_date, citizen_relatives in citizens:
+        citizen_ids.append(citizen_id)
+        towns.append(town)
+        births.append(birth_date.year * 10000 + birth_date.month * 100 + birth_date.day)
+        relatives.extend(citizen_relatives)
+        offsets.append(len(relatives))
+
+    citizen_ids = numpy.array(citizen_ids, dtype=numpy.int64)
+    town_names, town_codes = numpy.unique(numpy.array(towns, dtype=object), return_inverse=True)
+    columns = {
+        'citizen_ids': citizen_ids,
+        'town_codes': town_codes.astype(numpy.int32),
+        'birth_dates': numpy.array(births, dtype=numpy.int32),
+        'offsets': numpy.array(offsets, dtype=numpy.int64),
+        'indices': numpy.searchsorted(citizen_ids, numpy.array(relatives, dtype=numpy.int64)).astype(numpy.int32),
+    }
+
+    def header(start: int) -> bytes:
+        layout, offset = {}, start
+        for name, column in columns.items():
+            layout[name] = (column.dtype.str, offset, len(column))
+            offset += -(-column.nbytes // ALIGNMENT) * ALIGNMENT
+        return json.dumps({'import_id': import_id, 'version': version, 'towns': town_names.tolist(),
+                           'columns': layout}, ensure_ascii=False).encode()
+
+    # column offsets depend on header length, which does not change once offsets are wide enough
+    length = len(header(0))
+    while True:
+        start = -(-(_HEADER.size + length) // ALIGNMENT) * ALIGNMENT
+        encoded = header(start)
+        if len(encoded) <= length:
+            break
+        length = len(encoded)
+    encoded = encoded.ljust(length)
+
+    os.makedirs(directory, exist_ok=True)
+    path = _path(directory, import_id, version)
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(_HEADER.pack(MAGIC, length))
+        file.write(encoded)
+        for column in columns.values():
+            file.write(b'\0' * (-file.tell() % ALIGNMENT))
+            file.write(column.tobytes())
+    os.replace(temporary, path)
+    increment('snapshot_writes')
+    return path
+
+
+def _directory() -> Optional[str]:
+    """
+    :return: snapshot directory or None if snapshots are off
+    """
+    return current_app.config['SNAPSHOT_DIR'] if current_app.config['SNAPSHOTS'] else None
+
+
+def _rebuild(directory: str, import_id: int, version: int) -> bool:
+    """
+    Writes snapshot of an import version from the storage
+    :param directory: snapshot directory
+    :param import_id: import_id
+    :param version: import version read by the caller
+    :return: whether the file has been written, it is not if the import has changed meanwhile
+    """
+    storage = get_storage()
+    citizens = [(x[0], x[1], x[6], x[8]) for x in storage.citizen_stream(import_id)]
+    # version is bumped in the transaction of the change, unchanged version means unchanged citizens
+    if storage.import_version(import_id) != version:
+        return False
+    write(directory, import_id, version, citizens)
+    increment('snapshot_rebuilds')
+    return True
+
+
+def get(import_id: int, version: Optional[int] = None) -> Optional[Snapshot]:
+    """
+    Maps snapshot of the current import version, writes it first if it is missing
+    :param import_id: requested import_id
+    :param version: [OPTIONAL] current import version if already known
+    :return: snapshot or None if snapshots are off, the import does not exist or its snapshot can not be written
+    """
+    directory = _directory()
+    if directory is None:
+        return None
+    if version is None:
+        version = get_storage().import_version(import_id)
+    if version is None:
+        return None
+
+    key = (directory, import_id)
+    snapshot = cache.get(key)
+    if snapshot is not None and snapshot.version == version:
+        increment('snapshot_hits')
+        return snapshot
+    path = _path(directory, import_id, version)
+    if not os.path.exists(path):
+        increment('snapshot_misses')
+        if not _rebuild(directory, import_id, version):
+            return None
+    try:
+        snapshot = Snapshot(path)
+    except FileNotFoundError:
+        # removed by a change committed right after the rebuild
+        return None
+    increment('snapshot_hits')
+    cache.put(key, snapshot, current_app.config['SNAPSHOT_CACHE_SIZE'])
+    return snapshot
+
+
+def invalidate(import_id: int) -> None:
+    """
+    Removes snapshot files of every version of a changed import, the next read writes the new one
+    :param import_id: changed import_id
+    :return: None
+    """
+    directory = _directory()
+    if directory is None:
+        return
+    # mapped files stay readable by the workers holding them until they notice the version change
+    for path in glob.glob(os.path.join(directory, f'{import_id}.*.snap')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    cache.discard((directory, import_id))
+
+
+def store(import_id: int, citizens: List[Dict]) -> None:
+    """
+    Writes snapshot of a freshly created import
+    :param import_id: id of the new import
+    :param citizens: validated citizens of the import
+    :return: None
+    """
+    directory = _directory()
+    if directory is None:
+        return
+    citizens = sorted(citizens, key=itemgetter('citizen_id'))
+    write(directory, import_id, 0, ((x['citizen_id'], x['town'], x['birth_date'], x['relatives']) for x in citizens))
+
@@ -0,0 +1,302 @@
+from collections import OrderedDict
+from datetime import date, datetime
+from functools import cached_property
+from threading import Lock
+from typing import List, Dict, Sequence, Callable, Optional, Tuple
+
+from flask import current_app
+
+from yandex_school import memprof
+from yandex_school.metrics import increment
+from yandex_school.storage import get_storage
+
+"""
+    Per-town statistics engine. One scan of an import gives columns of (town, birth_date, gender, street, building),
+    every metric is a grouped reduction over them. Metrics are registered with @metric decorator.
+"""
+
+# metric name -> function of TownGroups returning one value per town
+METRICS: Dict[str, Callable] = OrderedDict()
+
+AGE_PERCENTILES = ('p50', 'p75', 'p99')
+
+
+def metric(name: str):
+    """
+    Registers a town metric
+    :param name: metric name used in ?metrics= query parameter
+    :return: decorator
+    """
+    def decorator(function: Callable) -> Callable:
+        METRICS[name] = function
+        return function
+    return decorator
+
+
+def ages(birth_dates: Sequence[date], today: date):
+    """
+    Full years between birth dates and a reference date, same as relativedelta(today, birth_date).years
+    :param birth_dates: birth dates
+    :param today: reference date
+    :return: numpy array of ages
+    """
+    import numpy
+
+    years = numpy.fromiter((x.year for x in birth_dates), numpy.int32, len(birth_dates))
+    month_days = numpy.fromiter((x.month * 100 + x.day for x in birth_dates), numpy.int32, len(birth_dates))
+    # those born on February 29 celebrate on February 28 in common years
+    if not (today.year % 4 == 0 and (today.year % 100 != 0 or today.year % 400 == 0)):
+        month_days[month_days == 229] = 228
+    return today.year - years - (month_days > today.month * 100 + today.day)
+
+
+def grouped_percentiles(values, starts, counts, percent: float):
+    """
+    Percentile of every group of sorted values, same as numpy.percentile with linear interpolation
+    :param values: values sorted within groups
+    :param starts: first index of every group
+    :param counts: size of every group
+    :param percent: percentile, 0..100
+    :return: numpy array with a percentile per group
+    """
+    import numpy
+
+    virtual = (counts - 1) * numpy.true_divide(percent, 100)
+    previous = numpy.floor(virtual).astype(numpy.int64)
+    following = numpy.minimum(previous + 1, counts - 1)
+    gamma = virtual - previous
+    return _lerp(values[starts + previous].astype(numpy.float64), values[starts + following].astype(numpy.float64),
+                 gamma)
+
+
+def histogram_percentiles(values, counts, percent):
+    """
+    Percentile of values given by their counts, same as numpy.percentile of the values repeated by counts
+    :param values: distinct values sorted ascending
+    :param counts: number of occurrences of every value
+    :param percent: percentile or array of percentiles, 0..100
+    :return: numpy array with a value per percentile
+    """
+    import numpy
+
+    cumulative = numpy.cumsum(counts)
+    total = cumulative[-1]
+    virtual = (total - 1) * numpy.true_divide(percent, 100)
+    previous = numpy.floor(virtual).astype(numpy.int64)
+    following = numpy.minimum(previous + 1, total - 1)
+    gamma = virtual - previous
+    # value of rank r is the first one whose cumulative count exceeds r
+    a = values[numpy.searchsorted(cumulative, previous, side='right')].astype(numpy.float64)
+    b = values[numpy.searchsorted(cumulative, following, side='right')].astype(numpy.float64)
+    return _lerp(a, b, gamma)
+
+
+def _lerp(a, b, gamma):
+    import numpy
+
+    # same arithmetic as numpy's _lerp, keeps results bit-identical
+    diff = b - a
+    return numpy.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+
+
+class TownGroups:
+    """
+    Columns of an import grouped by town. Intermediate arrays are built on first use,
+    so only what the requested metrics need gets computed.
+    """
+
+    def __init__(self, rows: Sequence, today: date):
+        """
+        :param rows: rows of town, birth_date, gender, street, building
+        :param today: reference date for ages
+        """
+        import numpy
+
+        self.today = today
+        self.towns_column, self.birth_dates, self.genders, self.streets, self.buildings = zip(*rows)
+        self.towns, self.town_index = numpy.unique(numpy.array(self.towns_column, dtype=object), return_inverse=True)
+        self.size = len(self.towns)
+
+    def _distinct(self, *columns) -> 'numpy.ndarray':
+        """
+        :param columns: columns forming a key
+        :return: number of distinct keys per town
+        """
+        import numpy
+
+        key = numpy.array(['\x00'.join(x) for x in zip(*columns)], dtype=object)
+        _, key_index = numpy.unique(key, return_inverse=True)
+        pairs = numpy.unique(self.town_index.astype(numpy.int64) * (key_index.max() + 1) + key_index)
+        return numpy.bincount(pairs // (key_index.max() + 1), minlength=self.size)
+
+    @cached_property
+    def counts(self):
+        import numpy
+        return numpy.bincount(self.town_index, minlength=self.size)
+
+    @cached_property
+    def ages(self):
+        return ages(self.birth_dates, self.today)
+
+    @cached_property
+    def sorted_ages(self):
+        """
+        :return: ages sorted by town, then by age; start index of every town
+        """
+        import numpy
+        order = numpy.lexsort((self.ages, self.town_index))
+        starts = numpy.concatenate(([0], numpy.cumsum(self.counts)[:-1]))
+        return self.ages[order], starts
+
+    @cached_property
+    def males(self):
+        import numpy
+        return numpy.bincount(self.town_index, weights=numpy.array(self.genders, dtype=object) == 'male',
+                              minlength=self.size).astype(numpy.int64)
+
+
+@metric('count')
+def _count(groups: TownGroups):
+    return groups.counts
+
+
+@metric('male')
+def _male(groups: TownGroups):
+    return groups.males
+
+
+@metric('female')
+def _female(groups: TownGroups):
+    return groups.counts - groups.males
+
+
+@metric('age_min')
+def _age_min(groups: TownGroups):
+    values, starts = groups.sorted_ages
+    return values[starts]
+
+
+@metric('age_max')
+def _age_max(groups: TownGroups):
+    values, starts = groups.sorted_ages
+    return values[starts + groups.counts - 1]
+
+
+@metric('age_mean')
+def _age_mean(groups: TownGroups):
+    import numpy
+    return numpy.bincount(groups.town_index, weights=groups.ages, minlength=groups.size) / groups.counts
+
+
+def _percentile(percent: int) -> Callable:
+    def function(groups: TownGroups):
+        values, starts = groups.sorted_ages
+        return grouped_percentiles(values, starts, groups.counts, percent)
+    return function
+
+
+for _name in AGE_PERCENTILES:
+    metric(_name)(_percentile(int(_name[1:])))
+
+
+@metric('streets')
+def _streets(groups: TownGroups):
+    return groups._distinct(groups.streets)
+
+
+@metric('buildings')
+def _buildings(groups: TownGroups):
+    return groups._distinct(groups.streets, groups.buildings)
+
+
+def parse_metrics(value: Optional[str]) -> Tuple[str, ...]:
+    """
+    :param value: comma separated metric names, None or empty for all the metrics
+    :return: tuple of metric names
+    :raise ValueError: on unknown metric
+    """
+    if not value:
+        return tuple(METRICS)
+    names = tuple(dict.fromkeys(x.strip() for x in value.split(',') if x.strip()))
+    unknown = [x for x in names if x not in METRICS]
+    if unknown:
+        raise ValueError(f'Unknown metrics: {", ".join(unknown)}')
+    return names
+
+
+def compute(rows: Sequence, metrics: Sequence[str], today: date) -> List[Dict]:
+    """
+    Computes requested metrics per town in one pass over rows
+    :param rows: rows of town, birth_date, gender, street, building
+    :param metrics: metric names
+    :param today: reference date for ages
+    :return: list of {'town': town, <metric>: value, ...}
+    """
+    groups = TownGroups(rows, today)
+    columns = [METRICS[name](groups).tolist() for name in metrics]
+    return [dict(zip(('town', *metrics), values)) for values in zip(groups.towns.tolist(), *columns)]
+
+
+class StatsCache:
+    """
+    LRU cache of computed statistics keyed by import version, metrics and reference date
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            except KeyError:
+                return None
+
+    def put(self, key, value, size: int) -> None:
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+cache = StatsCache()
+
+
+def town_stats(import_id: int, metrics: Sequence[str]) -> Optional[List[Dict]]:
+    """
+    Computes or fetches cached statistics of an import
+    :param import_id: requested import_id
+    :param metrics: metric names
+    :return: list of town statistics or None if import does not exist
+    """
+    storage = get_storage()
+    version = storage.import_version(import_id)
+    if version is None:
+        return None
+
+    today = datetime.utcnow().date()
+    key = (id(storage), import_id, version, tuple(metrics), today)
+    result = cache.get(key)
+    if result is not None:
+        increment('town_stats_cache_hits')
+        return result
+
+    increment('town_stats_cache_misses')
+    with memprof.phase('fetch'):
+        rows = storage.town_stat_rows(import_id)
+    if not rows:
+        return None
+    with memprof.phase('compute'):
+        result = compute(rows, metrics, today)
+    cache.put(key, result, current_app.config['TOWN_STATS_CACHE_SIZE'])
+    return result
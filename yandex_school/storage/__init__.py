@@ -0,0 +1,44 @@
+from flask import current_app
+
+from yandex_school import pool
+from yandex_school.storage.base import Storage
+
+__all__ = ['Storage', 'get_storage']
+
+
+def _prepared() -> bool:
+    """
+    :return: True if hot statements should be prepared, PgBouncer transaction pooling can not keep them
+    """
+    return current_app.config['SQL_PREPARED_STATEMENTS'] and not current_app.config['DB_PGBOUNCER']
+
+
+def _create(backend: str) -> Storage:
+    """
+    Instantiates storage backend, backends are imported on demand
+    :param backend: backend name, 'sql', 'sharded' or 'memory'
+    :return: storage instance
+    """
+    if backend == 'sql':
+        from yandex_school.storage.sql import SQLStorage
+        return SQLStorage(prepared=_prepared())
+    if backend == 'sharded':
+        from yandex_school.storage.sharded import ShardedStorage
+        return ShardedStorage(current_app.config['SHARDS'], prepared=_prepared(),
+                              engine_options=pool.engine_options(current_app.config))
+    if backend == 'memory':
+        from yandex_school.storage.memory import MemoryStorage
+        return MemoryStorage()
+    raise ValueError(f'Unknown storage backend: {backend}')
+
+
+def get_storage() -> Storage:
+    """
+    Returns storage of the current application selected by STORAGE_BACKEND config entry
+    :return: storage instance
+    """
+    backend = current_app.config['STORAGE_BACKEND']
+    storages = current_app.extensions.setdefault('storage', {})
+    if backend not in storages:
+        storages[backend] = _create(backend)
+    return storages[backend]
@@ -0,0 +1,159 @@
+from datetime import datetime
+from typing import List, Dict, Tuple, Optional, Sequence, Iterator, Iterable
+
+
+class Storage:
+    """
+    Storage interface used by the resources. Everything is scoped by import_id.
+    Citizens are addressed either by (import_id, citizen_id) or by storage-wide
+    database id, relationships always reference database ids.
+    Rows are returned in the shape of the corresponding SQL query results:
+    mapping-like rows for citizens, plain tuples for id pairs.
+    """
+
+    def reset(self) -> None:
+        """
+        Drops all the data and recreates empty storage
+        :return: None
+        """
+        raise NotImplementedError
+
+    def create_import(self, citizens: List[Dict], relative_links: List[Tuple[int, int]],
+                      digest: Optional[str] = None) -> int:
+        """
+        Stores a new import
+        :param citizens: validated citizens, each citizen is a dict
+        :param relative_links: relationship links list of citizen_ids
+        :param digest: [OPTIONAL] content hash stored along with the import
+        :return: id of the new import
+        """
+        raise NotImplementedError
+
+    def create_unique_import(self, citizens: List[Dict], relative_links: List[Tuple[int, int]], digest: str,
+                             since: Optional[datetime] = None) -> Tuple[int, bool]:
+        """
+        Stores a new import with its content hash unless an import with the same hash exists.
+        The lookup and the insert are atomic, concurrent uploads of the same content store one import.
+        :param citizens: validated citizens, each citizen is a dict
+        :param relative_links: relationship links list of citizen_ids
+        :param digest: content hash of the import
+        :param since: [OPTIONAL] ignore imports created before this moment
+        :return: latest import_id with the same content hash or id of the new import, and whether it is new
+        """
+        raise NotImplementedError
+
+    def citizens_with_relatives(self, import_id: int) -> Sequence:
+        """
+        Citizens joined with their relatives, one row per relationship, ordered by citizen_id.
+        Each row contains all the citizen columns and relative_id (database id or None).
+        :param import_id: requested import_id
+        :return: list of tuples laid out as described in rows.py
+        """
+        raise NotImplementedError
+
+    def birthday_rows(self, import_id: int) -> Sequence:
+        """
+        :param import_id: requested import_id
+        :return: tuples of id, citizen_id, birth_date, relative_id ordered by citizen_id
+        """
+        raise NotImplementedError
+
+    def town_stat_rows(self, import_id: int) -> Sequence:
+        """
+        :param import_id: requested import_id
+        :return: tuples of town, birth_date, gender, street, building in no particular order
+        """
+        raise NotImplementedError
+
+    def birth_histogram(self, import_id: int) -> Sequence:
+        """
+        :param import_id: requested import_id
+        :return: rows of town, birth_date, number of citizens ordered by town and birth_date,
+        empty if import does not exist
+        """
+        raise NotImplementedError
+
+    def rebuild_birth_histogram(self, import_id: Optional[int] = None) -> None:
+        """
+        Recounts birth histogram from citizens
+        :param import_id: [OPTIONAL] import to recount, all the imports by default
+        :return: None
+        """
+        raise NotImplementedError
+
+    def import_version(self, import_id: int) -> Optional[int]:
+        """
+        :param import_id: requested import_id
+        :return: current version of the import data or None if import does not exist
+        """
+        raise NotImplementedError
+
+    def citizen_ids(self, import_id: int) -> List[int]:
+        """
+        :param import_id: requested import_id
+        :return: sorted citizen_ids of the import
+        """
+        raise NotImplementedError
+
+    def relative_pairs(self, import_id: int, citizen_ids: Optional[List[int]] = None) -> List[Tuple[int, int]]:
+        """
+        Relationships as citizen_id pairs, every relationship is present in both directions
+        :param import_id: requested import_id
+        :param citizen_ids: [OPTIONAL] only relationships of these citizens
+        :return: list of (citizen_id, relative citizen_id)
+        """
+        raise NotImplementedError
+
+    def citizen_stream(self, import_id: int, batch_size: int = 1000) -> Iterator[Tuple]:
+        """
+        Streams citizens of an import ordered by citizen_id, at most batch_size rows are held at once
+        :param import_id: requested import_id
+        :param batch_size: number of rows fetched at once
+        :return: iterator of (citizen_id, town, street, building, apartment, name, birth_date, gender,
+        sorted list of relatives citizen_ids)
+        """
+        raise NotImplementedError
+
+    def patch_citizen(self, import_id: int, citizen_id: int, values: Dict) -> Optional[Dict]:
+        """
+        Updates citizen columns and relatives, moves the citizen between birth histogram cells and bumps
+        import version in one transaction. Changes of the same import are applied one after another.
+        :param import_id: requested import_id
+        :param citizen_id: requested citizen_id
+        :param values: new column values and optionally 'relatives' - the new list of relatives citizen_ids,
+        keys which are neither citizen columns nor relatives are ignored
+        :return: {'version', 'citizen': citizen columns after the update, 'relatives': relatives citizen_ids,
+        'added', 'removed': sets of gained and lost relatives citizen_ids,
+        'cells': {(town, birth_date): change of count}} or None if import or citizen does not exist
+        :raises ValidationError: if a relative does not exist, nothing is changed then
+        """
+        raise NotImplementedError
+
+    def citizen_relatives(self, import_id: int, citizen_ids: Iterable[int]) -> Dict[int, List[int]]:
+        """
+        :param import_id: requested import_id
+        :param citizen_ids: requested citizen_ids, missing ones are skipped
+        :return: relatives citizen_ids of every existing requested citizen, keyed by citizen_id
+        """
+        raise NotImplementedError
+
+    def apply_delta(self, import_id: int, citizens: List[Dict], removed: List[int]) -> Optional[Dict]:
+        """
+        Inserts new citizens, replaces existing ones and deletes removed ones in one transaction, then bumps
+        import version. Relationships of the listed citizens are replaced too, birth histogram cells are moved.
+        The delta is validated against the relatives read in the same transaction after the import is locked.
+        :param import_id: requested import_id
+        :param citizens: citizens to insert or replace, each citizen is a dict
+        :param removed: citizen_ids to delete
+        :return: {'version', 'inserted', 'replaced', 'deleted', 'replaced_ids': citizen_ids of replaced citizens,
+        'cells': {(town, birth_date): change of count}} or None if import does not exist
+        :raises ValidationError: if relationships would not stay mutual, nothing is changed then
+        """
+        raise NotImplementedError
+
+    def drop_import_hash(self, import_id: int) -> int:
+        """
+        :param import_id: id of the import
+        :return: number of dropped hashes
+        """
+        raise NotImplementedError
@@ -0,0 +1,259 @@
+from bisect import bisect_left, insort
+from collections import Counter
+from datetime import date, datetime
+from threading import RLock
+from typing import List, Dict, Tuple, Optional, Sequence, Iterator, Iterable
+
+from marshmallow import ValidationError
+
+from yandex_school import aggregation
+from yandex_school.storage.base import Storage
+from yandex_school.validation import validate_delta, delta_neighbourhood
+
+"""
+    Citizen columns in the order of the citizen table
+"""
+CITIZEN_COLUMNS = ('id', 'import_id', 'citizen_id', 'town', 'street', 'building', 'apartment', 'name', 'birth_date',
+                   'gender')
+UPDATABLE_COLUMNS = frozenset(CITIZEN_COLUMNS[3:])
+
+
+class MemoryStorage(Storage):
+    """
+    Pure-Python process-local storage. Meant for tests and profiling of the Python side, data is lost on exit.
+    Citizens are indexed by (import_id, citizen_id) and by database id, relationships are kept as
+    adjacency dicts of database ids, insertion ordered like rows of a heap table.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._import_seq = 0
+            self._citizen_seq = 0
+            # (import_id, citizen_id) -> citizen record
+            self._citizens: Dict[Tuple[int, int], Dict] = {}
+            # database id -> citizen record, same objects as above
+            self._by_id: Dict[int, Dict] = {}
+            # import_id -> sorted citizen_ids
+            self._import_citizens: Dict[int, List[int]] = {}
+            # import_id -> version
+            self._versions: Dict[int, int] = {}
+            # database id -> relatives database ids (ordered set)
+            self._relatives: Dict[int, Dict[int, None]] = {}
+            # content hash -> import_id -> creation time
+            self._hashes: Dict[str, Dict[int, datetime]] = {}
+            # import_id -> content hash
+            self._import_hashes: Dict[int, str] = {}
+            # import_id -> (town, birth_date) -> number of citizens
+            self._histograms: Dict[int, Counter] = {}
+
+    def _citizen_ids(self, import_id: int) -> List[int]:
+        """
+        :param import_id: requested import_id
+        :return: ordered citizen_ids of the import
+        """
+        return self._import_citizens.get(import_id, [])
+
+    def create_import(self, citizens: List[Dict], relative_links: List[Tuple[int, int]],
+                      digest: Optional[str] = None) -> int:
+        with self._lock:
+            self._import_seq += 1
+            import_id = self._import_seq
+
+            for citizen in citizens:
+                self._citizen_seq += 1
+                record = {column: citizen.get(column) for column in CITIZEN_COLUMNS}
+                record['id'] = self._citizen_seq
+                record['import_id'] = import_id
+                self._citizens[import_id, record['citizen_id']] = record
+                self._by_id[record['id']] = record
+                self._relatives[record['id']] = {}
+
+            self._import_citizens[import_id] = sorted(citizen['citizen_id'] for citizen in citizens)
+            self._versions[import_id] = 0
+
+            for citizen, relative in relative_links:
+                db_citizen_id = self._citizens[import_id, citizen]['id']
+                self._relatives[db_citizen_id][self._citizens[import_id, relative]['id']] = None
+
+            self.rebuild_birth_histogram(import_id)
+
+            if digest is not None:
+                self._hashes.setdefault(digest, {})[import_id] = datetime.utcnow()
+                self._import_hashes[import_id] = digest
+
+        return import_id
+
+    def create_unique_import(self, citizens: List[Dict], relative_links: List[Tuple[int, int]], digest: str,
+                             since: Optional[datetime] = None) -> Tuple[int, bool]:
+        with self._lock:
+            matches = [import_id for import_id, created in self._hashes.get(digest, {}).items()
+                       if since is None or created >= since]
+            if matches:
+                return max(matches), False
+            return self.create_import(citizens, relative_links, digest), True
+
+    def citizens_with_relatives(self, import_id: int) -> Sequence:
+        rows = []
+        for key in self._citizen_ids(import_id):
+            record = self._citizens[import_id, key]
+            citizen = tuple(record[column] for column in CITIZEN_COLUMNS)
+            for relative in self._relatives[record['id']] or (None,):
+                rows.append(citizen + (relative,))
+        return rows
+
+    def birthday_rows(self, import_id: int) -> Sequence:
+        rows = []
+        for key in self._citizen_ids(import_id):
+            record = self._citizens[import_id, key]
+            relatives = self._relatives[record['id']] or (None,)
+            for relative in relatives:
+                rows.append((record['id'], key, record['birth_date'], relative))
+        return rows
+
+    def town_stat_rows(self, import_id: int) -> Sequence:
+        return [(record['town'], record['birth_date'], record['gender'], record['street'], record['building'])
+                for record in (self._citizens[import_id, key] for key in self._citizen_ids(import_id))]
+
+    def birth_histogram(self, import_id: int) -> Sequence:
+        return [(town, birth_date, count)
+                for (town, birth_date), count in sorted(self._histograms.get(import_id, {}).items())]
+
+    def rebuild_birth_histogram(self, import_id: Optional[int] = None) -> None:
+        with self._lock:
+            for key in (self._import_citizens if import_id is None else [import_id]):
+                self._histograms[key] = Counter((record['town'], record['birth_date']) for record in
+                                                (self._citizens[key, x] for x in self._citizen_ids(key)))
+
+    def import_version(self, import_id: int) -> Optional[int]:
+        return self._versions.get(import_id)
+
+    def citizen_ids(self, import_id: int) -> List[int]:
+        return list(self._citizen_ids(import_id))
+
+    def relative_pairs(self, import_id: int, citizen_ids: Optional[List[int]] = None) -> List[Tuple[int, int]]:
+        keys = self._citizen_ids(import_id) if citizen_ids is None else citizen_ids
+        pairs = []
+        for key in keys:
+            record = self._citizens.get((import_id, key))
+            if record:
+                pairs.extend((key, self._by_id[relative]['citizen_id']) for relative in self._relatives[record['id']])
+        return pairs
+
+    def citizen_stream(self, import_id: int, batch_size: int = 1000) -> Iterator[Tuple]:
+        for key in list(self._citizen_ids(import_id)):
+            record = self._citizens.get((import_id, key))
+            if record is None:
+                continue
+            relatives = sorted(self._by_id[relative]['citizen_id'] for relative in self._relatives[record['id']])
+            yield (key, record['town'], record['street'], record['building'], record['apartment'], record['name'],
+                   record['birth_date'], record['gender'], relatives)
+
+    def _finish_change(self, import_id: int, cells: Dict[Tuple[str, date], int]) -> int:
+        """
+        Moves birth histogram cells by their net change and bumps import version, must be called under the lock
+        :param import_id: changed import
+        :param cells: (town, birth_date) -> change of count
+        :return: new import version
+        """
+        histogram = self._histograms[import_id]
+        for cell, change in cells.items():
+            histogram[cell] += change
+            if histogram[cell] <= 0:
+                del histogram[cell]
+        self._versions[import_id] += 1
+        return self._versions[import_id]
+
+    def patch_citizen(self, import_id: int, citizen_id: int, values: Dict) -> Optional[Dict]:
+        with self._lock:
+            record = self._citizens.get((import_id, citizen_id))
+            if record is None:
+                return None
+            relatives = self._relatives[record['id']]
+            current = [self._by_id[relative]['citizen_id'] for relative in relatives]
+            added, removed = set(), set()
+            if 'relatives' in values:
+                added, removed = aggregation.relatives_diff(current, values['relatives'])
+                if any((import_id, key) not in self._citizens for key in added):
+                    raise ValidationError('Citizen relatives contain unexistent citizen_id')
+                for key in removed:
+                    relative = self._citizens[import_id, key]['id']
+                    relatives.pop(relative, None)
+                    self._relatives[relative].pop(record['id'], None)
+                for key in added:
+                    relative = self._citizens[import_id, key]['id']
+                    relatives[relative] = None
+                    self._relatives[relative][record['id']] = None
+                current = values['relatives']
+
+            previous = (record['town'], record['birth_date'])
+            record.update((k, v) for k, v in values.items() if k in UPDATABLE_COLUMNS)
+            cells = {previous: -1, (record['town'], record['birth_date']): 1} \
+                if previous != (record['town'], record['birth_date']) else {}
+            return {'version': self._finish_change(import_id, cells), 'citizen': dict(record), 'relatives': current,
+                    'added': added, 'removed': removed, 'cells': cells}
+
+    def citizen_relatives(self, import_id: int, citizen_ids: Iterable[int]) -> Dict[int, List[int]]:
+        result = {}
+        for key in citizen_ids:
+            record = self._citizens.get((import_id, key))
+            if record is not None:
+                result[key] = [self._by_id[relative]['citizen_id'] for relative in self._relatives[record['id']]]
+        return result
+
+    def apply_delta(self, import_id: int, citizens: List[Dict], removed: List[int]) -> Optional[Dict]:
+        with self._lock:
+            if import_id not in self._versions:
+                return None
+            relative_links = validate_delta(self.citizen_relatives(import_id, delta_neighbourhood(citizens, removed)),
+                                            citizens, removed)
+            cells = Counter()
+            keys = self._import_citizens[import_id]
+            listed = [citizen['citizen_id'] for citizen in citizens]
+            replaced = [key for key in listed if (import_id, key) in self._citizens]
+
+            # relationships of the touched citizens go away in both directions
+            for key in replaced + removed:
+                record = self._citizens[import_id, key]
+                cells[record['town'], record['birth_date']] -= 1
+                for relative in self._relatives.pop(record['id']):
+                    self._relatives.get(relative, {}).pop(record['id'], None)
+                self._relatives[record['id']] = {}
+
+            for key in removed:
+                record = self._citizens.pop((import_id, key))
+                del self._by_id[record['id']], self._relatives[record['id']]
+                del keys[bisect_left(keys, key)]
+
+            for citizen in citizens:
+                record = self._citizens.get((import_id, citizen['citizen_id']))
+                if record is None:
+                    self._citizen_seq += 1
+                    record = {'id': self._citizen_seq, 'import_id': import_id}
+                    self._citizens[import_id, citizen['citizen_id']] = record
+                    self._by_id[record['id']] = record
+                    self._relatives[record['id']] = {}
+                    insort(keys, citizen['citizen_id'])
+                record.update((column, citizen.get(column)) for column in CITIZEN_COLUMNS[2:])
+                cells[record['town'], record['birth_date']] += 1
+
+            for citizen, relative in relative_links:
+                db_citizen_id = self._citizens[import_id, citizen]['id']
+                db_relative_id = self._citizens[import_id, relative]['id']
+                self._relatives[db_citizen_id][db_relative_id] = None
+                self._relatives[db_relative_id][db_citizen_id] = None
+
+            cells = {cell: change for cell, change in cells.items() if change}
+            return {'version': self._finish_change(import_id, cells), 'inserted': len(listed) - len(replaced),
+                    'replaced': len(replaced), 'deleted': len(removed), 'replaced_ids': replaced, 'cells': cells}
+
+    def drop_import_hash(self, import_id: int) -> int:
+        with self._lock:
+            digest = self._import_hashes.pop(import_id, None)
+            if digest is None:
+                return 0
+            del self._hashes[digest][import_id]
+            return 1
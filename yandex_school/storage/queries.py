@@ -0,0 +1,216 @@
+import re
+from time import perf_counter
+from typing import Dict, Callable, Hashable
+
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.engine import Connection, ResultProxy
+
+from yandex_school import db
+from yandex_school.metrics import increment, observe
+from yandex_school.models import Import, Citizen, Relative, BirthHistogram
+
+"""
+    Hot statements of the SQL storage. Each one is built once and executed either through
+    SQLAlchemy compiled cache or as a server-side prepared statement.
+"""
+
+UPDATABLE_COLUMNS = ('town', 'street', 'building', 'apartment', 'name', 'birth_date', 'gender')
+
+_join = Citizen.outerjoin(Relative, Relative.c.citizen_id == Citizen.c.id)
+_citizen = Citizen.alias('c')
+_relative = Citizen.alias('r')
+
+STATEMENTS: Dict[str, Callable] = {
+    'citizens_with_relatives': lambda: db.select([Citizen, Relative.c.relative_id])
+        .where(Citizen.c.import_id == bindparam('import_id'))
+        .order_by(Citizen.c.citizen_id).select_from(_join),
+    'birthday_rows': lambda: db.select([Citizen.c.id, Citizen.c.citizen_id, Citizen.c.birth_date,
+                                        Relative.c.relative_id])
+        .where(Citizen.c.import_id == bindparam('import_id'))
+        .order_by(Citizen.c.citizen_id)
+        .select_from(_join),
+    'town_stat_rows': lambda: db.select([Citizen.c.town, Citizen.c.birth_date, Citizen.c.gender, Citizen.c.street,
+                                         Citizen.c.building])
+        .where(Citizen.c.import_id == bindparam('import_id')),
+    'birth_histogram': lambda: db.select([BirthHistogram.c.town, BirthHistogram.c.birth_date,
+                                          BirthHistogram.c.count])
+        .where(BirthHistogram.c.import_id == bindparam('import_id'))
+        .order_by(BirthHistogram.c.town, BirthHistogram.c.birth_date),
+    'import_version': lambda: db.select([Import.c.version]).where(Import.c.id == bindparam('import_id')),
+    'lock_import': lambda: db.select([Import.c.version]).where(Import.c.id == bindparam('import_id'))
+        .with_for_update(),
+    'bump_version': lambda: Import.update()
+        .where(Import.c.id == bindparam('where_import_id'))
+        .values(version=Import.c.version + 1)
+        .returning(Import.c.version),
+    'citizen_ids': lambda: db.select([Citizen.c.citizen_id])
+        .where(Citizen.c.import_id == bindparam('import_id'))
+        .order_by(Citizen.c.citizen_id),
+    'relative_pairs': lambda: db.select([_citizen.c.citizen_id, _relative.c.citizen_id])
+        .select_from(Relative
+                     .join(_citizen, _citizen.c.id == Relative.c.citizen_id)
+                     .join(_relative, _relative.c.id == Relative.c.relative_id))
+        .where(_citizen.c.import_id == bindparam('import_id')),
+    'relative_pairs_of': lambda: db.select([_citizen.c.citizen_id, _relative.c.citizen_id])
+        .select_from(Relative
+                     .join(_citizen, _citizen.c.id == Relative.c.citizen_id)
+                     .join(_relative, _relative.c.id == Relative.c.relative_id))
+        .where(_citizen.c.import_id == bindparam('import_id'))
+        .where(_citizen.c.citizen_id == db.func.any(bindparam('citizen_ids'))),
+    'citizen_stream': lambda: db.select([_citizen.c.citizen_id, _citizen.c.town, _citizen.c.street,
+                                         _citizen.c.building, _citizen.c.apartment, _citizen.c.name,
+                                         _citizen.c.birth_date, _citizen.c.gender,
+                                         db.func.array_remove(db.func.array_agg(
+                                             aggregate_order_by(_relative.c.citizen_id, _relative.c.citizen_id)),
+                                             db.null()).label('relatives')])
+        .select_from(_citizen
+                     .outerjoin(Relative, Relative.c.citizen_id == _citizen.c.id)
+                     .outerjoin(_relative, _relative.c.id == Relative.c.relative_id))
+        .where(_citizen.c.import_id == bindparam('import_id'))
+        .group_by(_citizen.c.id)
+        .order_by(_citizen.c.citizen_id),
+    'citizen_relatives': lambda: db.select([_citizen.c.citizen_id,
+                                            db.func.array_remove(db.func.array_agg(_relative.c.citizen_id),
+                                                                 db.null())])
+        .select_from(_citizen
+                     .outerjoin(Relative, Relative.c.citizen_id == _citizen.c.id)
+                     .outerjoin(_relative, _relative.c.id == Relative.c.relative_id))
+        .where(_citizen.c.import_id == bindparam('import_id'))
+        .where(_citizen.c.citizen_id == db.func.any(bindparam('citizen_ids')))
+        .group_by(_citizen.c.id),
+    'citizen': lambda: db.select([Citizen])
+        .where(Citizen.c.import_id == bindparam('import_id'))
+        .where(Citizen.c.citizen_id == bindparam('citizen_id')),
+    'citizen_id_map': lambda: db.select([Citizen.c.citizen_id, Citizen.c.id])
+        .where(Citizen.c.import_id == bindparam('import_id'))
+        .where(Citizen.c.citizen_id == db.func.any(bindparam('citizen_ids'))),
+    'relative_id_map': lambda: db.select([_relative.c.citizen_id, _relative.c.id])
+        .select_from(Relative.join(_relative, _relative.c.id == Relative.c.relative_id))
+        .where(Relative.c.citizen_id == bindparam('db_citizen_id')),
+    # links as two arrays, a single execution of a prepared statement inserts all of them
+    'add_relatives': lambda: Relative.insert().from_select(
+        ['citizen_id', 'relative_id'],
+        db.select([db.func.unnest(db.cast(bindparam('db_citizen_ids'), postgresql.ARRAY(db.Integer))),
+                   db.func.unnest(db.cast(bindparam('db_relative_ids'), postgresql.ARRAY(db.Integer)))])),
+    'remove_relatives': lambda: Relative.delete()
+        .where(Relative.c.citizen_id == bindparam('db_citizen_id'))
+        .where(Relative.c.relative_id == db.func.any(bindparam('db_relative_ids'))),
+    'remove_relatives_opposite': lambda: Relative.delete()
+        .where(Relative.c.citizen_id == db.func.any(bindparam('db_relative_ids')))
+        .where(Relative.c.relative_id == bindparam('db_citizen_id')),
+}
+
+
+def _update_citizen_by_id(columns: tuple):
+    """
+    :param columns: updated columns
+    :return: update statement of a citizen addressed by database id
+    """
+    return Citizen.update() \
+        .where(Citizen.c.id == bindparam('db_citizen_id')) \
+        .values({column: bindparam(f'set_{column}') for column in columns})
+
+
+"""
+    Statements depending on the set of updated columns, built per columns combination
+"""
+UPDATE_STATEMENTS: Dict[str, Callable] = {
+    'update_citizen_by_id': _update_citizen_by_id,
+}
+
+
+class Statement:
+    """
+    A statement built once with its postgres text form for PREPARE
+    """
+    _param = re.compile(r'%\((\w+)\)s')
+
+    def __init__(self, name: str, statement):
+        self.name = name
+        self.statement = statement
+        self.compiled = statement.compile(dialect=postgresql.dialect())
+        self.is_select = statement.is_selectable
+
+        # turn pyformat placeholders into $n positional ones
+        self.param_names = []
+
+        def positional(match) -> str:
+            param = match.group(1)
+            if param not in self.param_names:
+                self.param_names.append(param)
+            return f'${self.param_names.index(param) + 1}'
+
+        self.prepare_text = f'PREPARE {name} AS {self._param.sub(positional, self.compiled.string)}'
+        self.execute_text = f'EXECUTE {name} ({", ".join(f"%({param})s" for param in self.param_names)})'
+
+
+class QueryRegistry:
+    """
+    Executes named statements. Statement objects are shared between requests, so SQLAlchemy
+    compiles each of them once per process. With prepared=True every statement is also
+    PREPAREd on a connection the first time it runs there, later executions skip parsing
+    and planning on the server.
+    """
+
+    def __init__(self, prepared: bool = False):
+        self.prepared = prepared
+        self.compiled_cache = {}
+        self._statements: Dict[Hashable, Statement] = {}
+
+    def statement(self, name: str, columns: tuple = ()) -> Statement:
+        """
+        :param name: statement name from STATEMENTS or UPDATE_STATEMENTS
+        :param columns: updated columns for UPDATE_STATEMENTS
+        :return: cached statement
+        """
+        key = (name, columns)
+        try:
+            return self._statements[key]
+        except KeyError:
+            pass
+        if columns:
+            built = Statement(f'{name}__{"__".join(columns)}', UPDATE_STATEMENTS[name](columns))
+        else:
+            built = Statement(name, STATEMENTS[name]())
+        self._statements[key] = built
+        return built
+
+    def execute(self, connection: Connection, statement: Statement, params: Dict) -> ResultProxy:
+        """
+        Executes statement, records its count and timing
+        :param connection: connection to execute on
+        :param statement: statement from self.statement()
+        :param params: statement parameters
+        :return: result
+        """
+        started = perf_counter()
+        if self.prepared:
+            result = self._execute_prepared(connection, statement, params)
+        else:
+            result = connection.execution_options(compiled_cache=self.compiled_cache) \
+                .execute(statement.statement, params)
+        observe(f'query.{statement.name}', perf_counter() - started)
+        return result
+
+    @staticmethod
+    def _execute_prepared(connection: Connection, statement: Statement, params: Dict) -> ResultProxy:
+        """
+        Prepares statement on the connection if needed and executes it
+        :param connection: connection to execute on
+        :param statement: statement from self.statement()
+        :param params: statement parameters
+        :return: result
+        """
+        # info lives as long as the DBAPI connection does, so do prepared statements
+        prepared = connection.connection.info.setdefault('prepared_statements', set())
+        if statement.name not in prepared:
+            connection.execute(statement.prepare_text)
+            prepared.add(statement.name)
+            increment('query_prepares')
+
+        # EXECUTE is not recognized as a data changing statement by autocommit detection
+        if not statement.is_select:
+            connection = connection.execution_options(autocommit=True)
+        return connection.execute(statement.execute_text, statement.compiled.construct_params(params))
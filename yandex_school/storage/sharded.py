@@ -0,0 +1,139 @@
+from datetime import datetime
+from itertools import count
+from typing import List, Dict, Tuple, Optional, Sequence, Iterator, Iterable
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+
+from yandex_school import pool
+from yandex_school.storage.base import Storage
+from yandex_school.storage.sql import SQLStorage
+
+
+def shard_of(import_id: int, shards: int) -> int:
+    """
+    :param import_id: import id
+    :param shards: number of shards
+    :return: index of the shard owning the import
+    """
+    return (import_id - 1) % shards
+
+
+def next_import_id(shard: int, shards: int, after: int = 0) -> int:
+    """
+    :param shard: index of the shard
+    :param shards: number of shards
+    :param after: largest import id allocated so far
+    :return: smallest import id above `after` owned by the shard
+    """
+    return after + 1 + (shard - after) % shards
+
+
+def allocate_import_ids(engine: Engine, shard: int, shards: int, after: int = 0) -> None:
+    """
+    Restarts import id sequence of a shard database so it yields only ids owned by the shard
+    :param engine: engine of the shard database
+    :param shard: index of the shard
+    :param shards: number of shards
+    :param after: largest import id allocated so far
+    :return: None
+    """
+    # utility statements take no bind parameters, both values are integers
+    engine.execute(f'ALTER SEQUENCE import_id_seq INCREMENT BY {int(shards)} '
+                   f'RESTART WITH {int(next_import_id(shard, shards, after))}')
+
+
+class ShardedStorage(Storage):
+    """
+    Imports spread over several Postgres databases, one SQL storage with its own engine pool per shard.
+    Every shard allocates import ids from its own sequence, so the owner shard is derived from the import id
+    and every call is routed to that shard only. New imports are placed round-robin.
+    """
+
+    def __init__(self, uris: List[str], prepared: bool = False, engine_options: Optional[Dict] = None):
+        """
+        :param uris: database URIs of the shards, in shard order
+        :param prepared: execute hot statements as server-side prepared statements
+        :param engine_options: [OPTIONAL] keyword arguments of every shard engine
+        """
+        if not uris:
+            raise ValueError('Sharded storage needs at least one shard')
+        self.shards = [SQLStorage(prepared, create_engine(uri, **(engine_options or {}))) for uri in uris]
+        for index, shard in enumerate(self.shards):
+            pool.register(f'shard{index}', lambda engine=shard.engine: engine)
+        self._placement = count()
+
+    def shard(self, import_id: int) -> SQLStorage:
+        """
+        :param import_id: import id
+        :return: storage of the shard owning the import
+        """
+        return self.shards[shard_of(import_id, len(self.shards))]
+
+    def dispose(self) -> None:
+        """
+        Closes pooled connections of all the shards
+        :return: None
+        """
+        for shard in self.shards:
+            shard.engine.dispose()
+
+    def reset(self) -> None:
+        for index, shard in enumerate(self.shards):
+            shard.reset()
+            allocate_import_ids(shard.engine, index, len(self.shards))
+
+    def create_import(self, citizens: List[Dict], relative_links: List[Tuple[int, int]],
+                      digest: Optional[str] = None) -> int:
+        shard = self.shards[next(self._placement) % len(self.shards)]
+        return shard.create_import(citizens, relative_links, digest)
+
+    def create_unique_import(self, citizens: List[Dict], relative_links: List[Tuple[int, int]], digest: str,
+                             since: Optional[datetime] = None) -> Tuple[int, bool]:
+        # the only lookup not scoped to an import, the lock on the first shard serializes uploads of the same
+        # content across all the shards while every shard is asked for its latest match
+        with self.shards[0].hash_lock(digest):
+            found = [x for x in (shard.find_import_by_hash(digest, since) for shard in self.shards) if x is not None]
+            if found:
+                return max(found), False
+            return self.create_import(citizens, relative_links, digest), True
+
+    def citizens_with_relatives(self, import_id: int) -> Sequence:
+        return self.shard(import_id).citizens_with_relatives(import_id)
+
+    def birthday_rows(self, import_id: int) -> Sequence:
+        return self.shard(import_id).birthday_rows(import_id)
+
+    def town_stat_rows(self, import_id: int) -> Sequence:
+        return self.shard(import_id).town_stat_rows(import_id)
+
+    def birth_histogram(self, import_id: int) -> Sequence:
+        return self.shard(import_id).birth_histogram(import_id)
+
+    def rebuild_birth_histogram(self, import_id: Optional[int] = None) -> None:
+        for shard in (self.shards if import_id is None else [self.shard(import_id)]):
+            shard.rebuild_birth_histogram(import_id)
+
+    def import_version(self, import_id: int) -> Optional[int]:
+        return self.shard(import_id).import_version(import_id)
+
+    def citizen_ids(self, import_id: int) -> List[int]:
+        return self.shard(import_id).citizen_ids(import_id)
+
+    def relative_pairs(self, import_id: int, citizen_ids: Optional[List[int]] = None) -> List[Tuple[int, int]]:
+        return self.shard(import_id).relative_pairs(import_id, citizen_ids)
+
+    def citizen_stream(self, import_id: int, batch_size: int = 1000) -> Iterator[Tuple]:
+        return self.shard(import_id).citizen_stream(import_id, batch_size)
+
+    def patch_citizen(self, import_id: int, citizen_id: int, values: Dict) -> Optional[Dict]:
+        return self.shard(import_id).patch_citizen(import_id, citizen_id, values)
+
+    def citizen_relatives(self, import_id: int, citizen_ids: Iterable[int]) -> Dict[int, List[int]]:
+        return self.shard(import_id).citizen_relatives(import_id, citizen_ids)
+
+    def apply_delta(self, import_id: int, citizens: List[Dict], removed: List[int]) -> Optional[Dict]:
+        return self.shard(import_id).apply_delta(import_id, citizens, removed)
+
+    def drop_import_hash(self, import_id: int) -> int:
+        return self.shard(import_id).drop_import_hash(import_id)
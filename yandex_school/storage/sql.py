@@ -0,0 +1,388 @@
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import List, Dict, Tuple, Optional, Sequence, Iterator, Callable, Any, Iterable
+
+from marshmallow import ValidationError
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import ResultProxy, Engine, Connection
+
+from yandex_school import aggregation, db, deadlines
+from yandex_school.models import Import, Citizen, Relative, ImportHash, BirthHistogram
+from yandex_school.storage.base import Storage
+from yandex_school.storage.queries import QueryRegistry, UPDATABLE_COLUMNS
+from yandex_school.validation import validate_delta, delta_neighbourhood
+
+
+def _tuples(result: ResultProxy) -> List[tuple]:
+    """
+    Fetches rows as plain tuples of the DBAPI cursor, skipping RowProxy wrappers
+    """
+    rows = result.cursor.fetchall()
+    result.close()
+    return rows
+
+
+class SQLStorage(Storage):
+    """
+    Postgres storage backed by the tables from models.py. Hot statements go through the query registry.
+    """
+
+    def __init__(self, prepared: bool = False, engine: Optional[Engine] = None):
+        """
+        :param prepared: execute hot statements as server-side prepared statements
+        :param engine: [OPTIONAL] engine of the database to use, application database by default
+        """
+        self.queries = QueryRegistry(prepared)
+        self._engine = engine
+
+    @property
+    def engine(self) -> Engine:
+        return self._engine if self._engine is not None else db.engine
+
+    @contextmanager
+    def _transaction(self) -> Iterator[Connection]:
+        """
+        Checks out a connection with a transaction limited by the request budget
+        :return: context manager giving the connection
+        """
+        with self.engine.connect() as connection, deadlines.budgeted(connection), connection.begin():
+            yield connection
+
+    def reset(self) -> None:
+        with self._transaction() as connection:
+            db.metadata.drop_all(connection)
+            db.metadata.create_all(connection)
+
+    @staticmethod
+    def store_relationships(connection: Connection, import_id: int, relative_links: List[Tuple]) -> None:
+        """
+        Maps citizen_ids to database ids, pushes relationships into database
+        :param connection: connection with the transaction of the import
+        :param import_id: id of current import
+        :param relative_links: relationship links list of citizen_ids
+        :return: None
+        """
+        # get citizens ids of the current import
+        id_list = connection.execute(
+            db.select([Citizen.c.id, Citizen.c.citizen_id]).where(Citizen.c.import_id == import_id)
+        ).fetchall()
+        # map database ids to citizen ids
+        rev_id_map = {k: v for v, k in id_list}
+        # create relationships
+        relationships = [{'citizen_id': rev_id_map[citizen], 'relative_id': rev_id_map[relative]}
+                         for citizen, relative in relative_links]
+        # push into database
+        connection.execute(Relative.insert(), relationships)
+
+    def create_import(self, citizens: List[Dict], relative_links: List[Tuple[int, int]],
+                      digest: Optional[str] = None) -> int:
+        with self._transaction() as connection:
+            return self._insert_import(connection, citizens, relative_links, digest)
+
+    def _insert_import(self, connection: Connection, citizens: List[Dict], relative_links: List[Tuple[int, int]],
+                       digest: Optional[str]) -> int:
+        """
+        Stores a new import in the transaction of the connection
+        :param connection: connection with an open transaction
+        :param citizens: validated citizens, each citizen is a dict
+        :param relative_links: relationship links list of citizen_ids
+        :param digest: content hash of the import or None
+        :return: id of the new import
+        """
+        # putting new import record into db and getting resulting primary key back
+        import_id = connection.execute(Import.insert(), [{}]).inserted_primary_key[0]
+
+        # assigning IDs manually as bulk saving ignores
+        # relationships
+        for citizen in citizens:
+            citizen['import_id'] = import_id
+
+        # putting citizens into db
+        connection.execute(Citizen.insert(), citizens)
+
+        # store relationships only if they exist
+        if relative_links:
+            self.store_relationships(connection, import_id, relative_links)
+
+        self._count_birth_histogram(connection, import_id)
+
+        if digest is not None:
+            connection.execute(ImportHash.insert(), [{'import_id': import_id, 'hash': digest,
+                                                      'created': datetime.utcnow()}])
+        return import_id
+
+    def create_unique_import(self, citizens: List[Dict], relative_links: List[Tuple[int, int]], digest: str,
+                             since: Optional[datetime] = None) -> Tuple[int, bool]:
+        with self.hash_lock(digest) as connection:
+            import_id = self._find_import_by_hash(connection, digest, since)
+            if import_id is not None:
+                return import_id, False
+            return self._insert_import(connection, citizens, relative_links, digest), True
+
+    def _execute(self, name: str, fetch: Callable[[ResultProxy], Any], **params) -> Any:
+        """
+        Executes a statement from the query registry
+        :param name: statement name
+        :param fetch: result consumer, called while the connection is still checked out
+        :param params: statement parameters
+        :return: fetch result
+        """
+        with self.engine.connect() as connection, deadlines.budgeted(connection):
+            return fetch(self.queries.execute(connection, self.queries.statement(name), params))
+
+    def citizens_with_relatives(self, import_id: int) -> Sequence:
+        return self._execute('citizens_with_relatives', _tuples, import_id=import_id)
+
+    def birthday_rows(self, import_id: int) -> Sequence:
+        return self._execute('birthday_rows', _tuples, import_id=import_id)
+
+    def town_stat_rows(self, import_id: int) -> Sequence:
+        return self._execute('town_stat_rows', _tuples, import_id=import_id)
+
+    def birth_histogram(self, import_id: int) -> Sequence:
+        return self._execute('birth_histogram', _tuples, import_id=import_id)
+
+    @staticmethod
+    def _count_birth_histogram(connection: Connection, import_id: Optional[int] = None) -> None:
+        """
+        Replaces birth histogram cells with the ones counted from citizens
+        :param connection: connection with an open transaction
+        :param import_id: [OPTIONAL] import to recount, all the imports by default
+        :return: None
+        """
+        cells = db.select([Citizen.c.import_id, Citizen.c.town, Citizen.c.birth_date, db.func.count()]) \
+            .group_by(Citizen.c.import_id, Citizen.c.town, Citizen.c.birth_date)
+        delete = BirthHistogram.delete()
+        if import_id is not None:
+            cells = cells.where(Citizen.c.import_id == import_id)
+            delete = delete.where(BirthHistogram.c.import_id == import_id)
+        connection.execute(delete)
+        connection.execute(BirthHistogram.insert().from_select(['import_id', 'town', 'birth_date', 'count'], cells))
+
+    def rebuild_birth_histogram(self, import_id: Optional[int] = None) -> None:
+        with self._transaction() as connection:
+            self._count_birth_histogram(connection, import_id)
+
+    def import_version(self, import_id: int) -> Optional[int]:
+        return self._execute('import_version', ResultProxy.scalar, import_id=import_id)
+
+    def citizen_ids(self, import_id: int) -> List[int]:
+        return [x for x, in self._execute('citizen_ids', ResultProxy.fetchall, import_id=import_id)]
+
+    def relative_pairs(self, import_id: int, citizen_ids: Optional[List[int]] = None) -> List[Tuple[int, int]]:
+        if citizen_ids is not None:
+            return self._execute('relative_pairs_of', ResultProxy.fetchall, import_id=import_id,
+                                 citizen_ids=list(citizen_ids))
+        return self._execute('relative_pairs', ResultProxy.fetchall, import_id=import_id)
+
+    def citizen_stream(self, import_id: int, batch_size: int = 1000) -> Iterator[Tuple]:
+        statement = self.queries.statement('citizen_stream')
+        with self.engine.connect() as connection, deadlines.budgeted(connection):
+            # server-side cursor, prepared statements can not be declared as cursors so the registry is bypassed
+            result = connection.execution_options(stream_results=True, compiled_cache=self.queries.compiled_cache) \
+                .execute(statement.statement, import_id=import_id)
+            for rows in iter(lambda: result.fetchmany(batch_size), []):
+                yield from rows
+                deadlines.check()
+
+    def _lock_import(self, connection: Connection, import_id: int) -> Optional[int]:
+        """
+        Locks the import row till the end of the transaction, changes of the same import made by any worker
+        are applied one after another. Every change locks the import before its citizens.
+        :param connection: connection with an open transaction
+        :param import_id: import to lock
+        :return: current version or None if import does not exist
+        """
+        return self.queries.execute(connection, self.queries.statement('lock_import'),
+                                    {'import_id': import_id}).scalar()
+
+    def _id_map(self, connection: Connection, import_id: int, citizen_ids: Iterable[int]) -> Dict[int, int]:
+        """
+        :param connection: connection with an open transaction
+        :param import_id: requested import_id
+        :param citizen_ids: requested citizen_ids
+        :return: citizen_id -> database id of the existing ones
+        """
+        return dict(self.queries.execute(connection, self.queries.statement('citizen_id_map'),
+                                         {'import_id': import_id, 'citizen_ids': list(citizen_ids)}).fetchall())
+
+    def _add_links(self, connection: Connection, links: Iterable[Tuple[int, int]]) -> None:
+        """
+        :param connection: connection with an open transaction
+        :param links: (citizen database id, relative database id) pairs to insert
+        :return: None
+        """
+        links = list(links)
+        self.queries.execute(connection, self.queries.statement('add_relatives'),
+                             {'db_citizen_ids': [x[0] for x in links], 'db_relative_ids': [x[1] for x in links]})
+
+    def _finish_change(self, connection: Connection, import_id: int, cells: Dict[Tuple[str, date], int]) -> int:
+        """
+        Moves birth histogram cells by their net change and bumps import version, last steps of every change
+        :param connection: connection with the transaction of the change
+        :param import_id: changed import
+        :param cells: (town, birth_date) -> change of count, no zeros
+        :return: new import version
+        """
+        if cells:
+            upsert = insert(BirthHistogram)
+            connection.execute(upsert.on_conflict_do_update(
+                index_elements=BirthHistogram.primary_key.columns,
+                set_={'count': BirthHistogram.c.count + upsert.excluded.count}
+            ), [{'import_id': import_id, 'town': town, 'birth_date': birth_date, 'count': change}
+                for (town, birth_date), change in cells.items()])
+            emptied = [{'town': town, 'birth_date': birth_date}
+                       for (town, birth_date), change in cells.items() if change < 0]
+            if emptied:
+                connection.execute(BirthHistogram.delete()
+                                   .where(BirthHistogram.c.import_id == import_id)
+                                   .where(BirthHistogram.c.town == bindparam('town'))
+                                   .where(BirthHistogram.c.birth_date == bindparam('birth_date'))
+                                   .where(BirthHistogram.c.count <= 0), emptied)
+        return self.queries.execute(connection, self.queries.statement('bump_version'),
+                                    {'where_import_id': import_id}).scalar()
+
+    def patch_citizen(self, import_id: int, citizen_id: int, values: Dict) -> Optional[Dict]:
+        with self._transaction() as connection:
+            if self._lock_import(connection, import_id) is None:
+                return None
+            citizen = self.queries.execute(connection, self.queries.statement('citizen'),
+                                           {'import_id': import_id, 'citizen_id': citizen_id}).fetchone()
+            if citizen is None:
+                return None
+            citizen = dict(citizen)
+            db_citizen_id = citizen['id']
+
+            # citizen_id -> database id of the current relatives
+            current = dict(self.queries.execute(connection, self.queries.statement('relative_id_map'),
+                                                {'db_citizen_id': db_citizen_id}).fetchall())
+            added, removed = set(), set()
+            if 'relatives' in values:
+                added, removed = aggregation.relatives_diff(current, values['relatives'])
+                id_map = self._id_map(connection, import_id, added) if added else {}
+                if len(id_map) != len(added):
+                    raise ValidationError('Citizen relatives contain unexistent citizen_id')
+                if removed:
+                    params = {'db_citizen_id': db_citizen_id, 'db_relative_ids': [current[x] for x in removed]}
+                    self.queries.execute(connection, self.queries.statement('remove_relatives'), params)
+                    self.queries.execute(connection, self.queries.statement('remove_relatives_opposite'), params)
+                if added:
+                    self._add_links(connection, {(db_citizen_id, id_map[x]) for x in added} |
+                                    {(id_map[x], db_citizen_id) for x in added})
+                relatives = values['relatives']
+            else:
+                relatives = list(current)
+
+            columns = tuple(column for column in UPDATABLE_COLUMNS if column in values)
+            if columns:
+                self.queries.execute(connection, self.queries.statement('update_citizen_by_id', columns),
+                                     {'db_citizen_id': db_citizen_id,
+                                      **{f'set_{column}': values[column] for column in columns}})
+            previous = (citizen['town'], citizen['birth_date'])
+            citizen.update((column, values[column]) for column in columns)
+            current_cell = (citizen['town'], citizen['birth_date'])
+            cells = {previous: -1, current_cell: 1} if previous != current_cell else {}
+
+            version = self._finish_change(connection, import_id, cells)
+        return {'version': version, 'citizen': citizen, 'relatives': relatives, 'added': added, 'removed': removed,
+                'cells': cells}
+
+    def citizen_relatives(self, import_id: int, citizen_ids: Iterable[int]) -> Dict[int, List[int]]:
+        return dict(self._execute('citizen_relatives', _tuples, import_id=import_id, citizen_ids=list(citizen_ids)))
+
+    def apply_delta(self, import_id: int, citizens: List[Dict], removed: List[int]) -> Optional[Dict]:
+        listed = [citizen['citizen_id'] for citizen in citizens]
+        cells = Counter()
+        with self._transaction() as connection:
+            if self._lock_import(connection, import_id) is None:
+                return None
+            # current relatives of the delta citizens and of their relatives, nothing else is checked
+            params = {'import_id': import_id, 'citizen_ids': list(delta_neighbourhood(citizens, removed))}
+            relatives = dict(self.queries.execute(connection, self.queries.statement('citizen_relatives'),
+                                                  params).fetchall())
+            relative_links = validate_delta(relatives, citizens, removed)
+
+            current = {citizen_id: (db_id, town, birth_date) for db_id, citizen_id, town, birth_date in
+                       connection.execute(db.select([Citizen.c.id, Citizen.c.citizen_id, Citizen.c.town,
+                                                     Citizen.c.birth_date])
+                                          .where(Citizen.c.import_id == import_id)
+                                          .where(Citizen.c.citizen_id == db.func.any(listed + removed)))}
+            for db_id, town, birth_date in current.values():
+                cells[town, birth_date] -= 1
+
+            # relationships of the touched citizens go away in both directions
+            if current:
+                pairs = connection.execute(
+                    Relative.delete().where(Relative.c.citizen_id == db.func.any([x[0] for x in current.values()]))
+                    .returning(Relative.c.citizen_id, Relative.c.relative_id)
+                ).fetchall()
+                if pairs:
+                    connection.execute(Relative.delete().where(Relative.c.citizen_id == bindparam('relative'))
+                                       .where(Relative.c.relative_id == bindparam('citizen')),
+                                       [{'citizen': citizen, 'relative': relative} for citizen, relative in pairs])
+            if removed:
+                connection.execute(Citizen.delete().where(Citizen.c.id == db.func.any([current[x][0]
+                                                                                       for x in removed])))
+
+            replaced = [citizen for citizen in citizens if citizen['citizen_id'] in current]
+            inserted = [citizen for citizen in citizens if citizen['citizen_id'] not in current]
+            if replaced:
+                connection.execute(self.queries.statement('update_citizen_by_id', UPDATABLE_COLUMNS).statement,
+                                   [{'db_citizen_id': current[citizen['citizen_id']][0],
+                                     **{f'set_{column}': citizen[column] for column in UPDATABLE_COLUMNS}}
+                                    for citizen in replaced])
+            if inserted:
+                connection.execute(Citizen.insert(), [{'import_id': import_id, 'citizen_id': citizen['citizen_id'],
+                                                       **{column: citizen[column] for column in UPDATABLE_COLUMNS}}
+                                                      for citizen in inserted])
+            for citizen in citizens:
+                cells[citizen['town'], citizen['birth_date']] += 1
+
+            if relative_links:
+                # database ids of the listed citizens and of their relatives
+                ids = {citizen for link in relative_links for citizen in link}
+                id_map = self._id_map(connection, import_id, ids)
+                links = set()
+                for citizen, relative in relative_links:
+                    links.add((id_map[citizen], id_map[relative]))
+                    links.add((id_map[relative], id_map[citizen]))
+                self._add_links(connection, links)
+
+            cells = {cell: change for cell, change in cells.items() if change}
+            version = self._finish_change(connection, import_id, cells)
+        return {'version': version, 'inserted': len(inserted), 'replaced': len(replaced), 'deleted': len(removed),
+                'replaced_ids': [citizen['citizen_id'] for citizen in replaced], 'cells': cells}
+
+    @contextmanager
+    def hash_lock(self, digest: str) -> Iterator[Connection]:
+        """
+        Serializes uploads of the same content with a transaction-level advisory lock on the content hash,
+        the lock is released when the transaction ends
+        :param digest: content hash of an import
+        :return: context manager giving the connection holding the lock
+        """
+        with self._transaction() as connection:
+            connection.execute(db.select([db.func.pg_advisory_xact_lock(db.func.hashtext(digest))]))
+            yield connection
+
+    def find_import_by_hash(self, digest: str, since: Optional[datetime] = None) -> Optional[int]:
+        """
+        :param digest: content hash of an import
+        :param since: [OPTIONAL] ignore imports created before this moment
+        :return: latest import_id with the same content hash or None
+        """
+        with self._transaction() as connection:
+            return self._find_import_by_hash(connection, digest, since)
+
+    @staticmethod
+    def _find_import_by_hash(connection: Connection, digest: str, since: Optional[datetime]) -> Optional[int]:
+        query = db.select([ImportHash.c.import_id]).where(ImportHash.c.hash == digest)
+        if since is not None:
+            query = query.where(ImportHash.c.created >= since)
+        return connection.execute(query.order_by(ImportHash.c.import_id.desc()).limit(1)).scalar()
+
+    def drop_import_hash(self, import_id: int) -> int:
+        with self._transaction() as connection:
+            return connection.execute(ImportHash.delete().where(ImportHash.c.import_id == import_id)).rowcount
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Set
 
 from marshmallow import Schema, fields, pre_load, ValidationError
 from marshmallow.validate import Range, Length
@@ -44,6 +44,17 @@ citizenSchema = CitizenSchema()
 citizensSchema = CitizenSchema(many=True)
 
 
+class DeltaSchema(Schema):
+    """
+    Changes of an existing import: citizens to insert or replace as a whole and citizen_ids to delete
+    """
+    citizens = fields.List(fields.Nested(CitizenSchema), load_default=list)
+    removed = fields.List(fields.Integer(strict=True, validate=[Range(min=1)]), load_default=list)
+
+
+deltaSchema = DeltaSchema()
+
+
 def validate_relatives(citizens: List[Dict]) -> List[Tuple[int, int]]:
     """
     Makes sure all relationships are mutual and all relative_ids are present in the dataset.
@@ -74,3 +85,62 @@ def validate_citizen_ids(citizens: List[Dict]) -> None:
     ids = {citizen['citizen_id'] for citizen in citizens}
     if len(citizens) != len(ids):
         raise ValidationError('Duplicate citizen_id found!')
+
+
+def delta_neighbourhood(citizens: List[Dict], removed: List[int]) -> Set[int]:
+    """
+    :param citizens: inserted or replaced citizens of a delta
+    :param removed: deleted citizen_ids of a delta
+    :return: citizen_ids whose current relatives are needed to validate the delta
+    """
+    ids = set(removed)
+    for citizen in citizens:
+        ids.add(citizen['citizen_id'])
+        ids.update(citizen['relatives'])
+    return ids
+
+
+def validate_delta(current: Dict[int, List[int]], citizens: List[Dict], removed: List[int]) -> List[Tuple[int, int]]:
+    """
+    Makes sure relationships stay mutual after a delta is applied. Only the delta citizens and their relatives
+    are checked, the rest of the import is left untouched by the delta and stays valid.
+    :param current: current relatives of the existing citizens of the delta neighbourhood, keyed by citizen_id
+    :param citizens: inserted or replaced citizens, each citizen is a dict
+    :param removed: deleted citizen_ids
+    :return: relationship links of the inserted and replaced citizens
+    """
+    validate_citizen_ids(citizens)
+    listed = {x['citizen_id']: x['relatives'] for x in citizens}
+    deleted = set(removed)
+    if len(deleted) != len(removed):
+        raise ValidationError('Duplicate removed citizen_id found!')
+    touched = deleted | listed.keys()
+    if len(touched) != len(deleted) + len(listed):
+        raise ValidationError('A citizen can not be both replaced and removed!')
+
+    for citizen in deleted:
+        if citizen not in current:
+            raise ValidationError(f'Removed citizen {citizen} does not exist')
+        for relative in current[citizen]:
+            if relative not in touched:
+                raise ValidationError(f'Removed citizen {citizen} is still a relative of {relative}')
+
+    relative_links = []
+    for citizen, relatives in listed.items():
+        for relative in relatives:
+            relative_links.append((citizen, relative))
+            if relative in deleted:
+                raise ValidationError(f'Citizen {citizen} has got a removed relative {relative}')
+            if relative in listed:
+                mutual = citizen in listed[relative]
+            elif relative in current:
+                mutual = citizen in current[relative]
+            else:
+                raise ValidationError(f'Citizen {citizen} has got an unexistent relative {relative}')
+            if not mutual:
+                raise ValidationError(f'Relationship between {citizen} and {relative} is not mutual!')
+        # relatives outside of the delta keep pointing at a replaced citizen
+        for relative in current.get(citizen, ()):
+            if relative not in touched and relative not in relatives:
+                raise ValidationError(f'Relationship between {relative} and {citizen} is not mutual!')
+    return relative_links